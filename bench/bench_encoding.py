@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare serializing records the old way (packb, then packb again with
+default= if that raised TypeError) with triton.encoding.msgpack_pack().
+
+    python bench/bench_encoding.py
+"""
+from __future__ import print_function
+import datetime
+import decimal
+import timeit
+
+import msgpack
+
+from triton.encoding import msgpack_encode_default, msgpack_pack
+
+NUMBER = 20000
+
+PLAIN = {
+    'value': 'some_key',
+    'ts': 1442357062.123,
+    'user_id': 123456,
+    'tags': ['a', 'b', 'c'],
+    'nested': {'x': 1, 'y': 2.5, 'z': None},
+}
+
+EXTRA = dict(PLAIN, **{
+    'amount': decimal.Decimal('12.50'),
+    'created': datetime.datetime(2015, 9, 15, 12, 30),
+    'day': datetime.date(2015, 9, 15),
+})
+
+
+def two_pass(data):
+    try:
+        return msgpack.packb(data)
+    except TypeError:
+        return msgpack.packb(data, default=msgpack_encode_default)
+
+
+def main():
+    for name, data in (('plain', PLAIN), ('decimal/datetime', EXTRA)):
+        for func in (two_pass, msgpack_pack):
+            secs = min(timeit.repeat(
+                lambda: func(data), number=NUMBER, repeat=5))
+            print("{:<18} {:<14} {:6.2f} us/record".format(
+                name, func.__name__, secs / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure how many events per second tritond can take in.
+
+Starts tritond with --skip-kinesis writing to a temporary file, pushes events
+at it as fast as it will accept them, and times how long it takes for the
+last one to be written out.
+
+    python bench/bench_tritond.py [num_events] [num_senders]
+
+Events are sent from several processes so that sending isn't the bottleneck.
+"""
+from __future__ import print_function
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import msgpack
+import zmq
+
+from triton import nonblocking_stream
+
+BENCH_PORT = 3519
+DONE_STREAM = 'bench_done'
+
+
+def send_events(num_events):
+    context = zmq.Context()
+    sock = context.socket(zmq.PUSH)
+    sock.connect('tcp://127.0.0.1:%d' % BENCH_PORT)
+
+    event = nonblocking_stream.NonblockingStream(
+        'bench', 'key')._serialize_context({'key': 'a', 'value': 1})
+    for _ in range(num_events):
+        sock.send_multipart(event)
+
+    sock.close(-1)
+    context.term()
+
+
+def main():
+    num_events = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    num_senders = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    output = tempfile.NamedTemporaryFile(delete=False)
+    output.close()
+
+    env = dict(os.environ, TRITON_ZMQ_PORT=str(BENCH_PORT))
+    tritond = subprocess.Popen(
+        [sys.executable, 'bin/tritond', '--skip-kinesis',
+         '--output_file', output.name],
+        env=env)
+
+    try:
+        time.sleep(1.0)
+
+        done = nonblocking_stream.NonblockingStream(
+            DONE_STREAM, 'key')._serialize_context({'key': 'a'})
+        done_marker = msgpack.packb(DONE_STREAM)
+
+        start = time.time()
+        senders = [
+            multiprocessing.Process(
+                target=send_events, args=(num_events // num_senders,))
+            for _ in range(num_senders)
+        ]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+
+        # Sent once everything else has been, so it's received last
+        context = zmq.Context()
+        sock = context.socket(zmq.PUSH)
+        sock.connect('tcp://127.0.0.1:%d' % BENCH_PORT)
+        sock.send_multipart(done)
+
+        while True:
+            with open(output.name, 'rb') as f:
+                if done_marker in f.read():
+                    break
+            time.sleep(0.01)
+        elapsed = time.time() - start
+
+        print("{} events in {:.2f}s: {:.0f} events/sec".format(
+            num_events, elapsed, num_events / elapsed))
+        sock.close(0)
+    finally:
+        tritond.terminate()
+        tritond.wait()
+        os.unlink(output.name)
+
+
+if __name__ == '__main__':
+    main()
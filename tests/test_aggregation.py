@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+
+from testify import *
+
+from triton import aggregation
+
+
+def packed(data, partition_key='a'):
+    return {'Data': data, 'PartitionKey': partition_key}
+
+
+class AggregateTest(TestCase):
+
+    def test_format(self):
+        (record, idxs), = aggregation.aggregate(
+            [packed(b'x'), packed(b'y', 'b'), packed(b'z')],
+            shard_of=lambda key: 'shardId-1')
+        assert_equal(idxs, [0, 1, 2])
+        assert_equal(record['PartitionKey'], 'a')
+
+        message = (
+            b'\x0a\x01a'                      # partition_key_table 'a'
+            b'\x1a\x05\x08\x00\x1a\x01x'      # record 0 -> key 0
+            b'\x0a\x01b'                      # partition_key_table 'b'
+            b'\x1a\x05\x08\x01\x1a\x01y'      # record 1 -> key 1
+            b'\x1a\x05\x08\x00\x1a\x01z'      # record 2 -> key 0
+        )
+        assert_equal(
+            record['Data'],
+            aggregation.MAGIC + message + hashlib.md5(message).digest())
+
+    def test_round_trip(self):
+        records = [packed(b'x' * n, 'key %d' % (n % 3)) for n in range(200)]
+        aggregated = aggregation.aggregate(
+            records, shard_of=lambda key: 'shardId-1')
+
+        assert_equal(len(aggregated), 1)
+        record, idxs = aggregated[0]
+        assert_equal(idxs, list(range(200)))
+        assert_equal(
+            aggregation.deaggregate(record['Data']),
+            [(r['PartitionKey'], r['Data']) for r in records])
+
+    def test_grouped_by_shard(self):
+        records = [packed(b'x', 'a'), packed(b'y', 'b'), packed(b'z', 'c'),
+                   packed(b'w', 'a')]
+        shards = {'a': 'shardId-1', 'b': 'shardId-2', 'c': 'shardId-1'}
+        aggregated = aggregation.aggregate(records, shard_of=shards.get)
+
+        assert_equal([idxs for _, idxs in aggregated], [[0, 2, 3], [1]])
+        assert_equal(
+            aggregation.deaggregate(aggregated[0][0]['Data']),
+            [('a', b'x'), ('c', b'z'), ('a', b'w')])
+        assert_equal(aggregated[1][0], records[1])
+
+    def test_grouped_by_partition_key(self):
+        records = [packed(b'x', 'a'), packed(b'y', 'b'), packed(b'z', 'a')]
+        aggregated = aggregation.aggregate(records)
+
+        assert_equal([idxs for _, idxs in aggregated], [[0, 2], [1]])
+
+    def test_max_size(self):
+        records = [packed(b'x' * 100) for _ in range(10)]
+        aggregated = aggregation.aggregate(records, max_size=500)
+
+        assert_equal(sorted(sum((idxs for _, idxs in aggregated), [])),
+                     list(range(10)))
+        for record, _ in aggregated:
+            assert_lte(len(record['Data']), 500)
+
+    def test_single_passed_through(self):
+        big = packed(b'x' * 1000)
+        small = packed(b'y')
+
+        aggregated = aggregation.aggregate([small, big], max_size=500)
+        assert_equal(aggregated, [(small, [0]), (big, [1])])
+
+    def test_deaggregate_plain(self):
+        assert_equal(aggregation.deaggregate(b'\x81\xa1a\x01'), None)
+
+    def test_deaggregate_bad_digest(self):
+        (record, _), = aggregation.aggregate([packed(b'x'), packed(b'y')])
+        data = record['Data'][:-1] + b'\x00'
+        assert_equal(aggregation.deaggregate(data), None)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+from testify import *
+import base64
+import six
+import threading
+
+import msgpack
+
+from triton import stream
+
+if six.PY3:
+    import asyncio
+    from triton import async_stream
+
+
+def generate_raw_record(n=1):
+    data = base64.b64encode(msgpack.packb({'value': True}))
+
+    raw_record = {'SequenceNumber': n, 'Data': data}
+
+    return raw_record
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+class AsyncCombinedStreamIteratorTest(TestCase):
+    """asyncio is only available on python 3; these tests no-op on 2"""
+
+    def build_stream(self, get_records):
+        s = turtle.Turtle()
+        s.name = 'test stream'
+        s.conn.get_records = get_records
+        return s
+
+    def test_multiple(self):
+        if not six.PY3:
+            return
+
+        def get_records(iter_value, **kwargs):
+            if iter_value in (1, 2):
+                records = [generate_raw_record(iter_value * 10 + n)
+                           for n in range(3)]
+            else:
+                records = []
+            return {
+                'NextShardIterator': 'done',
+                'MillisBehindLatest': 0,
+                'Records': records
+            }
+
+        s = self.build_stream(get_records)
+        i1 = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST)
+        i1._iter_value = 1
+        i2 = stream.StreamIterator(s, 1, stream.ITER_TYPE_LATEST)
+        i2._iter_value = 2
+
+        c = async_stream.AsyncCombinedStreamIterator([i1, i2])
+
+        records = [run(c.__anext__()) for _ in range(6)]
+        c.stop()
+        assert_raises(StopAsyncIteration, run, c.__anext__())
+
+        assert_equal(set(r.seq_num for r in records),
+                     set([10, 11, 12, 20, 21, 22]))
+        assert_equal(c._delivered_seq_nums, {i1: 12, i2: 22})
+
+    def test_shard_error(self):
+        if not six.PY3:
+            return
+
+        def get_records(iter_value, **kwargs):
+            raise ValueError(iter_value)
+
+        s = self.build_stream(get_records)
+        i = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST)
+        i._iter_value = 1
+
+        c = async_stream.AsyncCombinedStreamIterator([i])
+        assert_raises(ValueError, run, c.__anext__())
+
+    def test_all_shards_ended(self):
+        if not six.PY3:
+            return
+
+        def get_records(iter_value, **kwargs):
+            return {
+                'NextShardIterator': None,
+                'MillisBehindLatest': 0,
+                'Records': [generate_raw_record(1)]
+            }
+
+        c = turtle.Turtle()
+        c.get_records = get_records
+        s = stream.Stream(c, 'test stream', 'value')
+        s._shards = [{'ShardId': '0001'}]
+        s.refresh_shards = lambda: None
+
+        i = stream.StreamIterator(s, '0001', stream.ITER_TYPE_LATEST)
+        i._iter_value = 1
+
+        c = async_stream.AsyncCombinedStreamIterator([i])
+        assert_equal(run(c.__anext__()).seq_num, 1)
+        assert_raises(StopAsyncIteration, run, c.__anext__())
+
+    def test_merged_child_started_once(self):
+        if not six.PY3:
+            return
+
+        def get_records(iter_value, **kwargs):
+            return {
+                'NextShardIterator': None,
+                'MillisBehindLatest': 0,
+                'Records': []
+            }
+
+        c = turtle.Turtle()
+        c.get_records = get_records
+        s = stream.Stream(c, 'test stream', 'value')
+        s._shards = [
+            {'ShardId': '0001'},
+            {'ShardId': '0002'},
+            {'ShardId': '0003', 'ParentShardId': '0001',
+             'AdjacentParentShardId': '0002'},
+        ]
+
+        # Hold the first shard to retire, at each step, until the second
+        # catches up
+        def meet(barrier):
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                pass
+
+        retired_barrier = threading.Barrier(2, timeout=0.2)
+        refresh_barrier = threading.Barrier(2, timeout=0.2)
+
+        class MeetingSet(set):
+            def add(self, item):
+                super(MeetingSet, self).add(item)
+                meet(retired_barrier)
+
+        s.refresh_shards = lambda: meet(refresh_barrier)
+
+        i1 = stream.StreamIterator(s, '0001', stream.ITER_TYPE_LATEST)
+        i1._iter_value = 1
+        i2 = stream.StreamIterator(s, '0002', stream.ITER_TYPE_LATEST)
+        i2._iter_value = 1
+
+        c = async_stream.AsyncCombinedStreamIterator([i1, i2])
+        c._retired_shard_ids = MeetingSet()
+        started = []
+        retire_iterator = c._retire_iterator
+
+        def record_children(closed_iterator):
+            children = retire_iterator(closed_iterator)
+            for child in children:
+                started.append(child.shard_id)
+                child._iter_value = 1
+            return children
+
+        c._retire_iterator = record_children
+
+        async def read_all():
+            c._start()
+            while not all(task.done() for task in c._tasks):
+                await asyncio.gather(*c._tasks)
+
+        run(read_all())
+        assert_equal(started, ['0003'])
+
+    def test_checkpoint(self):
+        if not six.PY3:
+            return
+
+        checkpoints = []
+
+        class FakeCheckpointer(object):
+            def checkpoint(self, shard_id, seq_num):
+                checkpoints.append((shard_id, seq_num))
+
+        s = self.build_stream(None)
+        i = stream.StreamIterator(s, '0001', stream.ITER_TYPE_LATEST)
+        i._checkpointer = FakeCheckpointer()
+
+        c = async_stream.AsyncCombinedStreamIterator([i])
+        c._delivered_seq_nums[i] = 5
+
+        c.checkpoint()
+        assert_equal(checkpoints, [('0001', 5)])
+
+        run(c.checkpoint_async())
+        assert_equal(checkpoints, [('0001', 5), ('0001', 5)])
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+from testify import *
+
+from triton import batching_stream, errors, stream
+
+
+class FakePutRecords(object):
+    """Records each put_records call, failing records whose value is 'bad'"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, records, stream_name, **kwargs):
+        self.calls.append(len(records))
+        resp = []
+        for n, r in enumerate(records):
+            if r['PartitionKey'] == 'bad':
+                resp.append({'ErrorCode': 'InternalFailure'})
+            else:
+                resp.append({'ShardId': '0001', 'SequenceNumber': n})
+        return {'Records': resp}
+
+
+class PutFutureTest(TestCase):
+
+    def test_result(self):
+        f = batching_stream.PutFuture()
+        assert not f.done()
+
+        f.set_result(('0001', 1))
+        assert f.done()
+        assert_equal(f.result(), ('0001', 1))
+        assert_equal(f.exception(), None)
+
+    def test_exception(self):
+        f = batching_stream.PutFuture()
+        f.set_exception(ValueError())
+
+        assert_raises(ValueError, f.result)
+        assert isinstance(f.exception(), ValueError)
+
+    def test_timeout(self):
+        f = batching_stream.PutFuture()
+        assert_raises(errors.PutTimeoutError, f.result, 0)
+
+    def test_callback(self):
+        f = batching_stream.PutFuture()
+        called = []
+        f.add_done_callback(called.append)
+        f.set_result(('0001', 1))
+        assert_equal(called, [f])
+
+        # Callbacks added once done are called right away
+        f.add_done_callback(called.append)
+        assert_equal(called, [f, f])
+
+
+class BatchingStreamTest(TestCase):
+
+    @setup
+    def build_stream(self):
+        c = turtle.Turtle()
+        self.put_records = FakePutRecords()
+        c.put_records = self.put_records
+        self.stream = stream.Stream(c, 'test stream', 'value')
+
+    def test_linger(self):
+        s = batching_stream.BatchingStream(self.stream, linger_secs=0.1)
+
+        futures = [s.put(value=str(n)) for n in range(3)]
+        assert_equal([f.result(1.0) for f in futures],
+                     [('0001', 0), ('0001', 1), ('0001', 2)])
+
+        # All three went out together once the linger time passed
+        assert_equal(self.put_records.calls, [3])
+        s.close()
+
+    def test_max_batch_records(self):
+        s = batching_stream.BatchingStream(
+            self.stream, linger_secs=10.0, max_batch_records=2)
+
+        futures = [s.put(value=str(n)) for n in range(2)]
+        for f in futures:
+            f.result(1.0)
+
+        assert_equal(self.put_records.calls, [2])
+        s.close()
+
+    def test_flush(self):
+        s = batching_stream.BatchingStream(self.stream, linger_secs=10.0)
+
+        f = s.put(value='1')
+        s.flush()
+
+        assert f.done()
+        assert_equal(self.put_records.calls, [1])
+        s.close()
+
+    def test_flush_after_write(self):
+        s = batching_stream.BatchingStream(self.stream, linger_secs=0.0)
+
+        s.put(value='1').result(1.0)
+        s.flush()
+        s.close()
+
+        # Nothing was left to write, or to wait for
+        assert_equal(self.put_records.calls, [1])
+        assert_equal(s._in_flight, [])
+
+    def test_close(self):
+        s = batching_stream.BatchingStream(self.stream, linger_secs=10.0)
+
+        f = s.put(value='1')
+        s.close()
+
+        assert f.done()
+        assert_raises(errors.Error, s.put, value='2')
+
+    def test_close_at_exit(self):
+        s = batching_stream.BatchingStream(self.stream, linger_secs=10.0)
+
+        f = s.put(value='1')
+        batching_stream.close()
+
+        assert f.done()
+        assert_equal(self.put_records.calls, [1])
+        assert s not in batching_stream._open_streams
+
+    def test_failed_records(self):
+        s = batching_stream.BatchingStream(self.stream, linger_secs=10.0)
+
+        good = s.put(value='good')
+        bad = s.put(value='bad')
+        other_bad = s.put(value='bad')
+        s.flush()
+
+        assert_equal(good.result(), ('0001', 0))
+        assert isinstance(bad.exception(), errors.KinesisPutManyError)
+        # Each future's error only covers its own record
+        assert_equal(len(bad.exception().failed_data), 1)
+        assert bad.exception() is not other_bad.exception()
+        s.close()
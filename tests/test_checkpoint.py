@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from testify import *
 import tempfile
+import time
 import sqlite3
 import mock
 import msgpack
@@ -243,7 +244,7 @@ class StreamIteratorCheckpointTest(TestCase):
             with mock.patch(chkpt_patch, new=TritonCheckpointerTest):
                 c = turtle.Turtle()
                 s = stream.Stream(c, stream_name, 'p_key')
-                s._shard_ids = [shard_id, ]
+                s._shards = [{'ShardId': shard_id}]
 
                 s.conn.get_records = get_batches_of_10_records
 
@@ -272,3 +273,254 @@ class StreamIteratorCheckpointTest(TestCase):
                 #TODO: rewrite test to properly instantiate iterator
                 #assert_truthy(
                 #    i.iterator_type == stream.ITER_TYPE_FROM_SEQNUM)
+
+
+class TritonLeaseManagerTest(checkpoint.TritonLeaseManager):
+    """patch TritonLeaseManager for sqlite3"""
+
+    def __init__(self, *args, **kwargs):
+        if not kwargs.get('client_name'):
+            kwargs['client_name'] = CLIENT_NAME
+        super(TritonLeaseManagerTest, self).__init__(*args, **kwargs)
+        for prop_name in dir(self):
+            if prop_name.endswith('_sql'):
+                prop = getattr(self, prop_name)
+                setattr(self, prop_name, prop.replace('%s', '?'))
+
+
+class LeaseTest(TestCase):
+    """Test shard lease coordination"""
+
+    shard_ids = ['shardId-000000000000', 'shardId-000000000001',
+                 'shardId-000000000002', 'shardId-000000000003']
+
+    @setup
+    def setup_db(self):
+        self.tempfile = tempfile.NamedTemporaryFile()
+        self.tempfile_name = self.tempfile.name
+        self.conn = sqlite3.connect(self.tempfile_name)
+        self.pool = SqlitePool(self.conn)
+        checkpoint.init_db(lambda: self.pool)
+
+    def lease_manager(self, owner, **kwargs):
+        patch_string = 'triton.checkpoint.get_triton_connection_pool'
+        with mock.patch(patch_string, new=lambda: self.pool):
+            return TritonLeaseManagerTest('test_lease', owner=owner, **kwargs)
+
+    def test_claim_all(self):
+        a = self.lease_manager('a')
+
+        assert_equal(a.rebalance(self.shard_ids), set(self.shard_ids))
+        assert_equal(
+            set(owner for owner, _, _ in a.leases().values()), set(['a']))
+
+    def test_rebalance_new_owner(self):
+        a = self.lease_manager('a')
+        b = self.lease_manager('b')
+        a.rebalance(self.shard_ids)
+
+        # b steals one lease per round until it has its share
+        assert_equal(len(b.rebalance(self.shard_ids)), 1)
+        assert_equal(len(b.rebalance(self.shard_ids)), 2)
+        assert_equal(len(b.rebalance(self.shard_ids)), 2)
+
+        # a notices when renewing
+        owned_a = a.rebalance(self.shard_ids)
+        assert_equal(len(owned_a), 2)
+        assert_equal(owned_a & b.rebalance(self.shard_ids), set())
+
+    def test_expired_leases_claimed(self):
+        a = self.lease_manager('a', lease_duration_secs=-1)
+        b = self.lease_manager('b')
+        a.rebalance(self.shard_ids)
+
+        assert_equal(b.rebalance(self.shard_ids), set(self.shard_ids))
+        a.renew()
+        assert_equal(a.owned_leases, {})
+
+    def test_release(self):
+        a = self.lease_manager('a')
+        b = self.lease_manager('b')
+        a.rebalance(self.shard_ids[:1])
+        a.release(self.shard_ids[0])
+
+        assert_equal(b.rebalance(self.shard_ids[:1]), set(self.shard_ids[:1]))
+
+    def test_create_race(self):
+        a = self.lease_manager('a')
+        b = self.lease_manager('b')
+
+        # Both saw no lease, only one gets to create it
+        assert a._take(self.shard_ids[0], None)
+        assert not b._take(self.shard_ids[0], None)
+        assert_equal(b.owned_leases, {})
+        assert_equal(a.leases()[self.shard_ids[0]][0], 'a')
+
+    def test_finish(self):
+        a = self.lease_manager('a')
+        b = self.lease_manager('b')
+        parent_id, child_id = self.shard_ids[:2]
+        a.rebalance([parent_id])
+
+        assert a.claim(child_id)
+        assert not b.claim(child_id)
+        a.finish(parent_id)
+
+        # Nobody claims a finished lease again
+        assert_equal(a.finished_shard_ids(), set([parent_id]))
+        assert_equal(a.owned_leases, {child_id: 0})
+        assert_equal(b.rebalance([parent_id]), set())
+        assert not b.claim(parent_id)
+
+
+class FakeLeaseManager(object):
+    def __init__(self, shard_ids):
+        self.owned_leases = dict((shard_id, 0) for shard_id in shard_ids)
+        self.renewals = 0
+
+    def rebalance(self, shard_ids):
+        return set(self.owned_leases)
+
+    def finished_shard_ids(self):
+        return set()
+
+    def finish(self, shard_id):
+        self.owned_leases.pop(shard_id, None)
+
+    def renew(self):
+        self.renewals += 1
+
+
+class LeasedStreamIteratorTest(TestCase):
+    """Test reading a stream through leases"""
+
+    @setup
+    def setup_db(self):
+        self.tempfile = tempfile.NamedTemporaryFile()
+        self.tempfile_name = self.tempfile.name
+        self.conn = sqlite3.connect(self.tempfile_name)
+        self.pool = SqlitePool(self.conn)
+        checkpoint.init_db(lambda: self.pool)
+
+    def test_rebalance(self):
+        pool_patch = 'triton.checkpoint.get_triton_connection_pool'
+        with mock.patch(pool_patch, new=lambda: self.pool):
+            c = turtle.Turtle()
+            s = stream.Stream(c, 'test_lease', 'p_key')
+            s._shards = [{'ShardId': 'shardId-000000000000'},
+                         {'ShardId': 'shardId-000000000001'}]
+
+            a = stream.LeasedCombinedStreamIterator(
+                s, TritonLeaseManagerTest('test_lease', owner='a'))
+            a._rebalance()
+            assert_equal(len(a.iterators), 2)
+
+            b = stream.LeasedCombinedStreamIterator(
+                s, TritonLeaseManagerTest('test_lease', owner='b'))
+            b._rebalance()
+            a._rebalance()
+
+            assert_equal(len(a.iterators), 1)
+            assert_equal(len(b.iterators), 1)
+            assert a.iterators[0].shard_id != b.iterators[0].shard_id
+            assert_equal(a.iterators[0].iterator_type,
+                         stream.ITER_TYPE_FROM_CHECKPOINT)
+
+    def test_renews_in_background(self):
+        c = turtle.Turtle()
+        s = stream.Stream(c, 'test_lease', 'p_key')
+        leases = FakeLeaseManager([])
+
+        i = stream.LeasedCombinedStreamIterator(
+            s, leases, renew_interval_secs=0.01)
+        i._start_renewer()
+        time.sleep(0.1)
+        i.stop()
+        i._renewer.join()
+
+        assert_gt(leases.renewals, 1)
+
+    def test_lost_lease(self):
+        c = turtle.Turtle()
+        s = stream.Stream(c, 'test_lease', 'p_key')
+        s._shards = [{'ShardId': 'shardId-000000000000'},
+                     {'ShardId': 'shardId-000000000001'}]
+        leases = FakeLeaseManager(
+            ['shardId-000000000000', 'shardId-000000000001'])
+
+        checkpoints = []
+
+        class FakeCheckpointer(object):
+            def __init__(self, stream_name):
+                pass
+
+            def checkpoint(self, shard_id, seq_num):
+                checkpoints.append((shard_id, seq_num))
+
+        with mock.patch.object(stream, 'TritonCheckpointer',
+                               FakeCheckpointer):
+            i = stream.LeasedCombinedStreamIterator(s, leases)
+            i._rebalance()
+            it_0, it_1 = sorted(i.iterators, key=lambda it: it.shard_id)
+            it_0.last_seq_num = '10'
+            it_1.last_seq_num = '20'
+            i.last_iterator = it_1
+            i.last_seq_num = '15'
+            i._records.append(stream.Record(it_1.shard_id, '16'))
+
+            # Another consumer took shard 1 while we were processing
+            del leases.owned_leases['shardId-000000000001']
+            i.checkpoint()
+            assert_equal(checkpoints, [('shardId-000000000000', '10')])
+
+            # We still record how far we got as we drop it
+            del checkpoints[:]
+            i._rebalance()
+            assert_equal(i.iterators, [it_0])
+            assert_equal(checkpoints, [('shardId-000000000001', '15')])
+            assert_equal(list(i._records), [])
+
+    def test_child_shards_leased(self):
+        pool_patch = 'triton.checkpoint.get_triton_connection_pool'
+        with mock.patch(pool_patch, new=lambda: self.pool):
+            c = turtle.Turtle()
+            s = stream.Stream(c, 'test_lease', 'p_key')
+            parent_id = 'shardId-000000000000'
+            child_ids = ['shardId-000000000001', 'shardId-000000000002']
+            s._shards = [{'ShardId': parent_id}] + [
+                {'ShardId': child_id, 'ParentShardId': parent_id}
+                for child_id in child_ids]
+            s.refresh_shards = lambda: None
+
+            a = stream.LeasedCombinedStreamIterator(
+                s, TritonLeaseManagerTest('test_lease', owner='a'))
+            a._rebalance()
+            parent_iterator, = a.iterators
+            parent_iterator._checkpointer = TritonCheckpointerTest('test_lease')
+            parent_iterator.last_seq_num = '10'
+
+            # Each child is read under its own lease
+            a._retire_iterator(parent_iterator)
+            a._rebalance()
+            assert_equal(sorted(i.shard_id for i in a.iterators), child_ids)
+            assert_equal(
+                set(a.lease_manager.owned_leases),
+                set([parent_id] + child_ids))
+
+            # Once the parent's end is checkpointed, its lease is done with
+            a.checkpoint()
+            assert_equal(set(a.lease_manager.owned_leases), set(child_ids))
+            leases = a.lease_manager.leases()
+            assert_equal(leases[parent_id][0], checkpoint.FINISHED_OWNER)
+
+            # A consumer joining after the parent ages out sees the children
+            # are leased
+            s._shards = s._shards[1:]
+            s._shard_ids = None
+            b = stream.LeasedCombinedStreamIterator(
+                s, TritonLeaseManagerTest('test_lease', owner='b'))
+            b._rebalance()
+            a._rebalance()
+            assert_equal(len(a.iterators), 1)
+            assert_equal(len(b.iterators), 1)
+            assert a.iterators[0].shard_id != b.iterators[0].shard_id
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import decimal
+
+from testify import *
+import msgpack
+
+from triton import encoding
+
+
+class Point(object):
+
+    def __init__(self, lat, lng):
+        self.coords = (lat, lng)
+
+
+class Unrepresentable(object):
+
+    def __repr__(self):
+        raise ValueError()
+
+
+class MsgpackPackTest(TestCase):
+
+    def test_plain(self):
+        data = {'value': True, 'n': [1, 2.5, None], 'text': u'宇宙'}
+        assert_equal(encoding.msgpack_pack(data), msgpack.packb(data))
+
+    def test_extra_types(self):
+        data = {
+            'd': decimal.Decimal('1.50'),
+            'dt': datetime.datetime(2015, 1, 2, 3, 4, 5),
+            'date': datetime.date(2015, 1, 2),
+            'point': Point(1.0, 2.0),
+        }
+
+        assert_equal(
+            msgpack.unpackb(encoding.msgpack_pack(data), encoding='utf-8'),
+            {
+                'd': '1.50',
+                'dt': '2015-01-02 03:04:05',
+                'date': '2015-01-02',
+                'point': '(1.0, 2.0)',
+            })
+
+    def test_matches_two_pass(self):
+        data = {'d': decimal.Decimal('1'), 'date': datetime.date(2015, 1, 2)}
+        assert_equal(
+            encoding.msgpack_pack(data),
+            msgpack.packb(data, default=encoding.msgpack_encode_default))
+
+    def test_error_resets_packer(self):
+        assert_raises(
+            TypeError, encoding.msgpack_pack,
+            {'a': 'some data', 'b': Unrepresentable()})
+
+        # Nothing from the failed call is left in the output
+        assert_equal(encoding.msgpack_pack({'a': 1}), msgpack.packb({'a': 1}))
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+from testify import *
+import mock
+
+from boto.exception import BotoServerError
+from boto.kinesis.exceptions import (
+    LimitExceededException, ProvisionedThroughputExceededException)
+
+from triton import retry
+
+
+class FailingCall(object):
+    """Raises each of errors in turn, then succeeds"""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+def throttled():
+    return ProvisionedThroughputExceededException(
+        400, 'Bad Request',
+        {'__type': 'ProvisionedThroughputExceededException'})
+
+
+class RetryBudgetTest(TestCase):
+
+    def test_withdraw(self):
+        budget = retry.RetryBudget(
+            ratio=0.5, min_retries_per_sec=0.0, max_retries=2.0)
+
+        assert budget.withdraw()
+        assert budget.withdraw()
+        assert not budget.withdraw()
+
+        budget.deposit()
+        assert not budget.withdraw()
+        budget.deposit()
+        assert budget.withdraw()
+
+
+class RetryPolicyTest(TestCase):
+
+    @setup
+    def build_policy(self):
+        self.budget = retry.RetryBudget()
+        self.policy = retry.RetryPolicy(budget=self.budget)
+
+    def test_error_kind(self):
+        assert_equal(retry.error_kind(throttled()), retry.THROTTLED)
+        assert_equal(
+            retry.error_kind(LimitExceededException(400, 'Bad Request')),
+            retry.THROTTLED)
+        assert_equal(retry.error_kind(BotoServerError(503, 'test')),
+                     retry.SERVER_ERROR)
+        assert_equal(retry.error_kind(BotoServerError(400, 'test')), None)
+
+    def test_next_delay(self):
+        delay = None
+        for _ in range(20):
+            delay = self.policy.next_delay(delay, retry.SERVER_ERROR)
+            assert_gte(delay, retry.BASE_DELAY_SECS)
+            assert_lte(delay, retry.MAX_DELAY_SECS)
+
+        delay = self.policy.next_delay(None, retry.THROTTLED)
+        assert_gte(delay, retry.THROTTLE_BASE_DELAY_SECS)
+
+    def test_call_retries(self):
+        func = FailingCall(BotoServerError(500, 'test'), throttled())
+
+        with mock.patch('time.sleep') as sleep:
+            assert_equal(self.policy.call(func), 'ok')
+
+        assert_equal(func.calls, 3)
+        assert_equal(sleep.call_count, 2)
+        assert_equal(self.policy.counters['retries'], 2)
+        assert_equal(self.policy.counters[retry.THROTTLED], 1)
+        assert_equal(self.policy.counters[retry.SERVER_ERROR], 1)
+
+    def test_call_gives_up(self):
+        func = FailingCall(*[BotoServerError(500, 'test')] * 3)
+
+        with mock.patch('time.sleep'):
+            assert_raises(BotoServerError, self.policy.call, func)
+
+        assert_equal(func.calls, 3)
+        assert_equal(self.policy.counters['give_ups'], 1)
+
+    def test_should_retry_max_retries(self):
+        assert self.policy.should_retry(
+            2, retry.SERVER_ERROR, max_retries=3)
+        assert not self.policy.should_retry(
+            3, retry.SERVER_ERROR, max_retries=3)
+        assert not self.policy.should_retry(2, retry.SERVER_ERROR)
+
+    def test_call_not_retried(self):
+        func = FailingCall(BotoServerError(400, 'test'))
+        assert_raises(BotoServerError, self.policy.call, func)
+        assert_equal(func.calls, 1)
+
+    def test_budget_exhausted(self):
+        self.budget.balance = 0.0
+        self.budget.min_retries_per_sec = 0.0
+
+        func = FailingCall(BotoServerError(500, 'test'))
+        assert_raises(BotoServerError, self.policy.call, func)
+        assert_equal(self.policy.counters['budget_exhausted'], 1)
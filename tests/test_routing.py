@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+
+from testify import *
+import mock
+
+from boto.exception import BotoServerError
+from boto.kinesis.exceptions import LimitExceededException
+
+from triton import retry, routing
+
+MAX_HASH_KEY = 2 ** 128 - 1
+
+
+def generate_shard(shard_id, start, end, closed=False):
+    shard = {
+        'ShardId': shard_id,
+        'HashKeyRange': {
+            'StartingHashKey': str(start),
+            'EndingHashKey': str(end),
+        },
+        'SequenceNumberRange': {'StartingSequenceNumber': '1'},
+    }
+    if closed:
+        shard['SequenceNumberRange']['EndingSequenceNumber'] = '2'
+    return shard
+
+
+class FakeStream(object):
+    name = 'test stream'
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.retry_policy = retry.RetryPolicy(budget=retry.RetryBudget())
+        self.refreshes = 0
+        self.refresh_errors = []
+
+    def _describe_shards(self):
+        self.refreshes += 1
+        if self.refresh_errors:
+            raise self.refresh_errors.pop(0)
+        return self.shards
+
+
+class HashKeyTest(TestCase):
+
+    def test_hash_key(self):
+        assert_equal(routing.hash_key('a'),
+                     int(hashlib.md5(b'a').hexdigest(), 16))
+        assert_equal(routing.hash_key(u'宇宙'),
+                     int(hashlib.md5(u'宇宙'.encode('utf-8')).hexdigest(), 16))
+
+
+class ShardMapTest(TestCase):
+
+    def test_shard_id(self):
+        middle = 2 ** 127
+        shard_map = routing.ShardMap([
+            generate_shard('shardId-0', 0, MAX_HASH_KEY, closed=True),
+            generate_shard('shardId-2', middle, MAX_HASH_KEY),
+            generate_shard('shardId-1', 0, middle - 1),
+        ])
+
+        for n in range(50):
+            key = 'key %d' % n
+            expected = 'shardId-1' if routing.hash_key(key) < middle \
+                else 'shardId-2'
+            assert_equal(shard_map.shard_id(key), expected)
+
+    def test_not_covered(self):
+        shard_map = routing.ShardMap([generate_shard('shardId-1', 0, 0)])
+        assert_equal(shard_map.shard_id('a'), None)
+
+
+class TokenBucketTest(TestCase):
+
+    def test_take(self):
+        bucket = routing.TokenBucket(100)
+
+        assert_equal(bucket.take(60), 0.0)
+        assert_equal(bucket.take(40), 0.0)
+
+        # Out of tokens, so we'd have to wait for them to refill
+        assert_gt(bucket.take(50), 0.45)
+        assert_lte(bucket.take(50), 1.0)
+
+
+class ShardRateLimiterTest(TestCase):
+
+    def test_delay(self):
+        s = FakeStream([generate_shard('shardId-1', 0, MAX_HASH_KEY)])
+        limiter = routing.ShardRateLimiter(s, max_records_per_sec=10)
+
+        assert_equal(limiter.delay([('a', 10)] * 10), 0.0)
+        assert_gt(limiter.delay([('a', 10)] * 5), 0.4)
+
+    def test_shards_independent(self):
+        middle = 2 ** 127
+        s = FakeStream([
+            generate_shard('shardId-1', 0, middle - 1),
+            generate_shard('shardId-2', middle, MAX_HASH_KEY),
+        ])
+        limiter = routing.ShardRateLimiter(s, max_records_per_sec=10)
+
+        keys = ['key %d' % n for n in range(50)]
+        hot_key = keys[0]
+        cold_key = [
+            k for k in keys
+            if (routing.hash_key(k) < middle) !=
+            (routing.hash_key(hot_key) < middle)
+        ][0]
+
+        limiter.delay([(hot_key, 10)] * 20)
+        assert_equal(limiter.delay([(cold_key, 10)]), 0.0)
+        assert_gt(limiter.delay([(hot_key, 10)]), 0.0)
+
+    def test_refresh(self):
+        s = FakeStream([generate_shard('shardId-1', 0, MAX_HASH_KEY)])
+        limiter = routing.ShardRateLimiter(s, refresh_secs=60.0)
+
+        limiter.delay([('a', 10)])
+        limiter.delay([('a', 10)])
+        assert_equal(s.refreshes, 0)
+
+        limiter._shard_map._shard_map_time -= 61.0
+        limiter.delay([('a', 10)])
+        assert_equal(s.refreshes, 1)
+
+    def test_refresh_retried(self):
+        s = FakeStream([generate_shard('shardId-1', 0, MAX_HASH_KEY)])
+        shard_map = routing.RefreshingShardMap(s, refresh_secs=60.0)
+        shard_map.get()
+
+        s.shards = [generate_shard('shardId-2', 0, MAX_HASH_KEY)]
+        s.refresh_errors = [LimitExceededException(400, 'Bad Request')]
+        shard_map._shard_map_time -= 61.0
+        with mock.patch('time.sleep'):
+            assert_equal(shard_map.get().shard_id('a'), 'shardId-2')
+        assert_equal(s.refreshes, 2)
+
+    def test_refresh_fails(self):
+        s = FakeStream([generate_shard('shardId-1', 0, MAX_HASH_KEY)])
+        shard_map = routing.RefreshingShardMap(s, refresh_secs=60.0)
+        shard_map.get()
+
+        s.refresh_errors = [BotoServerError(400, 'Bad Request')]
+        shard_map._shard_map_time -= 61.0
+
+        # The old map is kept, and not reloaded again until the next refresh
+        assert_equal(shard_map.get().shard_id('a'), 'shardId-1')
+        assert_equal(shard_map.get().shard_id('a'), 'shardId-1')
+        assert_equal(s.refreshes, 1)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+from testify import *
+import os
+import shutil
+import tempfile
+
+from triton import spool
+
+
+class SpoolTest(TestCase):
+
+    @setup
+    def build_dir(self):
+        self.path = tempfile.mkdtemp()
+
+    @teardown
+    def remove_dir(self):
+        shutil.rmtree(self.path)
+
+    def segment_files(self):
+        return sorted(os.listdir(self.path))
+
+    def test_read_entries(self):
+        first = spool.pack_entry('a', 'key', b'data')
+        buf = (first + spool.pack_entry('b', 'key 2', b'\x00\xff') +
+               b'\x00' * 16)
+        assert_equal(list(spool.read_entries(buf)),
+                     [(0, 'a', 'key', b'data'),
+                      (len(first), 'b', 'key 2', b'\x00\xff')])
+
+    def test_read_entries_torn(self):
+        entry = spool.pack_entry('a', 'key', b'data')
+        assert_equal(list(spool.read_entries(entry + entry[:-1])),
+                     [(0, 'a', 'key', b'data')])
+
+        corrupt = entry[:-1] + b'X'
+        assert_equal(list(spool.read_entries(entry + corrupt + entry)),
+                     [(0, 'a', 'key', b'data')])
+
+    def test_written_deleted(self):
+        s = spool.Spool(self.path, segment_size=64)
+        entry_ids = [s.append('a', 'key', b'x' * 20) for _ in range(4)]
+        segment_ids = set(segment_id for segment_id, _ in entry_ids)
+        assert_gt(len(segment_ids), 1)
+        assert_equal(len(self.segment_files()), len(segment_ids))
+
+        s.done(entry_ids)
+        s.close()
+        assert_equal(self.segment_files(), [])
+
+    def test_replay_after_restart(self):
+        s = spool.Spool(self.path)
+        one_id = s.append('a', 'key', b'one')
+        two_id = s.append('b', 'key', b'two')
+        s.done([one_id, two_id])
+        s.append('a', 'key', b'three')
+        s.sync()
+
+        # As if we'd crashed without closing. Everything is replayed, as we
+        # can't know what was written.
+        s = spool.Spool(self.path)
+        records = s.replay()
+        assert_equal([r[1:] for r in records],
+                     [('a', 'key', b'one'), ('b', 'key', b'two'),
+                      ('a', 'key', b'three')])
+        assert_equal(s.replay(), [])
+
+        s.done([entry_id for entry_id, _, _, _ in records])
+        s.close()
+        assert_equal(self.segment_files(), [])
+
+    def test_failed_replayed(self):
+        s = spool.Spool(self.path, segment_size=64, replay_delay_secs=0.0)
+        x_id = s.append('a', 'key', b'x' * 20)
+        y_id = s.append('a', 'key', b'y' * 20)
+        z_id = s.append('a', 'key', b'z' * 20)
+
+        # One segment at a time
+        s.done([x_id, y_id], ok=False)
+        assert_equal(s.replay(), [(x_id, 'a', 'key', b'x' * 20)])
+        assert_equal(s.replay(), [(y_id, 'a', 'key', b'y' * 20)])
+        assert_equal(s.replay(), [])
+
+        s.done([x_id, y_id, z_id], ok=True)
+        s.close()
+        assert_equal(len(self.segment_files()), 0)
+
+    def test_only_failed_replayed(self):
+        s = spool.Spool(self.path, replay_delay_secs=0.0,
+                        segment_roll_secs=0.0)
+        x_id = s.append('a', 'key', b'x')
+        y_id = s.append('a', 'key', b'y')
+        z_id = s.append('a', 'key', b'z')
+
+        # Records that were written aren't written again
+        s.done([x_id, z_id])
+        s.done([y_id], ok=False)
+        assert_equal(s.replay(), [(y_id, 'a', 'key', b'y')])
+
+        s.done([y_id])
+        s.close()
+        assert_equal(self.segment_files(), [])
+
+    def test_replay_delay(self):
+        s = spool.Spool(self.path, segment_size=64, replay_delay_secs=60.0)
+        x_id = s.append('a', 'key', b'x' * 40)
+        y_id = s.append('a', 'key', b'y' * 40)
+
+        s.done([x_id, y_id], ok=False)
+        assert_equal(s.replay(), [])
+
+    def test_failed_active_replayed(self):
+        s = spool.Spool(self.path, replay_delay_secs=0.0,
+                        segment_roll_secs=0.0)
+        x_id = s.append('a', 'key', b'x')
+
+        s.done([x_id], ok=False)
+        assert_equal(s.replay(), [(x_id, 'a', 'key', b'x')])
+
+        # Later records go to a new segment
+        y_id = s.append('a', 'key', b'y')
+        assert_not_equal(y_id[0], x_id[0])
+
+        s.done([x_id, y_id])
+        s.close()
+        assert_equal(self.segment_files(), [])
+
+    def test_failed_active_stays_open(self):
+        s = spool.Spool(self.path, replay_delay_secs=0.0,
+                        segment_roll_secs=60.0)
+        x_id = s.append('a', 'key', b'x')
+
+        # Each failed flush doesn't start a new segment, and the failure is
+        # replayed once the segment is closed
+        for _ in range(3):
+            s.done([x_id], ok=False)
+            y_id = s.append('a', 'key', b'y')
+            assert_equal(y_id[0], x_id[0])
+            s.done([y_id])
+        assert_equal(s.replay(), [])
+        assert_equal(len(self.segment_files()), 1)
+
+        s.segment_roll_secs = 0.0
+        assert_equal(s.replay(), [(x_id, 'a', 'key', b'x')])
+
+    def test_given_up(self):
+        s = spool.Spool(self.path, replay_delay_secs=0.0,
+                        segment_roll_secs=0.0, max_attempts=3)
+        x_id = s.append('a', 'key', b'x')
+
+        assert_equal(s.done([x_id], ok=False), [])
+        for _ in range(2):
+            assert_equal(s.replay(), [(x_id, 'a', 'key', b'x')])
+            given_up = s.done([x_id], ok=False)
+
+        # Not replayed again, and its segment is removed
+        assert_equal(given_up, [x_id])
+        assert_equal(s.replay(), [])
+        assert_equal(self.segment_files(), [])
+
+    def test_replay_when_due(self):
+        s = spool.Spool(self.path, segment_size=64, replay_delay_secs=60.0)
+        x_id = s.append('a', 'key', b'x' * 40)
+        y_id = s.append('a', 'key', b'y' * 40)
+        s.done([x_id], ok=False)
+
+        s.replay_delay_secs = 0.0
+        s.append('a', 'key', b'z' * 40)
+        s.done([y_id], ok=False)
+
+        # x was queued first, but only y is due
+        assert_equal(s.replay(), [(y_id, 'a', 'key', b'y' * 40)])
+        assert_equal(s.replay(), [])
@@ -7,13 +7,18 @@ import time
 import datetime
 import decimal
 import random
+import threading
 
 import msgpack
 
+from triton import aggregation
 from triton import stream
 from triton import errors
+from triton import encoding
+from triton import routing
 from triton.encoding import ascii_to_unicode_str
 from boto.exception import BotoServerError
+from boto.kinesis.exceptions import ProvisionedThroughputExceededException
 
 
 def generate_raw_record(n=1):
@@ -37,6 +42,16 @@ def generate_escaped_unicode_raw_record(n=42):
 
     return raw_record
 
+def generate_shard(shard_id, start, end):
+    return {
+        'ShardId': shard_id,
+        'HashKeyRange': {
+            'StartingHashKey': str(start),
+            'EndingHashKey': str(end),
+        },
+        'SequenceNumberRange': {'StartingSequenceNumber': '1'},
+    }
+
 def generate_record(n=1):
     return stream.Record.from_raw_record(0, generate_raw_record(n))
 
@@ -112,6 +127,47 @@ class RecordTest(TestCase):
         #NOTE: escaped unicode comes out the other side as unicode
         assert_equal(eur.data[u'test_üñîçø∂é_ké¥_宇宙'], u'test_üñîçø∂é_√ål_宇宙')
 
+    def test_lazy_decode(self):
+        raw_record = {'SequenceNumber': 1, 'Data': 'not base64 or msgpack!'}
+
+        r = stream.Record.from_raw_record(0, raw_record)
+        assert_equal(r.seq_num, 1)
+        assert_raises(Exception, getattr, r, 'data')
+
+    def test_raw_data(self):
+        raw_record = generate_raw_record()
+
+        r = stream.Record.from_raw_record(0, raw_record)
+        assert_equal(r.raw_data, msgpack.packb({'value': True}))
+        assert_equal(r.data, {'value': True})
+
+    def test_compressed(self):
+        data = {'value': 'x' * 1000}
+        packed = msgpack.packb(data)
+
+        for compression in ('zlib', 'snappy'):
+            compressed = encoding.compress_payload(packed, compression)
+            assert_lt(len(compressed), len(packed))
+
+            raw_record = {
+                'SequenceNumber': 1,
+                'Data': base64.b64encode(compressed)
+            }
+            r = stream.Record.from_raw_record(0, raw_record)
+            assert_equal(r.raw_data, packed)
+            assert_equal(r.data, data)
+
+            assert_equal(
+                stream.Record._decode_record_data(raw_record['Data']), data)
+
+    def test_from_decoded_raw_record(self):
+        raw_record = {
+            'SequenceNumber': 1, 'Data': msgpack.packb({'value': True})}
+
+        r = stream.Record.from_raw_record(0, raw_record, b64_encoded=False)
+        assert_equal(r.data['value'], True)
+
+
 class StreamIteratorTest(TestCase):
 
     def test_iter_value(self):
@@ -144,7 +200,7 @@ class StreamIteratorTest(TestCase):
         i.fill()
 
         assert_equal(i.iter_value, 2)
-        assert_equal(i.records, [])
+        assert_equal(list(i.records), [])
 
     def test_fill_records(self):
         raw_record = generate_raw_record()
@@ -170,6 +226,72 @@ class StreamIteratorTest(TestCase):
         assert_equal(len(i.records), 1)
         assert i.records[0].data['value'] is True
 
+    def test_fill_aggregated(self):
+        (aggregated, _), = aggregation.aggregate([
+            {'Data': msgpack.packb({'value': n}), 'PartitionKey': 'a'}
+            for n in range(3)
+        ])
+        raw_record = {
+            'SequenceNumber': 7,
+            'Data': base64.b64encode(aggregated['Data'])
+        }
+        s = turtle.Turtle()
+
+        def get_records(*args, **kwargs):
+            return {
+                'NextShardIterator': 2,
+                'MillisBehindLatest': 0,
+                'Records': [raw_record, generate_raw_record(8)]
+            }
+
+        s.conn.get_records = get_records
+
+        i = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST)
+        i._iter_value = 1
+        i.fill()
+
+        assert_equal(
+            [(r.seq_num, r.sub_seq_num) for r in i.records],
+            [(7, 0), (7, 1), (7, 2), (8, None)])
+        assert_equal([r.data['value'] for r in i.records], [0, 1, 2, True])
+
+    def test_schedule_next_poll(self):
+        s = turtle.Turtle()
+        i = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST)
+
+        i.behind_latest_secs = 30.0
+        i._schedule_next_poll(100.0, 10)
+        assert_equal(i.next_poll_time,
+                     100.0 + stream.BEHIND_POLL_INTERVAL_SECS)
+
+        i.behind_latest_secs = 0.0
+        i._schedule_next_poll(100.0, 10)
+        assert_equal(i.next_poll_time, 100.0 + stream.MIN_POLL_INTERVAL_SECS)
+
+        intervals = []
+        for _ in range(5):
+            i._schedule_next_poll(100.0, 0)
+            intervals.append(i.poll_interval_secs)
+        assert_equal(intervals, [2.0, 4.0, 4.0, 4.0, 4.0])
+
+    def test_schedule_next_poll_throttled(self):
+        s = turtle.Turtle()
+        s.conn.get_records = mock.Mock(
+            side_effect=ProvisionedThroughputExceededException(
+                400, 'Bad Request'))
+        i = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST)
+        i._iter_value = 'iter'
+        i.prefetch = False
+
+        # Even a shard that's behind backs off once it's throttled
+        i.behind_latest_secs = 30.0
+        i.poll_interval_secs = stream.BEHIND_POLL_INTERVAL_SECS
+        intervals = []
+        for _ in range(5):
+            i.fill()
+            intervals.append(i.poll_interval_secs)
+        assert_equal(intervals, [1.0, 2.0, 4.0, 4.0, 4.0])
+
     def test_next_empty(self):
         s = turtle.Turtle()
         i = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST)
@@ -200,32 +322,155 @@ class StreamIteratorTest(TestCase):
         assert_equal(found_records, records)
         assert i._empty
 
+    def test_next_batch(self):
+        s = turtle.Turtle()
+
+        def get_records(*args, **kwargs):
+            return {
+                'NextShardIterator': 2,
+                'MillisBehindLatest': 0,
+                'Records': [generate_raw_record(1), generate_raw_record(2)]
+            }
+
+        s.conn.get_records = get_records
+
+        i = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST)
+        i._iter_value = 1
+
+        batch = i.next_batch()
+        assert_equal([r.seq_num for r in batch], [1, 2])
+        assert_equal(i.last_seq_num, 2)
+        assert i._empty
+
+    def test_prefetch(self):
+        s = turtle.Turtle()
+        iter_values = []
+
+        def get_records(iter_value, **kwargs):
+            iter_values.append(iter_value)
+            return {
+                'NextShardIterator': iter_value + 1,
+                'MillisBehindLatest': 1000,
+                'Records': [generate_raw_record(iter_value)]
+            }
+
+        s.conn.get_records = get_records
+
+        i = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST,
+                                  prefetch=True)
+        i._iter_value = 1
+        i.next_poll_time = 0.0
+
+        assert_equal([r.seq_num for r in i.next_batch()], [1])
+
+        # The next page was requested without waiting for us to ask
+        assert i._prefetched.wait(1.0)
+        assert_equal(iter_values, [1, 2])
+
+        assert_equal([r.seq_num for r in i.next_batch()], [2])
+        assert_equal(i._iter_value, 3)
+
+        # Every page is fetched from the same thread
+        prefetch_thread = i._prefetcher._thread
+        assert i._prefetched.wait(1.0)
+        assert_equal([r.seq_num for r in i.next_batch()], [3])
+        assert_is(i._prefetcher._thread, prefetch_thread)
+
+    def test_prefetch_thread_idle(self):
+        s = turtle.Turtle()
+        s.conn.get_records = lambda iter_value, **kwargs: {
+            'NextShardIterator': iter_value + 1,
+            'MillisBehindLatest': 0,
+            'Records': [],
+        }
+
+        i = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST,
+                                  prefetch=True)
+        prefetcher = stream._Prefetcher(i)
+
+        with mock.patch.object(stream, 'PREFETCH_THREAD_IDLE_SECS', 0.01):
+            assert prefetcher.fetch(1, 0.0).wait(1.0)
+            thread = prefetcher._thread
+            thread.join(1.0)
+            assert not thread.is_alive()
+            assert_is(prefetcher._thread, None)
+
+            # Started again when needed
+            assert prefetcher.fetch(2, 0.0).wait(1.0)
+
+    def test_prefetch_error(self):
+        s = turtle.Turtle()
+        calls = []
+
+        def get_records(iter_value, **kwargs):
+            calls.append(iter_value)
+            if len(calls) > 1:
+                raise ValueError(iter_value)
+            return {
+                'NextShardIterator': 2,
+                'MillisBehindLatest': 0,
+                'Records': [generate_raw_record(1)]
+            }
+
+        s.conn.get_records = get_records
+
+        i = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST,
+                                  prefetch=True)
+        i._iter_value = 1
+        i.next_poll_time = 0.0
+        i.next_batch()
+
+        # Errors from the prefetch come out of the next fill
+        with assert_raises(ValueError):
+            i.next_batch()
+
 
 class CombinedStreamIteratorTest(TestCase):
 
     def test_first_no_wait(self):
-        c = stream.CombinedStreamIterator([])
+        s = turtle.Turtle()
+        i = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST)
+        c = stream.CombinedStreamIterator([i])
 
         start_t = time.time()
-        c._wait()
+        c._wait(i)
         duration_s = time.time() - start_t
         assert_lt(duration_s, 0.1)
 
     def test_next_wait(self):
-        c = stream.CombinedStreamIterator([])
-        c._last_wait = time.time()
+        s = turtle.Turtle()
+        i = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST)
+        i.next_poll_time = time.time() + 0.2
+        c = stream.CombinedStreamIterator([i])
 
         start_t = time.time()
-        c._wait()
+        c._wait(i)
         duration_s = time.time() - start_t
         assert_gt(duration_s, 0.1)
 
+    def test_fill_most_due(self):
+        s = turtle.Turtle()
+        s.name = 'test stream'
+        now = time.time()
+
+        i1 = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST)
+        i1.next_poll_time = now + 1.0
+        i2 = stream.StreamIterator(s, 1, stream.ITER_TYPE_LATEST)
+        i2.next_poll_time = now - 1.0
+        i2.records.append(generate_record())
+        i2._empty = False
+
+        c = stream.CombinedStreamIterator([i1, i2])
+        c._fill()
+
+        assert c.last_iterator is i2
+
     def test_single(self):
         s = turtle.Turtle()
         s.name = 'test stream'
         i = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST)
         r = generate_record()
-        i.records = [r, ]
+        i.records.append(r)
         i._empty = False
 
         c = stream.CombinedStreamIterator([i])
@@ -242,11 +487,11 @@ class CombinedStreamIteratorTest(TestCase):
         sent_records = [generate_record(1), generate_record(2)]
 
         i1 = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST)
-        i1.records = [sent_records[0], ]
+        i1.records.append(sent_records[0])
         i1._empty = False
 
         i2 = stream.StreamIterator(s, 1, stream.ITER_TYPE_LATEST)
-        i2.records = [sent_records[1], ]
+        i2.records.append(sent_records[1])
         i2._empty = False
 
         c = stream.CombinedStreamIterator([i1, i2])
@@ -260,6 +505,411 @@ class CombinedStreamIteratorTest(TestCase):
 
         assert_equal(set(records), set(sent_records))
 
+    def test_iter_batches(self):
+        s = turtle.Turtle()
+        s.name = 'test stream'
+
+        i1 = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST)
+        i1.records.extend([generate_record(1), generate_record(2)])
+        i1._empty = False
+
+        i2 = stream.StreamIterator(s, 1, stream.ITER_TYPE_LATEST)
+        i2.records.append(generate_record(3))
+        i2._empty = False
+
+        c = stream.CombinedStreamIterator([i1, i2])
+        c._fill()
+        c._fill()
+        c._running = False
+
+        batches = list(c.iter_batches())
+
+        assert_equal(len(batches), 1)
+        assert_equal(set(r.seq_num for r in batches[0]), set([1, 2, 3]))
+        assert_equal(c.last_seq_num, batches[0][-1].seq_num)
+
+    def test_checkpoint_mid_aggregate(self):
+        (aggregated, _), = aggregation.aggregate([
+            {'Data': msgpack.packb({'value': n}), 'PartitionKey': 'a'}
+            for n in range(3)
+        ])
+        raw_records = [
+            generate_raw_record(1),
+            {'SequenceNumber': 2,
+             'Data': base64.b64encode(aggregated['Data'])},
+        ]
+
+        c = turtle.Turtle()
+        s = stream.Stream(c, 'test stream', 'value')
+        s._shards = [{'ShardId': '0001'}]
+
+        def get_shard_iterator(name, shard_id, iterator_type, seq_num):
+            if iterator_type == stream.ITER_TYPE_FROM_SEQNUM:
+                return {'ShardIterator': seq_num}
+            return {'ShardIterator': 0}
+
+        def get_records(iter_value, **kwargs):
+            return {
+                'NextShardIterator': 'done',
+                'MillisBehindLatest': 0,
+                'Records': [r for r in raw_records
+                            if r['SequenceNumber'] > iter_value],
+            }
+
+        c.get_shard_iterator = get_shard_iterator
+        c.get_records = get_records
+
+        checkpoints = {}
+
+        class FakeCheckpointer(object):
+            def __init__(self, stream_name):
+                pass
+
+            def checkpoint(self, shard_id, seq_num):
+                checkpoints[shard_id] = seq_num
+
+            def last_sequence_number(self, shard_id):
+                return checkpoints.get(shard_id)
+
+        with mock.patch.object(stream, 'TritonCheckpointer', FakeCheckpointer):
+            i = s.build_iterator_for_all()
+            assert_equal(i.next().data['value'], True)
+            assert_equal(i.next().sub_seq_num, 0)
+
+            # Checkpointing the aggregate would skip the rest of it
+            i.checkpoint()
+            assert_equal(checkpoints, {'0001': 1})
+
+            i = s.build_iterator_from_checkpoint()
+            records = [i.next() for _ in range(3)]
+            assert_equal([r.data['value'] for r in records], [0, 1, 2])
+
+            i.checkpoint()
+            assert_equal(checkpoints, {'0001': 2})
+
+
+class ReshardTest(TestCase):
+    """Iterators follow a shard into its children once it's drained"""
+
+    def build_stream(self):
+        c = turtle.Turtle()
+        s = stream.Stream(c, 'test stream', 'value')
+        # 0001 was split into 0002 and 0003, which were merged into 0004
+        s._shards = [
+            {'ShardId': '0001'},
+            {'ShardId': '0002', 'ParentShardId': '0001'},
+            {'ShardId': '0003', 'ParentShardId': '0001'},
+            {'ShardId': '0004', 'ParentShardId': '0002',
+             'AdjacentParentShardId': '0003'},
+        ]
+        s.refresh_shards = lambda: None
+
+        def get_shard_iterator(name, shard_id, *args):
+            return {'ShardIterator': shard_id}
+
+        def get_records(iter_value, **kwargs):
+            # Every shard has one record, and only 0004 is still open
+            if iter_value.endswith('-next'):
+                return {
+                    'NextShardIterator': iter_value,
+                    'MillisBehindLatest': 0,
+                    'Records': []
+                }
+            return {
+                'NextShardIterator': (iter_value + '-next'
+                                      if iter_value == '0004' else None),
+                'MillisBehindLatest': 0,
+                'Records': [generate_raw_record(iter_value)]
+            }
+
+        c.get_shard_iterator = get_shard_iterator
+        c.get_records = get_records
+        return s
+
+    def test_combined(self):
+        s = self.build_stream()
+        i = s.build_iterator_for_all()
+        assert_equal([it.shard_id for it in i.iterators], ['0001'])
+
+        records = [i.next() for _ in range(4)]
+        i.stop()
+
+        assert_equal(records[0].seq_num, '0001')
+        assert_equal(set(r.seq_num for r in records[1:3]),
+                     set(['0002', '0003']))
+        assert_equal(records[3].seq_num, '0004')
+        assert_equal([it.shard_id for it in i.iterators], ['0004'])
+        assert_equal(len(i._retired_iterators), 3)
+
+    def test_parallel(self):
+        s = self.build_stream()
+        i = s.build_iterator_for_all(parallel=True)
+
+        records = [i.next() for _ in range(4)]
+        i.stop()
+
+        assert_equal([r.seq_num for r in records][0], '0001')
+        assert_equal(records[3].seq_num, '0004')
+
+    def test_parallel_starts_children_once(self):
+        # Workers retiring shards race with the consumer starting workers
+        for _ in range(100):
+            s = self.build_stream()
+            i = s.build_iterator_for_all(parallel=True)
+
+            records = [i.next() for _ in range(4)]
+            i.stop()
+
+            assert_equal(sorted(r.seq_num for r in records),
+                         ['0001', '0002', '0003', '0004'])
+            assert_equal(sorted(t.name for t in i._threads),
+                         ['triton-0001', 'triton-0002', 'triton-0003',
+                          'triton-0004'])
+            assert_equal(i._worker_exc_info, None)
+
+    def test_merge_checkpoint_between_parents(self):
+        c = turtle.Turtle()
+        s = stream.Stream(c, 'test stream', 'value')
+        # 0001 and 0002 were merged into 0003
+        s._shards = [
+            {'ShardId': '0001'},
+            {'ShardId': '0002'},
+            {'ShardId': '0003', 'ParentShardId': '0001',
+             'AdjacentParentShardId': '0002'},
+        ]
+        s.refresh_shards = lambda: None
+
+        def get_shard_iterator(name, shard_id, *args):
+            return {'ShardIterator': shard_id}
+
+        def get_records(iter_value, **kwargs):
+            # 0002 has two pages, so 0001 is drained first
+            next_iter = {'0002': '0002-2', '0003': '0003'}.get(iter_value)
+            return {
+                'NextShardIterator': next_iter,
+                'MillisBehindLatest': 0,
+                'Records': [generate_raw_record(iter_value)]
+            }
+
+        c.get_shard_iterator = get_shard_iterator
+        c.get_records = get_records
+
+        i = s.build_iterator_for_all()
+        seq_nums = []
+        with mock.patch.object(stream, 'TritonCheckpointer'), \
+                mock.patch.object(stream, 'MIN_POLL_INTERVAL_SECS', 0.0):
+            for _ in range(4):
+                seq_nums.append(i.next().seq_num)
+                i.checkpoint()
+
+        assert_equal(seq_nums, ['0001', '0002', '0002-2', '0003'])
+
+    def test_all_shards_ended(self):
+        s = self.build_stream()
+        s._shards = [{'ShardId': '0001'}]
+
+        i = s.build_iterator_for_all()
+        assert_equal([r.seq_num for r in i], ['0001'])
+
+    def test_latest_skips_closed(self):
+        s = self.build_stream()
+        for shard in s._shards[:3]:
+            shard['SequenceNumberRange'] = {
+                'StartingSequenceNumber': '1',
+                'EndingSequenceNumber': '2',
+            }
+
+        i = s.build_iterator_from_latest()
+        assert_equal([(it.shard_id, it.iterator_type) for it in i.iterators],
+                     [('0004', stream.ITER_TYPE_LATEST)])
+
+        # Whatever is selected, it's the open descendants that are read
+        i = s.build_iterator_from_latest(shard_nums=[1])
+        assert_equal([it.shard_id for it in i.iterators], ['0004'])
+
+
+class PrefetchBudgetTest(TestCase):
+
+    def test_unlimited(self):
+        b = stream.PrefetchBudget()
+        b.add([generate_record()] * 100)
+
+        assert_equal(b.page_limit(), None)
+        assert b.wait(0)
+
+    def test_records(self):
+        b = stream.PrefetchBudget(max_records=10)
+        assert_equal(b.page_limit(), 10)
+
+        records = [generate_record()] * 10
+        b.add(records)
+        assert not b.wait(0)
+
+        b.release(records[:4])
+        assert b.wait(0)
+        assert_equal(b.page_limit(), 4)
+
+    def test_bytes(self):
+        record = generate_record()
+        b = stream.PrefetchBudget(max_bytes=record.size * 10)
+
+        # Nothing seen yet, so no idea how many records would fit
+        assert_equal(b.page_limit(), None)
+
+        b.add([record] * 4)
+        assert_equal(b.page_limit(), 6)
+
+        b.add([record] * 6)
+        assert not b.wait(0)
+        assert_equal(b.page_limit(), 1)
+
+    def test_pending(self):
+        b = stream.PrefetchBudget(max_records=10)
+        records = [generate_record()] * 4
+        b.add(records)
+
+        # Records a caller holds but hasn't added count against the room
+        assert_equal(b.page_limit(pending_records=4), 2)
+        assert b.has_room(pending_records=5)
+        assert not b.has_room(pending_records=6)
+
+
+class ParallelCombinedStreamIteratorTest(TestCase):
+
+    def test_multiple(self):
+        s = turtle.Turtle()
+        s.name = 'test stream'
+
+        def get_records(iter_value, **kwargs):
+            # Each shard has a single page of records, then goes quiet.
+            if iter_value in (1, 2):
+                records = [generate_raw_record(iter_value * 10 + n)
+                           for n in range(3)]
+            else:
+                records = []
+            return {
+                'NextShardIterator': 'done',
+                'MillisBehindLatest': 0,
+                'Records': records
+            }
+
+        s.conn.get_records = get_records
+
+        i1 = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST)
+        i1._iter_value = 1
+        i2 = stream.StreamIterator(s, 1, stream.ITER_TYPE_LATEST)
+        i2._iter_value = 2
+
+        c = stream.ParallelCombinedStreamIterator([i1, i2])
+
+        records = [c.next() for _ in range(6)]
+        c.stop()
+        assert_equal(list(c), [])
+
+        assert_equal(set(r.seq_num for r in records),
+                     set([10, 11, 12, 20, 21, 22]))
+        assert_equal(c._delivered_seq_nums, {i1: 12, i2: 22})
+
+    def test_next_batch(self):
+        s = turtle.Turtle()
+        s.name = 'test stream'
+
+        def get_records(iter_value, **kwargs):
+            return {
+                'NextShardIterator': 'done',
+                'MillisBehindLatest': 0,
+                'Records': ([generate_raw_record(n) for n in range(3)]
+                            if iter_value == 1 else [])
+            }
+
+        s.conn.get_records = get_records
+
+        i = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST)
+        i._iter_value = 1
+
+        c = stream.ParallelCombinedStreamIterator([i])
+
+        records = []
+        while len(records) < 3:
+            records += c.next_batch()
+        c.stop()
+
+        assert_equal([r.seq_num for r in records], [0, 1, 2])
+        assert_equal(c._delivered_seq_nums, {i: 2})
+
+    def test_budget(self):
+        s = turtle.Turtle()
+        s.name = 'test stream'
+        limits = []
+
+        def get_records(iter_value, limit=None, **kwargs):
+            limits.append(limit)
+            return {
+                'NextShardIterator': 1,
+                'MillisBehindLatest': 1000,
+                'Records': [generate_raw_record(n) for n in range(limit)]
+            }
+
+        s.conn.get_records = get_records
+
+        i = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST)
+        i._iter_value = 1
+
+        c = stream.ParallelCombinedStreamIterator(
+            [i], max_buffered_records=5)
+        c.next()
+        time.sleep(0.5)
+
+        # The worker filled the budget and then stopped fetching
+        assert_equal(limits, [5, 1])
+        assert_equal(c.budget.records, 5)
+        c.stop()
+
+    def test_budget_prefetch(self):
+        s = turtle.Turtle()
+        s.name = 'test stream'
+        limits = []
+
+        def get_records(iter_value, limit=None, **kwargs):
+            limits.append(limit)
+            return {
+                'NextShardIterator': 1,
+                'MillisBehindLatest': 1000,
+                'Records': [generate_raw_record(n) for n in range(limit)]
+            }
+
+        s.conn.get_records = get_records
+
+        i = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST,
+                                  prefetch=True)
+        i._iter_value = 1
+
+        c = stream.ParallelCombinedStreamIterator(
+            [i], max_buffered_records=5)
+        c.next()
+        time.sleep(0.5)
+
+        # Prefetching doesn't get around the budget
+        assert_equal(limits, [5, 1])
+        assert_equal(c.budget.records, 5)
+        c.stop()
+
+    def test_worker_error(self):
+        s = turtle.Turtle()
+        s.name = 'test stream'
+
+        def get_records(iter_value, **kwargs):
+            raise ValueError(iter_value)
+
+        s.conn.get_records = get_records
+
+        i = stream.StreamIterator(s, 0, stream.ITER_TYPE_LATEST)
+        i._iter_value = 1
+
+        c = stream.ParallelCombinedStreamIterator([i])
+        with assert_raises(ValueError):
+            c.next()
+
 
 class StreamTest(TestCase):
 
@@ -340,7 +990,8 @@ class StreamTest(TestCase):
     def test_select_shard_ids(self):
         c = turtle.Turtle()
         s = stream.Stream(c, 'test stream', 'value')
-        s._shard_ids = ['0001', '0002', '0003']
+        s._shards = [
+            {'ShardId': '0001'}, {'ShardId': '0002'}, {'ShardId': '0003'}]
 
         shard_ids = s._select_shard_ids([0, 2])
         assert_equal(shard_ids, ['0001', '0003'])
@@ -348,7 +999,8 @@ class StreamTest(TestCase):
     def test_select_shard_ids_empty(self):
         c = turtle.Turtle()
         s = stream.Stream(c, 'test stream', 'value')
-        s._shard_ids = ['0001', '0002', '0003']
+        s._shards = [
+            {'ShardId': '0001'}, {'ShardId': '0002'}, {'ShardId': '0003'}]
 
         shard_ids = s._select_shard_ids([])
         assert_equal(shard_ids, ['0001', '0002', '0003'])
@@ -356,11 +1008,62 @@ class StreamTest(TestCase):
     def test_select_shard_ids_missing(self):
         c = turtle.Turtle()
         s = stream.Stream(c, 'test stream', 'value')
-        s._shard_ids = ['0001', '0002', '0003']
+        s._shards = [
+            {'ShardId': '0001'}, {'ShardId': '0002'}, {'ShardId': '0003'}]
 
         with assert_raises(errors.ShardNotFoundError):
             shard_ids = s._select_shard_ids([4])
 
+    def test_select_shard_ids_skips_children(self):
+        c = turtle.Turtle()
+        s = stream.Stream(c, 'test stream', 'value')
+        s._shards = [
+            {'ShardId': '0001'},
+            {'ShardId': '0002', 'ParentShardId': '0001'},
+            {'ShardId': '0003', 'ParentShardId': '0001'},
+        ]
+
+        assert_equal(s._select_shard_ids([]), ['0001'])
+        assert_equal(s._select_shard_ids([1, 2]), ['0002', '0003'])
+
+    def test_select_shard_ids_by_id(self):
+        c = turtle.Turtle()
+        s = stream.Stream(c, 'test stream', 'value')
+        # 0001 was split into 0003 and 0004, then aged out
+        s._shards = [
+            {'ShardId': '0002'},
+            {'ShardId': '0003', 'ParentShardId': '0001'},
+            {'ShardId': '0004', 'ParentShardId': '0001'},
+        ]
+
+        assert_equal(s._select_shard_ids(None, shard_ids=['0002']), ['0002'])
+        assert_equal(s._select_shard_ids(None, shard_ids=['0001']),
+                     ['0003', '0004'])
+
+    def test_shards_paginated(self):
+        c = turtle.Turtle()
+        calls = []
+
+        def describe_stream(name, exclusive_start_shard_id=None):
+            calls.append(exclusive_start_shard_id)
+            if exclusive_start_shard_id is None:
+                return {'StreamDescription': {
+                    'HasMoreShards': True,
+                    'Shards': [{'ShardId': '0001'}, {'ShardId': '0002'}]
+                }}
+            return {'StreamDescription': {
+                'HasMoreShards': False,
+                'Shards': [{'ShardId': '0003', 'ParentShardId': '0001'}]
+            }}
+
+        c.describe_stream = describe_stream
+        s = stream.Stream(c, 'test stream', 'value')
+
+        assert_equal(s.shard_ids, ['0001', '0002', '0003'])
+        assert_equal(calls, [None, '0002'])
+        assert_equal(s.child_shard_ids('0001'), ['0003'])
+        assert_equal(s.parent_shard_ids('0003'), ('0001', None))
+
     def test_put(self):
         c = turtle.Turtle()
 
@@ -530,6 +1233,234 @@ class StreamTest(TestCase):
             resp = s.put_many([dict(value=0)] * test_count)
             assert_equal(len(resp), test_count)
 
+    def test_put_compressed(self):
+        c = turtle.Turtle()
+        sent = []
+
+        def put_record(*args):
+            sent.append(args[1])
+            return {'ShardId': '0001', 'SequenceNumber': 1}
+
+        c.put_record = put_record
+        s = stream.Stream(c, 'test stream', 'value', compression='zlib')
+        s.put(value='a', big='x' * 1000)
+        s.put(value='a')
+
+        # Only compressed when it helps
+        assert sent[0].startswith(encoding.COMPRESSED_HEADER)
+        assert_equal(sent[1], msgpack.packb({'value': 'a'}))
+
+    def test_unknown_compression(self):
+        assert_raises(
+            errors.InvalidConfigurationError, stream.Stream,
+            turtle.Turtle(), 'test stream', 'value', compression='lzma')
+
+    def test_put_group_commit(self):
+        c = turtle.Turtle()
+        calls = []
+
+        def put_records(records, stream_name, **kwargs):
+            calls.append(len(records))
+            time.sleep(0.05)
+            return {'Records': [
+                {'ShardId': '0001', 'SequenceNumber': r['Data']}
+                for r in records
+            ]}
+
+        c.put_records = put_records
+        s = stream.Stream(c, 'test stream', 'value', group_commit=True)
+        results = {}
+
+        def put(n):
+            results[n] = s.put(value='a', n=n)
+
+        threads = [threading.Thread(target=put, args=(n,)) for n in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert_lt(len(calls), 20)
+        assert_equal(sum(calls), 20)
+        for n, (shard_id, seq_num) in results.items():
+            assert_equal(msgpack.unpackb(seq_num)[b'n'], n)
+
+    def test_put_group_commit_error(self):
+        c = turtle.Turtle()
+
+        def put_records(records, stream_name, **kwargs):
+            raise BotoServerError(400, "test", "test")
+
+        c.put_records = put_records
+        s = stream.Stream(c, 'test stream', 'value', group_commit=True)
+        assert_raises(BotoServerError, s.put, value='a')
+
+    def test_put_group_commit_failed_records(self):
+        c = turtle.Turtle()
+
+        def put_records(records, stream_name, **kwargs):
+            # 1 and 3 fail, 5 is throttled
+            results = []
+            for r in records:
+                n = msgpack.unpackb(r['Data'])[b'n']
+                if n == 5:
+                    results.append({
+                        'ErrorCode': 'ProvisionedThroughputExceededException',
+                        'ErrorMessage': 'Rate exceeded'})
+                elif n % 2:
+                    results.append({'ErrorCode': 'InternalFailure',
+                                    'ErrorMessage': 'Internal service failure'})
+                else:
+                    results.append({'ShardId': '0001', 'SequenceNumber': 1})
+            return {'Records': results}
+
+        c.put_records = put_records
+        s = stream.Stream(c, 'test stream', 'value', group_commit=True,
+                          group_commit_window_secs=0.05)
+        s.retry_policy.max_record_retries = 0
+        failures = {}
+
+        def put(n):
+            try:
+                s.put(value='a', n=n)
+            except BotoServerError as e:
+                failures[n] = e
+
+        threads = [threading.Thread(target=put, args=(n,)) for n in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # The same errors put_record would have raised
+        assert_equal(sorted(failures), [1, 3, 5])
+        for n in (1, 3):
+            assert_equal(failures[n].status, 500)
+            assert_equal(failures[n].error_code, 'InternalFailure')
+        assert isinstance(
+            failures[5], ProvisionedThroughputExceededException)
+        assert_equal(failures[5].status, 400)
+
+    def test_put_group_commit_unknown_error(self):
+        c = turtle.Turtle()
+        c.put_records = lambda records, stream_name, **kwargs: {
+            'Records': [{} for _ in records]}
+        s = stream.Stream(c, 'test stream', 'value', group_commit=True,
+                          group_commit_window_secs=0.0)
+        s.retry_policy.max_record_retries = 0
+
+        with assert_raises(errors.KinesisError):
+            s.put(value='a')
+
+    def test_get_stream_group_commit(self):
+        config = {'a': {
+            'name': 'a', 'partition_key': 'value', 'group_commit': True,
+            'group_commit_window_secs': 0.05,
+        }}
+        with mock.patch.object(stream, 'get_connection'):
+            s = stream.get_stream('a', config)
+
+        assert_equal(s._group_commit.window_secs, 0.05)
+
+    def test_put_many_chunks_by_size(self):
+        c = turtle.Turtle()
+        calls = []
+
+        def put_records(records, stream_name, **kwargs):
+            calls.append(len(records))
+            return {'Records': [
+                {'ShardId': '0001', 'SequenceNumber': n}
+                for n in range(len(records))
+            ]}
+
+        c.put_records = put_records
+        s = stream.Stream(c, 'test stream', 'value')
+
+        # Each record is just under 1MB, so 5 fit in a request
+        big = 'x' * (1024 * 1024 - 100)
+        resp = s.put_many([dict(value='a', big=big)] * 12)
+
+        assert_equal(len(resp), 12)
+        assert_equal(sorted(calls), [2, 5, 5])
+
+    def test_put_many_concurrent(self):
+        c = turtle.Turtle()
+        lock = threading.Lock()
+        in_flight = [0]
+        most_in_flight = [0]
+
+        def put_records(records, stream_name, **kwargs):
+            with lock:
+                in_flight[0] += 1
+                most_in_flight[0] = max(most_in_flight[0], in_flight[0])
+            time.sleep(0.1)
+            with lock:
+                in_flight[0] -= 1
+            return {'Records': [
+                {'ShardId': '0001', 'SequenceNumber': r['Data']}
+                for r in records
+            ]}
+
+        c.put_records = put_records
+        s = stream.Stream(c, 'test stream', 'value', put_concurrency=4)
+        records = [dict(value='a', n=n) for n in range(2000)]
+        resp = s.put_many(records)
+
+        assert_equal(most_in_flight[0], 4)
+        assert_equal([msgpack.unpackb(seq_num)[b'n'] for _, seq_num in resp],
+                     list(range(2000)))
+
+        # One call at a time unless asked for
+        most_in_flight[0] = 0
+        s = stream.Stream(c, 'test stream', 'value')
+        s.put_many(records)
+        assert_equal(most_in_flight[0], 1)
+
+    def test_put_pool_shared(self):
+        s = stream.Stream(turtle.Turtle(), 'test stream', 'value',
+                          put_concurrency=4)
+
+        def slow_pool(processes):
+            time.sleep(0.05)
+            return object()
+
+        with mock.patch.object(stream, 'ThreadPool',
+                               side_effect=slow_pool) as thread_pool:
+            threads = [threading.Thread(target=s._get_put_pool)
+                       for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        assert_equal(thread_pool.call_count, 1)
+
+    def test_put_many_oversized(self):
+        c = turtle.Turtle()
+        calls = []
+
+        def put_records(records, stream_name, **kwargs):
+            calls.append(len(records))
+            return {'Records': [
+                {'ShardId': '0001', 'SequenceNumber': n}
+                for n in range(len(records))
+            ]}
+
+        c.put_records = put_records
+        s = stream.Stream(c, 'test stream', 'value')
+
+        too_big = dict(value='a', big='x' * (1024 * 1024))
+        try:
+            s.put_many([dict(value='a'), too_big, dict(value='b')])
+        except errors.KinesisPutManyError as e:
+            assert_equal(len(e.failed_data), 1)
+            assert_equal(e.results, [('0001', 0), None, ('0001', 1)])
+        else:
+            raise Exception('Expected oversized record to fail')
+
+        # The rest went out in one request, with no retries
+        assert_equal(calls, [2])
+
     def test_build_iterator(self):
         c = turtle.Turtle()
 
@@ -608,6 +1539,14 @@ class StreamTest(TestCase):
         resp = s.put_many([dict(value=0)] * test_count)
         assert_equal(len(resp), test_count)
 
+        # Failed records are sent up to 4 times in all
+        put_records = PutRecords(fail_for_n_calls=3, initial_error_rate=1.)
+        c.put_records = put_records
+        s = stream.Stream(c, 'test stream', 'value')
+        resp = s.put_many([dict(value=0)] * 100)
+        assert_equal(len(resp), 100)
+        assert_equal(put_records.calls, 4)
+
         put_records = PutRecords(fail_for_n_calls=4, initial_error_rate=1.)
         c.put_records = put_records
         s = stream.Stream(c, 'test stream', 'value')
@@ -626,3 +1565,191 @@ class StreamTest(TestCase):
             assert_lt(len(e.failed_data), test_count)
         else:
             raise Exception('Expected failed records')
+
+    def test_put_many_aggregate(self):
+        c = turtle.Turtle()
+        sent = []
+
+        def put_records(records, stream_name, **kwargs):
+            sent.extend(records)
+            return {'Records': [
+                {'ShardId': '0001', 'SequenceNumber': n}
+                for n in range(len(records))
+            ]}
+
+        c.put_records = put_records
+        s = stream.Stream(c, 'test stream', 'value', aggregate=True)
+        s._shards = [generate_shard('0001', 0, 2 ** 128 - 1)]
+        resp = s.put_many([dict(value='a', n=n) for n in range(10)])
+
+        assert_equal(len(sent), 1)
+        assert_equal(resp, [('0001', 0)] * 10)
+        assert_equal(len(aggregation.deaggregate(sent[0]['Data'])), 10)
+
+    def test_put_many_aggregate_by_shard(self):
+        c = turtle.Turtle()
+        sent = []
+
+        def put_records(records, stream_name, **kwargs):
+            sent.extend(records)
+            return {'Records': [
+                {'ShardId': '0001', 'SequenceNumber': n}
+                for n in range(len(records))
+            ]}
+
+        c.put_records = put_records
+        s = stream.Stream(c, 'test stream', 'value', aggregate=True)
+        middle = 2 ** 127
+        s._shards = [
+            generate_shard('0001', 0, middle - 1),
+            generate_shard('0002', middle, 2 ** 128 - 1),
+        ]
+        keys = ['key %d' % n for n in range(10)]
+        resp = s.put_many([dict(value=key) for key in keys])
+
+        assert_equal(len(sent), 2)
+        sent_keys = []
+        for record in sent:
+            sub_records = aggregation.deaggregate(record['Data'])
+            if sub_records is None:
+                # Passed through on its own
+                sent_keys.append(set([record['PartitionKey']]))
+            else:
+                sent_keys.append(set(key for key, _ in sub_records))
+        for record_keys in sent_keys:
+            assert_equal(
+                len(set(routing.hash_key(k) < middle for k in record_keys)), 1)
+
+        # Each record gets the result for the aggregate it went into
+        for key, (_, seq_num) in zip(keys, resp):
+            assert_in(key, sent_keys[seq_num])
+
+    def test_put_many_rate_limit_per_shard(self):
+        c = turtle.Turtle()
+        events = []
+
+        def put_records(records, stream_name, **kwargs):
+            events.append([r['PartitionKey'] for r in records])
+            return {'Records': [
+                {'ShardId': '0001', 'SequenceNumber': n}
+                for n in range(len(records))
+            ]}
+
+        c.put_records = put_records
+        s = stream.Stream(c, 'test stream', 'value', rate_limit=True,
+                          put_concurrency=1)
+        middle = 2 ** 127
+        s._shards = [
+            generate_shard('0001', 0, middle - 1),
+            generate_shard('0002', middle, 2 ** 128 - 1),
+        ]
+        hot_key, cold_key = 'key 0', 'key 6'
+        assert_lt(routing.hash_key(hot_key), middle)
+        assert_gte(routing.hash_key(cold_key), middle)
+
+        # Use up the hot shard's capacity
+        s.rate_limiter.delay([(hot_key, 10)] * 2000)
+
+        with mock.patch('time.sleep') as sleep:
+            sleep.side_effect = lambda secs: events.append('sleep')
+            s.put_many([dict(value=hot_key), dict(value=cold_key)])
+
+        # The cold shard's record isn't held up behind the hot one
+        assert_equal(events, [[cold_key], 'sleep', [hot_key]])
+        assert s.rate_limiter._shard_map is s._shard_map
+
+    def test_put_many_rate_limit_one_call(self):
+        c = turtle.Turtle()
+        calls = []
+
+        def put_records(records, stream_name, **kwargs):
+            calls.append(len(records))
+            return {'Records': [
+                {'ShardId': '0001', 'SequenceNumber': n}
+                for n in range(len(records))
+            ]}
+
+        c.put_records = put_records
+        s = stream.Stream(c, 'test stream', 'value', rate_limit=True)
+        shard_size = 2 ** 128 // 16
+        s._shards = [
+            generate_shard('{:04d}'.format(n), n * shard_size,
+                           (n + 1) * shard_size - 1)
+            for n in range(16)
+        ]
+
+        with mock.patch('time.sleep') as sleep:
+            s.put_many([dict(value='key {}'.format(n)) for n in range(500)])
+
+        # No shard has to wait, so it's all one request
+        assert_equal(calls, [500])
+        assert not sleep.called
+
+    def test_put_many_retry_keeps_order(self):
+        c = turtle.Turtle()
+        calls = []
+
+        def put_records(records, stream_name, **kwargs):
+            calls.append(len(records))
+            resp = []
+            for r in records:
+                # Odd records fail the first time through
+                n = msgpack.unpackb(r['Data'])[b'n']
+                if len(calls) == 1 and n % 2:
+                    resp.append({'ErrorCode': 'InternalFailure'})
+                else:
+                    resp.append({'ShardId': '0001', 'SequenceNumber': n})
+            return {'Records': resp}
+
+        c.put_records = put_records
+        s = stream.Stream(c, 'test stream', 'value')
+        resp = s.put_many([dict(value='a', n=n) for n in range(6)])
+
+        assert_equal(calls, [6, 3])
+        assert_equal([seq_num for _, seq_num in resp], list(range(6)))
+
+
+class ConnectionCacheTest(TestCase):
+
+    @setup
+    def clear(self):
+        stream.clear_connections()
+
+    @teardown
+    def clear_after(self):
+        stream.clear_connections()
+
+    def test_get_connection(self):
+        with mock.patch.object(stream, 'connect_to_region') as connect:
+            connect.side_effect = lambda region, **kwargs: object()
+
+            conn = stream.get_connection('us-east-1')
+            assert stream.get_connection('us-east-1') is conn
+            assert stream.get_connection('us-west-1') is not conn
+            assert stream.get_connection(
+                'us-east-1', aws_access_key_id='x') is not conn
+
+            assert_equal(connect.call_count, 3)
+
+            stream.clear_connections()
+            assert stream.get_connection('us-east-1') is not conn
+
+    def test_get_stream_shares_connection(self):
+        config = {
+            'a': {'name': 'a', 'partition_key': 'value'},
+            'b': {'name': 'b', 'partition_key': 'value'},
+        }
+        with mock.patch.object(stream, 'connect_to_region') as connect:
+            connect.side_effect = lambda region, **kwargs: object()
+            a = stream.get_stream('a', config)
+            b = stream.get_stream('b', config)
+
+        assert a.conn is b.conn
+
+    def test_get_stream_tritond_config(self):
+        config = {
+            'tritond': {'stream_deny': ['a']},
+            'a': {'name': 'a', 'partition_key': 'value'},
+        }
+        assert_raises(errors.StreamNotConfiguredError,
+                      stream.get_stream, 'tritond', config)
@@ -1,7 +1,107 @@
 from testify import *
+import mock
 
+import json
 import os
+import shutil
 import subprocess
+import tempfile
+import types
+from collections import defaultdict
+
+import six
+
+import zmq
+from boto.kinesis.exceptions import ResourceNotFoundException
+
+from triton import errors, spool
+
+TRITOND_PATH = os.path.join(
+    os.path.dirname(__file__), os.pardir, 'bin', 'tritond')
+
+
+def load_tritond():
+    """Import bin/tritond as a module, without writing a tritondc next to it"""
+    module = types.ModuleType(str('tritond'))
+    module.__file__ = TRITOND_PATH
+    with open(TRITOND_PATH) as f:
+        code = compile(f.read(), TRITOND_PATH, 'exec')
+    exec(code, module.__dict__)
+    return module
+
+
+# tritond is python 2 only; the tests using it no-op on 3
+if six.PY2:
+    tritond = load_tritond()
+
+
+class FakeSocket(object):
+    """A collector socket with messages waiting for stream_name"""
+
+    def __init__(self, stream_name, count):
+        meta = json.dumps({'stream_name': stream_name,
+                           'partition_key': 'key'}).encode('utf-8')
+        self.messages = [(meta, b'data') for _ in range(count)]
+
+    def recv_multipart(self, flags=0):
+        if not self.messages:
+            raise zmq.Again()
+        return self.messages.pop(0)
+
+
+class FakeStream(object):
+    """Records each _put_packed call, failing messages whose data is 'bad',
+    and rejecting those whose data is 'invalid'
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def _put_packed(self, records):
+        self.calls.append(list(records))
+        results = [None if r['Data'] in (b'bad', b'invalid') else ('0001', n)
+                   for n, r in enumerate(records)]
+        record_errors = [
+            ('ValidationException', 'invalid') if r['Data'] == b'invalid' else
+            ('InternalFailure', 'bad') if r['Data'] == b'bad' else None
+            for r in records]
+        if None in results:
+            raise errors.KinesisPutManyError(
+                'failed', failed_data=[], results=results,
+                record_errors=record_errors)
+        return results
+
+
+def pending(stream_name, *datas, **kwargs):
+    """waiting_messages with datas pending for stream_name"""
+    entry_ids = kwargs.get('entry_ids') or [None] * len(datas)
+    waiting_messages = defaultdict(tritond._PendingMessages)
+    for data, entry_id in zip(datas, entry_ids):
+        waiting_messages[stream_name].add(
+            {'Data': data, 'PartitionKey': 'key'}, entry_id)
+    return waiting_messages
+
+
+class TritondTestCase(TestCase):
+
+    @setup
+    def set_streams(self):
+        self.streams = defaultdict(FakeStream)
+        if six.PY2:
+            self.old_streams = tritond._streams
+            self.old_stream_filter = tritond._stream_filter
+            tritond._streams = self.streams
+            tritond._stream_filter = tritond.StreamFilter(
+                deny=tritond.STREAM_BLACKLIST)
+            tritond._flush_settings.clear()
+
+    @teardown
+    def restore_streams(self):
+        if six.PY2:
+            tritond._streams = self.old_streams
+            tritond._stream_filter = self.old_stream_filter
+            tritond._flush_settings.clear()
+
 
 class Tritond(TestCase):
 
@@ -14,3 +114,366 @@ class Tritond(TestCase):
             p = subprocess.Popen(cmd.split(' '), stdout=null, stderr=null)
             p.communicate()
             assert_equal(p.returncode, 0)
+
+
+class SpoolTest(TritondTestCase):
+
+    @setup
+    def build_spool(self):
+        self.path = tempfile.mkdtemp()
+        self.spool = spool.Spool(self.path, replay_delay_secs=0.0,
+                                 segment_roll_secs=0.0)
+
+    @teardown
+    def remove_spool(self):
+        self.spool.close()
+        shutil.rmtree(self.path)
+
+    def spooled(self, stream_name, *datas):
+        entry_ids = [self.spool.append(stream_name, 'key', data)
+                     for data in datas]
+        return pending(stream_name, *datas, entry_ids=entry_ids)
+
+    def test_only_failed_replayed(self):
+        if not six.PY2:
+            return
+
+        waiting_messages = self.spooled('s', b'good', b'bad', b'good 2')
+        tritond._flush_events(waiting_messages, spool=self.spool)
+        assert_equal(len(self.streams['s'].calls), 1)
+
+        # What was written alongside it isn't written again
+        replayed = defaultdict(tritond._PendingMessages)
+        tritond._replay_spool(self.spool, replayed)
+        assert_equal([m['Data'] for m in replayed['s']], [b'bad'])
+
+    def test_invalid_not_replayed(self):
+        if not six.PY2:
+            return
+
+        waiting_messages = self.spooled('s', b'invalid', b'bad')
+        with mock.patch.object(tritond.pystatsd, 'increment') as increment:
+            tritond._flush_events(waiting_messages, spool=self.spool)
+
+        # Retrying it would only fail again
+        increment.assert_any_call(tritond.STATSD_DROPCOUNT + 's', 1)
+        replayed = defaultdict(tritond._PendingMessages)
+        tritond._replay_spool(self.spool, replayed)
+        assert_equal([m['Data'] for m in replayed['s']], [b'bad'])
+
+    def test_given_up(self):
+        if not six.PY2:
+            return
+
+        self.spool.max_attempts = 2
+        waiting_messages = self.spooled('s', b'bad')
+        tritond._flush_events(waiting_messages, spool=self.spool)
+
+        replayed = defaultdict(tritond._PendingMessages)
+        tritond._replay_spool(self.spool, replayed)
+        with mock.patch.object(tritond.pystatsd, 'increment') as increment:
+            tritond._flush_events(replayed, spool=self.spool)
+
+        increment.assert_any_call(tritond.STATSD_DROPCOUNT + 's')
+        replayed = defaultdict(tritond._PendingMessages)
+        tritond._replay_spool(self.spool, replayed)
+        assert_equal(len(replayed), 0)
+
+    def test_dropped_replayed(self):
+        if not six.PY2:
+            return
+
+        flush_queue = tritond.queue.Queue(1)
+        flush_queue.put(None)
+        waiting_messages = self.spooled('s', b'one', b'two')
+        tritond._flush_events(waiting_messages, flush_queues=[flush_queue],
+                              spool=self.spool)
+
+        replayed = defaultdict(tritond._PendingMessages)
+        tritond._replay_spool(self.spool, replayed)
+        assert_equal([m['Data'] for m in replayed['s']], [b'one', b'two'])
+
+
+class WriteMessagesTest(TritondTestCase):
+
+    def test_stream_fails_to_load(self):
+        if not six.PY2:
+            return
+
+        good_stream = FakeStream()
+        tritond._streams = {'good': good_stream}
+        waiting_messages = pending('good', b'one')
+        waiting_messages.update(pending('broken', b'two', b'three'))
+
+        with mock.patch.object(tritond, 'get_stream',
+                               side_effect=KeyError('name')):
+            failed = tritond._write_messages_to_streams(waiting_messages)
+
+        # The other stream is still written
+        assert_equal(len(good_stream.calls), 1)
+        assert_equal(failed, {'broken': [0, 1]})
+
+    def test_stream_deleted(self):
+        if not six.PY2:
+            return
+
+        deleted_stream = FakeStream()
+        deleted_stream._put_packed = mock.Mock(
+            side_effect=ResourceNotFoundException(400, 'Bad Request'))
+        tritond._streams = {'deleted': deleted_stream}
+
+        failed = tritond._write_messages_to_streams(
+            pending('deleted', b'one', b'two'))
+        assert_equal(failed, {'deleted': []})
+
+
+class SenderTest(TritondTestCase):
+
+    def test_senders(self):
+        if not six.PY2:
+            return
+
+        flush_queues = [tritond.queue.Queue() for _ in range(2)]
+        senders = tritond._start_senders(flush_queues)
+
+        waiting_messages = pending('a', b'one')
+        waiting_messages.update(pending('b', b'two', b'three'))
+        tritond._flush_events(waiting_messages, flush_queues=flush_queues)
+        tritond._stop_senders(flush_queues, senders)
+
+        assert_equal([[m['Data'] for m in call]
+                      for call in self.streams['a'].calls], [[b'one']])
+        assert_equal([[m['Data'] for m in call]
+                      for call in self.streams['b'].calls],
+                     [[b'two', b'three']])
+
+    def test_stream_sender(self):
+        if not six.PY2:
+            return
+
+        flush_queues = [tritond.queue.Queue() for _ in range(4)]
+        for data in (b'one', b'two'):
+            tritond._flush_events(pending('a', data),
+                                  flush_queues=flush_queues)
+
+        # Both flushes wait for the same sender, so are written in order
+        flush_queue = tritond._sender_queue(flush_queues, 'a')
+        assert_equal(sum(q.qsize() for q in flush_queues), 2)
+        assert_equal(
+            [[m['Data'] for m in flush_queue.get()[1]['a']]
+             for _ in range(2)],
+            [[b'one'], [b'two']])
+
+    def test_queue_full(self):
+        if not six.PY2:
+            return
+
+        flush_queues = [tritond.queue.Queue(1)]
+        with mock.patch.object(tritond.pystatsd, 'increment') as increment:
+            tritond._flush_events(pending('a', b'one'),
+                                  flush_queues=flush_queues)
+            tritond._flush_events(pending('a', b'two', b'three'),
+                                  flush_queues=flush_queues)
+
+        # The second flush is dropped and counted
+        increment.assert_called_once_with(tritond.STATSD_DROPCOUNT + 'a', 2)
+        assert_equal(flush_queues[0].qsize(), 1)
+        assert_equal([m['Data'] for m in flush_queues[0].get()[1]['a']],
+                     [b'one'])
+
+
+class DrainMessagesTest(TritondTestCase):
+
+    def test_drain(self):
+        if not six.PY2:
+            return
+
+        sock = FakeSocket('order_event', 3)
+        waiting_messages = defaultdict(tritond._PendingMessages)
+        assert_equal(tritond._drain_messages(sock, waiting_messages), 3)
+        assert_equal(len(waiting_messages['order_event']), 3)
+
+    def test_max_messages(self):
+        if not six.PY2:
+            return
+
+        sock = FakeSocket('order_event', 5)
+        waiting_messages = defaultdict(tritond._PendingMessages)
+
+        # The rest wait for the next poll
+        assert_equal(
+            tritond._drain_messages(sock, waiting_messages, max_messages=2),
+            2)
+        assert_equal(len(waiting_messages['order_event']), 2)
+        assert_equal(len(sock.messages), 3)
+
+
+class MaybeFlushEventsTest(TritondTestCase):
+
+    def flushed(self, stream_name):
+        return [[m['Data'] for m in call]
+                for call in self.streams[stream_name].calls]
+
+    def test_max_records(self):
+        if not six.PY2:
+            return
+
+        tritond._flush_settings['a'] = (2, 1024, 60.0)
+        waiting_messages = tritond._maybe_flush_events(pending('a', b'one'))
+        assert_equal(self.flushed('a'), [])
+
+        waiting_messages['a'].add({'Data': b'two', 'PartitionKey': 'key'})
+        waiting_messages = tritond._maybe_flush_events(waiting_messages)
+        assert_equal(self.flushed('a'), [[b'one', b'two']])
+        assert_equal(dict(waiting_messages), {})
+
+    def test_max_bytes(self):
+        if not six.PY2:
+            return
+
+        # Partition keys count too
+        tritond._flush_settings['a'] = (500, len(b'one' + b'key') + 1, 60.0)
+        waiting_messages = tritond._maybe_flush_events(pending('a', b'one'))
+        assert_equal(self.flushed('a'), [])
+
+        waiting_messages['a'].add({'Data': b'two', 'PartitionKey': 'key'})
+        tritond._maybe_flush_events(waiting_messages)
+        assert_equal(self.flushed('a'), [[b'one', b'two']])
+
+    def test_linger(self):
+        if not six.PY2:
+            return
+
+        tritond._flush_settings['a'] = (500, 1024, 0.5)
+        waiting_messages = tritond._maybe_flush_events(pending('a', b'one'))
+        assert_equal(self.flushed('a'), [])
+
+        # Up to the linger time, and no longer
+        assert_lte(tritond._poll_timeout_ms(waiting_messages), 500)
+        waiting_messages['a'].first_time -= 1.0
+        assert_equal(tritond._poll_timeout_ms(waiting_messages), 0)
+
+        tritond._maybe_flush_events(waiting_messages)
+        assert_equal(self.flushed('a'), [[b'one']])
+
+    def test_per_stream(self):
+        if not six.PY2:
+            return
+
+        tritond._flush_settings['a'] = (1, 1024, 60.0)
+        tritond._flush_settings['b'] = (2, 1024, 60.0)
+        waiting_messages = pending('a', b'one')
+        waiting_messages.update(pending('b', b'two'))
+
+        # Only the stream that's ready is flushed
+        waiting_messages = tritond._maybe_flush_events(waiting_messages)
+        assert_equal(self.flushed('a'), [[b'one']])
+        assert_equal(self.flushed('b'), [])
+        assert_equal(list(waiting_messages), ['b'])
+
+
+class StreamFilterTest(TestCase):
+
+    def test_deny(self):
+        if not six.PY2:
+            return
+
+        f = tritond.StreamFilter(deny=['job_', 'god_event'])
+        assert f.allowed('order_event')
+        assert not f.allowed('job_event')
+        assert not f.allowed('god_event_v2')
+
+    def test_allow(self):
+        if not six.PY2:
+            return
+
+        f = tritond.StreamFilter(allow=['order_', 'delivery_'],
+                                 deny=['order_test_'])
+        assert f.allowed('order_event')
+        assert f.allowed('delivery_event')
+        assert not f.allowed('job_event')
+        assert not f.allowed('order_test_event')
+
+        # An empty allow list allows nothing
+        assert not tritond.StreamFilter(allow=[]).allowed('order_event')
+
+    def test_cache(self):
+        if not six.PY2:
+            return
+
+        f = tritond.StreamFilter(deny=['job_'])
+        assert not f.allowed('job_event')
+        assert_equal(f._decisions, {'job_event': False})
+
+        # Decisions come from the cache once made
+        f._decisions['job_event'] = True
+        assert f.allowed('job_event')
+
+        with mock.patch.object(tritond, 'MAX_FILTER_CACHE_SIZE', 1):
+            assert f.allowed('order_event')
+        assert_equal(f._decisions, {'order_event': True})
+
+
+class ReloadConfigTest(TritondTestCase):
+    """What SIGHUP does, on the main loop's next pass"""
+
+    @setup
+    def write_config(self):
+        self.path = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.path, 'triton.yaml')
+        self.environ = mock.patch.dict(
+            os.environ, {'TRITON_CONFIG': self.config_path})
+        self.environ.start()
+        if six.PY2:
+            self.old_config = tritond._triton_config
+            tritond._triton_config = None
+            tritond._stream_filter = None
+
+    @teardown
+    def remove_config(self):
+        if six.PY2:
+            tritond._triton_config = self.old_config
+        self.environ.stop()
+        shutil.rmtree(self.path)
+
+    def set_config(self, config):
+        with open(self.config_path, 'w') as f:
+            f.write(config)
+
+    def test_reload(self):
+        if not six.PY2:
+            return
+
+        self.set_config(
+            'a: {name: a_v1, partition_key: key}\n'
+            'b: {name: b_v1, partition_key: key}\n'
+            'tritond: {stream_deny: [god_]}\n')
+        assert tritond.get_stream_filter().allowed('job_event')
+        tritond._flush_settings['b'] = (1, 1, 1.0)
+        self.streams['a'] = stream_a = FakeStream()
+        self.streams['b'] = FakeStream()
+
+        self.set_config(
+            'a: {name: a_v1, partition_key: key}\n'
+            'b: {name: b_v2, partition_key: key, flush_max_records: 2}\n'
+            'tritond: {stream_deny: [job_]}\n')
+        tritond.reload_triton_config()
+
+        # Only the stream whose config changed is rebuilt
+        assert_equal(list(tritond._streams), ['a'])
+        assert tritond._streams['a'] is stream_a
+        assert_equal(tritond.get_triton_config()['b']['name'], 'b_v2')
+        assert_equal(tritond.get_flush_settings('b')[0], 2)
+        assert not tritond.get_stream_filter().allowed('job_event')
+
+    def test_reload_failed(self):
+        if not six.PY2:
+            return
+
+        self.set_config('a: {name: a_v1, partition_key: key}\n')
+        config = tritond.get_triton_config()
+
+        # Missing a partition key, so the config we have is kept
+        self.set_config('a: {name: a_v2}\n')
+        tritond.reload_triton_config()
+        assert tritond.get_triton_config() is config
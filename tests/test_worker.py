@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+from testify import *
+import mock
+import pickle
+import signal
+
+from triton import stream, worker
+
+
+def handle_record(rec):
+    pass
+
+
+class FakeIterator(object):
+    def __init__(self, records):
+        self.records = records
+        self.checkpoints = 0
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def iter_batches(self):
+        yield self.records
+
+    def checkpoint(self):
+        self.checkpoints += 1
+
+
+class FakeProcess(object):
+    def __init__(self, shard_ids, exitcode=None):
+        self.shard_ids = shard_ids
+        self.pid = 1
+        self.exitcode = exitcode
+
+    def is_alive(self):
+        return self.exitcode is None
+
+
+class ConsumeTest(TestCase):
+
+    def test_records(self):
+        i = FakeIterator([1, 2, 3])
+        handled = []
+
+        worker.consume(i, handled.append)
+
+        assert_equal(handled, [1, 2, 3])
+        assert_equal(i.checkpoints, 1)
+
+    def test_batches(self):
+        i = FakeIterator([1, 2, 3])
+        handled = []
+
+        worker.consume(i, handled.append, batch=True)
+
+        assert_equal(handled, [[1, 2, 3]])
+
+    def test_checkpoint_interval(self):
+        i = FakeIterator([1, 2, 3])
+
+        worker.consume(i, lambda rec: None, checkpoint_interval_secs=0)
+
+        # Once per record, plus once at the end
+        assert_equal(i.checkpoints, 4)
+
+
+class ShardWorkerPoolTest(TestCase):
+
+    def build_stream(self):
+        c = turtle.Turtle()
+        s = stream.Stream(c, 'test stream', 'value')
+        s._shards = [
+            {'ShardId': '0001'},
+            {'ShardId': '0002'},
+            {'ShardId': '0003', 'ParentShardId': '0001'},
+            {'ShardId': '0004'},
+        ]
+        return s
+
+    def test_shard_groups(self):
+        pool = worker.ShardWorkerPool(self.build_stream(), None, num_workers=2)
+
+        assert_equal(pool.shard_groups(), [['0001', '0004'], ['0002']])
+
+    def test_shard_groups_more_workers_than_shards(self):
+        pool = worker.ShardWorkerPool(self.build_stream(), None, num_workers=8)
+
+        assert_equal(pool.shard_groups(), [['0001'], ['0002'], ['0004']])
+
+    def test_supervise(self):
+        pool = worker.ShardWorkerPool(self.build_stream(), None, num_workers=3)
+        pool._start_process = FakeProcess
+        for group in [(0,), (1,), (3,)]:
+            pool._start_worker(group)
+        pool._processes[(1,)].exitcode = 0
+        pool._processes[(3,)].exitcode = -9
+
+        with mock.patch('time.time', return_value=100.0):
+            pool._supervise()
+
+        assert_equal(set(pool._processes), set([(0,)]))
+        assert_equal(pool._restart_times, {
+            (3,): 100.0 + worker.RESTART_BASE_DELAY_SECS})
+
+        with mock.patch('time.time', return_value=102.0):
+            pool._supervise()
+
+        assert_equal(set(pool._processes), set([(0,), (3,)]))
+        assert pool._processes[(3,)].is_alive()
+
+    def test_restart_backoff(self):
+        pool = worker.ShardWorkerPool(self.build_stream(), None, num_workers=1)
+        pool._start_process = FakeProcess
+
+        now = 100.0
+        delays = []
+        with mock.patch('time.time', side_effect=lambda: now):
+            pool._start_worker((0,))
+            for _ in range(8):
+                pool._processes[(0,)].exitcode = 1
+                pool._supervise()
+                delays.append(pool._restart_times[(0,)] - now)
+                now = pool._restart_times[(0,)]
+                pool._supervise()
+
+            # Staying up for a while resets the delay
+            now += worker.RESTART_MAX_DELAY_SECS
+            pool._processes[(0,)].exitcode = 1
+            pool._supervise()
+
+        assert_equal(delays, [1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 60.0, 60.0])
+        assert_equal(pool._restart_times[(0,)] - now, 1.0)
+
+    def test_worker_args_picklable(self):
+        conn = stream.connect_to_region(
+            'us-west-1', aws_access_key_id='key',
+            aws_secret_access_key='secret')
+        s = stream.Stream(conn, 'test stream', 'value')
+        pool = worker.ShardWorkerPool(s, handle_record)
+
+        args = pickle.loads(
+            pickle.dumps(pool._worker_args(['0001', '0002'])))
+        assert_equal(args[:5], (
+            'test stream', 'value', 'us-west-1',
+            {'aws_access_key_id': 'key', 'aws_secret_access_key': 'secret'},
+            ['0001', '0002']))
+
+    def test_worker_main(self):
+        i = FakeIterator([1, 2])
+        handled = []
+        handlers = dict((signum, signal.getsignal(signum))
+                        for signum in (signal.SIGTERM, signal.SIGINT))
+
+        try:
+            with mock.patch.object(worker, 'get_connection') as connect, \
+                    mock.patch.object(stream.Stream,
+                                      'build_iterator_from_checkpoint',
+                                      return_value=i) as build:
+                worker._worker_main(
+                    'test stream', 'value', 'us-west-1',
+                    {'aws_access_key_id': 'key'}, ['0001', '0002'],
+                    handled.append,
+                    False, 10.0)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+        connect.assert_called_once_with('us-west-1', aws_access_key_id='key')
+        build.assert_called_once_with(shard_ids=['0001', '0002'])
+        assert_equal(handled, [1, 2])
+        assert_equal(i.checkpoints, 1)
@@ -19,4 +19,5 @@ __copyright__ = 'Copyright 2015 Postmates'
 from .config import load_config
 from .stream import get_stream
 from .nonblocking_stream import get_nonblocking_stream
+from .batching_stream import get_batching_stream
 from .store import stream_from_s3_store
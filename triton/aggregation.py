@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+triton.aggregation
+~~~~~~~~
+
+Packs many small records into one Kinesis record, and unpacks them again.
+
+Kinesis limits and bills shards per record, so writing a few hundred bytes at a
+time wastes most of a shard's capacity. Aggregated records use the format of
+the Kinesis Producer Library, so they can also be read by the KCL and other
+KPL-aware consumers:
+
+    magic (4 bytes) | AggregatedRecord protobuf | md5 of the protobuf
+
+where
+
+    message AggregatedRecord {
+        repeated string partition_key_table = 1;
+        repeated string explicit_hash_key_table = 2;
+        repeated Record records = 3;
+    }
+
+    message Record {
+        required uint64 partition_key_index = 1;
+        optional uint64 explicit_hash_key_index = 2;
+        required bytes data = 3;
+        repeated Tag tags = 4;
+    }
+
+The protobuf is small enough that we encode it by hand rather than depend on
+protobuf.
+
+All the records in an aggregated record end up on the shard for the first
+record's partition key, so like the KPL we only aggregate records bound for
+the same shard.
+
+"""
+from __future__ import unicode_literals
+import collections
+import hashlib
+
+import six
+
+MAGIC = b'\xf3\x89\x9a\xc2'
+DIGEST_SIZE = 16
+
+# The KPL's default limit on the size of an aggregated record. Kinesis allows
+# up to 1MB, but smaller records spread more evenly across consumers.
+MAX_AGGREGATED_BYTES = 50 * 1024
+
+# Protobuf wire types
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH_DELIMITED = 2
+_FIXED32 = 5
+
+# Field numbers
+_AGG_PARTITION_KEY_TABLE = 1
+_AGG_EXPLICIT_HASH_KEY_TABLE = 2
+_AGG_RECORDS = 3
+_REC_PARTITION_KEY_INDEX = 1
+_REC_DATA = 3
+
+
+def _encode_varint(value):
+    out = bytearray()
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+
+def _decode_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = six.indexbytes(buf, pos)
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _encode_field(field_num, value):
+    """Encode a length delimited field"""
+    return (_encode_varint(field_num << 3 | _LENGTH_DELIMITED) +
+            _encode_varint(len(value)) + value)
+
+
+def _iter_fields(buf):
+    """Yield (field_num, value) for each field in a protobuf message
+
+    Length delimited values are returned as bytes, varints as ints. Fixed width
+    fields, which we never need, are skipped.
+    """
+    pos = 0
+    while pos < len(buf):
+        key, pos = _decode_varint(buf, pos)
+        field_num, wire_type = key >> 3, key & 0x7
+
+        if wire_type == _VARINT:
+            value, pos = _decode_varint(buf, pos)
+        elif wire_type == _LENGTH_DELIMITED:
+            length, pos = _decode_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == _FIXED64:
+            pos += 8
+            continue
+        elif wire_type == _FIXED32:
+            pos += 4
+            continue
+        else:
+            raise ValueError("Unknown wire type {}".format(wire_type))
+
+        yield field_num, value
+
+
+def _encode_record(partition_key_index, data):
+    return _encode_field(
+        _AGG_RECORDS,
+        _encode_varint(_REC_PARTITION_KEY_INDEX << 3 | _VARINT) +
+        _encode_varint(partition_key_index) +
+        _encode_field(_REC_DATA, data))
+
+
+def _to_bytes(value):
+    if isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return value
+
+
+class _Aggregate(object):
+    """Records being collected into one aggregated record"""
+
+    def __init__(self):
+        self.records = []
+        # Where each record was in the input to aggregate()
+        self.idxs = []
+        self.partition_keys = {}
+        self.parts = []
+        self.size = len(MAGIC) + DIGEST_SIZE
+
+    def size_with(self, record):
+        """How big we'd be after adding record, and the encoded parts to add"""
+        parts = []
+        partition_key = _to_bytes(record['PartitionKey'])
+        pk_index = self.partition_keys.get(partition_key)
+        if pk_index is None:
+            pk_index = len(self.partition_keys)
+            parts.append(
+                _encode_field(_AGG_PARTITION_KEY_TABLE, partition_key))
+
+        parts.append(_encode_record(pk_index, _to_bytes(record['Data'])))
+        return self.size + sum(len(p) for p in parts), parts
+
+    def add(self, idx, record, size, parts):
+        partition_key = _to_bytes(record['PartitionKey'])
+        if partition_key not in self.partition_keys:
+            self.partition_keys[partition_key] = len(self.partition_keys)
+
+        self.idxs.append(idx)
+        self.records.append(record)
+        self.parts.extend(parts)
+        self.size = size
+
+    def to_record(self):
+        if len(self.records) == 1:
+            # Not worth the overhead
+            return self.records[0]
+
+        # Field order doesn't matter to protobuf, so the partition key table
+        # can be interleaved with the records.
+        message = b''.join(self.parts)
+        return {
+            'Data': MAGIC + message + hashlib.md5(message).digest(),
+            'PartitionKey': self.records[0]['PartitionKey'],
+        }
+
+
+def aggregate(records, max_size=MAX_AGGREGATED_BYTES, shard_of=None):
+    """Pack records into as few aggregated records as fit in max_size
+
+    Only records bound for the same shard are packed together.
+
+    Args:
+        records - list() of packed records, dicts with 'Data' and
+            'PartitionKey' as taken by Stream._put_many_packed()
+        max_size - Largest aggregated record to build, in bytes
+        shard_of - Function giving the shard a partition key maps to. By
+            default only records with the same partition key are packed
+            together.
+
+    Returns a list of (record, idxs), where record stands for the records at
+    idxs in the input. Records too big to share, or that end up alone, are
+    passed through as they are.
+    """
+    if shard_of is None:
+        shard_of = _to_bytes
+
+    aggregated = []
+    # shard -> _Aggregate being filled for it, in the order first seen
+    current = collections.OrderedDict()
+
+    for idx, record in enumerate(records):
+        shard = shard_of(record['PartitionKey'])
+        shard_aggregate = current.get(shard)
+        if shard_aggregate is None:
+            shard_aggregate = current[shard] = _Aggregate()
+
+        size, parts = shard_aggregate.size_with(record)
+        if size > max_size and shard_aggregate.records:
+            aggregated.append(
+                (shard_aggregate.to_record(), shard_aggregate.idxs))
+            shard_aggregate = current[shard] = _Aggregate()
+            size, parts = shard_aggregate.size_with(record)
+
+        shard_aggregate.add(idx, record, size, parts)
+
+    for shard_aggregate in current.values():
+        aggregated.append((shard_aggregate.to_record(), shard_aggregate.idxs))
+
+    return aggregated
+
+
+def is_aggregated(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def deaggregate(data):
+    """Unpack an aggregated record's data
+
+    Returns a list of (partition_key, data) for the records it contains, or
+    None if data isn't an aggregated record.
+    """
+    if not is_aggregated(data) or len(data) < len(MAGIC) + DIGEST_SIZE:
+        return None
+
+    message = data[len(MAGIC):-DIGEST_SIZE]
+    if hashlib.md5(message).digest() != data[-DIGEST_SIZE:]:
+        return None
+
+    partition_keys = []
+    records = []
+    for field_num, value in _iter_fields(message):
+        if field_num == _AGG_PARTITION_KEY_TABLE:
+            partition_keys.append(value.decode('utf-8'))
+        elif field_num == _AGG_RECORDS:
+            key_index = None
+            record_data = b''
+            for rec_field_num, rec_value in _iter_fields(value):
+                if rec_field_num == _REC_PARTITION_KEY_INDEX:
+                    key_index = rec_value
+                elif rec_field_num == _REC_DATA:
+                    record_data = rec_value
+            records.append((key_index, record_data))
+
+    return [
+        (partition_keys[pk_index] if pk_index is not None else None, d)
+        for pk_index, d in records
+    ]
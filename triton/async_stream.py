@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+triton.async_stream
+~~~~~~~~
+
+asyncio support for consuming a Triton Stream.
+
+Each shard is driven by its own coroutine. Kinesis calls are still made with
+boto, so they run in the event loop's default executor, but waiting for a shard
+to be due for polling uses asyncio.sleep() and never blocks the loop.
+
+Requires python 3.5+; use Stream.build_async_iterator_* rather than importing
+this module directly.
+
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+
+from triton import errors
+from triton.stream import CombinedStreamIterator, MAX_QUEUED_RECORDS_PER_SHARD
+
+log = logging.getLogger(__name__)
+
+
+class AsyncCombinedStreamIterator(CombinedStreamIterator):
+    """Combines multiple StreamIterators for reading from an event loop
+
+    Usage:
+
+        async for rec in stream.build_async_iterator_from_latest():
+            ...
+
+    Args:
+        iterators - list of StreamIterator()
+        max_queued_records - How many records may be waiting for the consumer
+            before the shard coroutines stop fetching.
+        max_buffered_records, max_buffered_bytes - Bound the size of each
+            get_records page, see CombinedStreamIterator
+    """
+
+    def __init__(
+        self, iterators, max_queued_records=MAX_QUEUED_RECORDS_PER_SHARD,
+        **kwargs
+    ):
+        super(AsyncCombinedStreamIterator, self).__init__(iterators, **kwargs)
+        self.max_queued_records = max_queued_records
+
+        self._queue = None
+        self._wakeup = None
+        self._tasks = []
+        self._error = None
+        self._delivered_seq_nums = {}
+        # Shards that end together are retired in parallel executor threads,
+        # which mustn't both decide to start a merged child.
+        self._retire_lock = threading.Lock()
+
+    def _start(self):
+        if self._queue is not None:
+            return
+
+        self._queue = asyncio.Queue(self.max_queued_records)
+        self._wakeup = asyncio.Event()
+        for this_iterator in self.iterators:
+            task = asyncio.ensure_future(self._run_shard(this_iterator))
+            self._tasks.append(task)
+
+    async def _run_shard(self, stream_iterator):
+        loop = asyncio.get_event_loop()
+        try:
+            while self._running:
+                throttle_secs = stream_iterator.next_poll_time - time.time()
+                if throttle_secs > 0.0:
+                    await asyncio.sleep(throttle_secs)
+
+                log.debug("Checking stream (%s, %s) ",
+                          stream_iterator.stream.name,
+                          stream_iterator.shard_id)
+                stream_iterator.limit = self.budget.page_limit()
+                records = await loop.run_in_executor(
+                    None, functools.partial(
+                        stream_iterator.next_batch, prefetch=False))
+                num_bytes = self.budget.observe(records)
+                stream_iterator.start_prefetch(
+                    self.budget, len(records), num_bytes)
+                for rec in records:
+                    await self._queue.put((stream_iterator, rec))
+                    self._wakeup.set()
+        except errors.EndOfShardError:
+            child_iterators = await loop.run_in_executor(
+                None, self._retire_iterator_locked, stream_iterator)
+            for child_iterator in child_iterators:
+                self._tasks.append(
+                    asyncio.ensure_future(self._run_shard(child_iterator)))
+            # In case that was the last shard
+            self._wakeup.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.exception("Coroutine for %r failed", stream_iterator)
+            self._error = e
+            self._wakeup.set()
+
+    def _retire_iterator_locked(self, closed_iterator):
+        with self._retire_lock:
+            return self._retire_iterator(closed_iterator)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self._start()
+
+        while True:
+            if not self._queue.empty():
+                this_iterator, rec = self._queue.get_nowait()
+                if rec.ends_seq_num:
+                    # Otherwise a checkpoint would skip the rest of the
+                    # aggregate
+                    self._delivered_seq_nums[this_iterator] = rec.seq_num
+                    self.last_seq_num = rec.seq_num
+                self.last_iterator = this_iterator
+                return rec
+
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+
+            if not self._running:
+                raise StopAsyncIteration
+
+            if all(task.done() for task in self._tasks):
+                # Every shard has been read to the end, and any children
+                # would have been started before their parent's task ended
+                log.info("Every shard has been read to the end")
+                self.stop()
+                raise StopAsyncIteration
+
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    def stop(self):
+        """Stop fetching; records already fetched will still be delivered."""
+        self._running = False
+        for task in self._tasks:
+            task.cancel()
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _checkpoint_positions(self):
+        with self._retire_lock:
+            # Retired shards are covered by _delivered_seq_nums
+            self._retired_iterators = []
+            return list(self._delivered_seq_nums.items())
+
+    def checkpoint(self):
+        """Record how far we've delivered, blocking until it's saved"""
+        for this_iterator, seq_num in self._checkpoint_positions():
+            this_iterator.checkpointer.checkpoint(
+                this_iterator.shard_id, seq_num)
+
+    async def checkpoint_async(self):
+        """Like checkpoint(), but saves from the default executor"""
+        loop = asyncio.get_event_loop()
+        for this_iterator, seq_num in self._checkpoint_positions():
+            await loop.run_in_executor(
+                None, this_iterator.checkpointer.checkpoint,
+                this_iterator.shard_id, seq_num)
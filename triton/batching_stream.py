@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+triton.batching_stream
+~~~~~~~~
+
+This module provides a producer that batches writes to a Triton Stream in
+process.
+
+Calls to put() are buffered in memory and written with a single put_records
+call once enough have built up, or the oldest has waited long enough. put()
+returns right away with a PutFuture, which resolves to the (shard_id, seq_num)
+of the record once it has been written.
+
+Unlike NonblockingStream, this doesn't need tritond and still tells you
+whether your write made it.
+
+"""
+from __future__ import unicode_literals
+import atexit
+import collections
+import logging
+import threading
+import time
+import weakref
+
+from . import errors
+from .stream import get_stream, KINESIS_MAX_LENGTH
+
+log = logging.getLogger(__name__)
+
+# How long a record may wait for others to join its batch
+LINGER_SECS = 0.1
+
+# Flush once this much data is waiting, whatever the linger time
+MAX_BATCH_BYTES = 1024 * 1024
+
+# BatchingStreams with a running thread, closed at exit so what they've
+# buffered is written rather than lost.
+_open_streams = weakref.WeakSet()
+
+
+class PutFuture(object):
+    """The eventual result of a BatchingStream put
+
+    Resolves to (shard_id, seq_num), or the exception that stopped the record
+    from being written.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done.is_set()
+
+    def _wait(self, timeout):
+        self._done.wait(timeout)
+        if not self._done.is_set():
+            raise errors.PutTimeoutError()
+
+    def result(self, timeout=None):
+        """Wait for the put, returning (shard_id, seq_num)
+
+        Raises the put's error if it failed, or PutTimeoutError if it hasn't
+        finished within timeout seconds.
+        """
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """Wait for the put, returning its error or None if it succeeded"""
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """Call fn(future) once the put finishes
+
+        Callbacks run in the thread writing to Kinesis, so should be quick.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+
+        fn(self)
+
+    def _finish(self, result, exception):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                log.exception("Callback for %r failed", self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        self._finish(None, exception)
+
+
+class BatchingStream(object):
+    """Writes to a Stream in batches from a background thread
+
+    Usage:
+
+        s = triton.get_batching_stream('my_stream', c)
+        f = s.put(value='hi mom', ts=time.time())
+        ...
+        shard, seq_num = f.result()
+
+    Args:
+        stream - Instance of Stream() to write to
+        linger_secs - Longest a record waits before its batch is written
+        max_batch_records - Write as soon as this many records are waiting
+        max_batch_bytes - Write as soon as this much data is waiting
+    """
+
+    def __init__(self, stream, linger_secs=LINGER_SECS,
+                 max_batch_records=KINESIS_MAX_LENGTH,
+                 max_batch_bytes=MAX_BATCH_BYTES):
+        self.stream = stream
+        self.name = stream.name
+        self.linger_secs = linger_secs
+        self.max_batch_records = max_batch_records
+        self.max_batch_bytes = max_batch_bytes
+
+        # (packed record, PutFuture) waiting to be written
+        self._pending = collections.deque()
+        self._pending_bytes = 0
+        self._first_put_time = None
+        self._flushing = 0
+        # Futures for the batch being written
+        self._in_flight = []
+
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = None
+
+    def put(self, **kwargs):
+        """Queue a record to be written, returning a PutFuture"""
+        record = self.stream._pack(kwargs)
+        future = PutFuture()
+
+        with self._cond:
+            if not self._running:
+                raise errors.Error("BatchingStream is closed")
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+                _open_streams.add(self)
+
+            if not self._pending:
+                self._first_put_time = time.time()
+            self._pending.append((record, future))
+            self._pending_bytes += len(record['Data'])
+
+            if self._batch_full():
+                self._cond.notify()
+
+        return future
+
+    def _batch_full(self):
+        return (len(self._pending) >= self.max_batch_records or
+                self._pending_bytes >= self.max_batch_bytes)
+
+    def _take_batch(self):
+        """Wait until a batch is due, and remove it from _pending
+
+        Returns an empty list once we're closed and there's nothing left.
+        """
+        with self._cond:
+            while True:
+                if self._pending:
+                    if (not self._running or self._flushing or
+                            self._batch_full()):
+                        break
+
+                    linger_secs = (self._first_put_time + self.linger_secs -
+                                   time.time())
+                    if linger_secs <= 0.0:
+                        break
+                    self._cond.wait(linger_secs)
+
+                elif not self._running:
+                    return []
+
+                else:
+                    self._cond.wait()
+
+            batch = []
+            batch_bytes = 0
+            while (self._pending and len(batch) < self.max_batch_records and
+                   batch_bytes < self.max_batch_bytes):
+                record, future = self._pending.popleft()
+                batch.append((record, future))
+                batch_bytes += len(record['Data'])
+
+            # Anything left over was held up behind a full batch, so
+            # _first_put_time is left alone and it goes out next without
+            # lingering again.
+            self._pending_bytes -= batch_bytes
+            self._in_flight = [future for _, future in batch]
+            return batch
+
+    def _write_batch(self, batch):
+        error = None
+        try:
+            results = self.stream._put_packed(
+                [record for record, _ in batch])
+        except errors.KinesisPutManyError as e:
+            log.error("Failed to write %d records to %s",
+                      len(e.failed_data), self.name)
+            error = e
+            results = e.results
+        except Exception as e:
+            log.exception("Failed to write batch to %s", self.name)
+            error = e
+            results = [None] * len(batch)
+
+        for (record, future), result in zip(batch, results):
+            if result is None:
+                future.set_exception(self._future_error(error, record))
+            else:
+                future.set_result(result)
+
+    def _future_error(self, error, record):
+        """The error for one future whose record wasn't written"""
+        if isinstance(error, errors.KinesisPutManyError):
+            # Only this future's record, not everyone's in the batch
+            return errors.KinesisPutManyError(
+                'Failed to put record to Kinesis for stream {}'.format(
+                    self.name),
+                failed_data=[record], results=[None])
+        return error
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+            self._write_batch(batch)
+            with self._cond:
+                self._in_flight = []
+
+    def flush(self):
+        """Write everything put so far, waiting until it's done"""
+        with self._cond:
+            futures = self._in_flight + [f for _, f in self._pending]
+            self._flushing += 1
+            self._cond.notify()
+
+        try:
+            for future in futures:
+                future.exception()
+        finally:
+            with self._cond:
+                self._flushing -= 1
+
+    def close(self):
+        """Write anything pending and stop the background thread"""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+            thread = self._thread
+
+        if thread is not None:
+            thread.join()
+        _open_streams.discard(self)
+
+
+def get_batching_stream(stream_name, config, **kwargs):
+    """Like get_stream(), but returns a BatchingStream
+
+    Extra keyword arguments are passed to BatchingStream().
+    """
+    return BatchingStream(get_stream(stream_name, config), **kwargs)
+
+
+def close():
+    """Close every open BatchingStream, writing what they have buffered"""
+    for batching_stream in list(_open_streams):
+        batching_stream.close()
+
+atexit.register(close)
@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 import os
 import logging
 import psycopg2.pool
+import socket
 import time
 
 from triton import errors
@@ -24,6 +25,24 @@ CREATE TABLE IF NOT EXISTS triton_checkpoint (
     PRIMARY KEY (client, stream, shard))
 """
 
+CREATE_LEASE_TABLE_STMT = """
+CREATE TABLE IF NOT EXISTS triton_lease (
+    client VARCHAR(255) NOT NULL,
+    stream VARCHAR(255) NOT NULL,
+    shard VARCHAR(255) NOT NULL,
+    owner VARCHAR(255) NOT NULL,
+    counter INTEGER NOT NULL,
+    expires INTEGER NOT NULL,
+    PRIMARY KEY (client, stream, shard))
+"""
+
+# Leases not renewed within this long are up for grabs
+LEASE_DURATION_SECS = 30
+
+# Owner of the lease on a shard that's been read to the end. Its children
+# have leases of their own, and it's never claimed again.
+FINISHED_OWNER = 'SHARD_END'
+
 
 def get_triton_connection_pool():
     global postal_rds_pool
@@ -38,11 +57,12 @@ def get_triton_connection_pool():
 
 
 def init_db(db_pool_function=get_triton_connection_pool):
-    """Create the required table in DB if not already there"""
+    """Create the required tables in DB if not already there"""
     db_pool = db_pool_function()
     conn = db_pool.getconn()
     curs = conn.cursor()
     curs.execute(CREATE_TABLE_STMT)
+    curs.execute(CREATE_LEASE_TABLE_STMT)
     conn.commit()
 
 
@@ -145,3 +165,213 @@ class TritonCheckpointer(object):
             conn.commit()
         finally:
             self.db_pool.putconn(conn)
+
+
+class TritonLeaseManager(object):
+    """Coordinates which consumer reads which shards through a lease table
+
+    Every consumer of a stream sharing a client name takes leases on shards
+    and renews them by calling rebalance() more often than
+    lease_duration_secs. Leases that aren't renewed expire and are claimed by
+    the remaining consumers, and consumers with fewer than their share of
+    shards steal from the busiest one, so the fleet rebalances as nodes join,
+    leave or die.
+
+    Once a shard closed by a split or merge has been read to the end, its
+    children are leased under their own ids with claim() and the shard's
+    lease is marked finished with finish().
+
+    Every change is a conditional update on the lease's counter, so two
+    consumers can't both think they won the same lease.
+
+    Args:
+        stream_name - Stream the leases are for
+        owner - Unique name for this consumer, defaults to host and pid
+        client_name - Shared by all consumers that divide up the stream
+        lease_duration_secs - How long a lease lasts without renewal
+    """
+
+    def __init__(self, stream_name, owner=None,
+                 client_name=triton_client_name,
+                 lease_duration_secs=LEASE_DURATION_SECS):
+        if not client_name:
+            raise errors.TritonCheckpointError(
+                'client_name is required to create a TritonLeaseManager')
+        self.client_name = client_name
+        self.stream_name = stream_name
+        self.owner = owner or '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.lease_duration_secs = lease_duration_secs
+        self.db_pool = get_triton_connection_pool()
+
+        # shard_id -> counter of the leases we hold
+        self.owned_leases = {}
+
+        self.all_leases_sql = (
+            "SELECT shard, owner, counter, expires FROM triton_lease "
+            "WHERE client=%s AND stream=%s"
+        )
+
+        self.create_lease_sql = (
+            "INSERT INTO triton_lease VALUES (%s, %s, %s, %s, %s, %s)"
+        )
+
+        self.take_lease_sql = (
+            "UPDATE triton_lease SET owner=%s, counter=%s, expires=%s"
+            " WHERE client=%s AND stream=%s AND shard=%s AND counter=%s"
+        )
+
+    def _execute(self, sql, params, fetch=False):
+        """Run sql, returning the rows if fetch is set, else the row count
+
+        Returns None instead if it would break a unique constraint.
+        """
+        conn = self.db_pool.getconn()
+        try:
+            curs = conn.cursor()
+            curs.execute(sql, params)
+            if fetch:
+                result = curs.fetchall()
+            else:
+                result = curs.rowcount
+        except conn.IntegrityError:
+            # DB-API connections carry their module's exceptions, so this
+            # catches psycopg2's and sqlite3's alike
+            conn.rollback()
+            result = None
+        except Exception:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+        finally:
+            self.db_pool.putconn(conn)
+
+        return result
+
+    def leases(self):
+        """Current leases as dict of shard_id -> (owner, counter, expires)"""
+        rows = self._execute(
+            self.all_leases_sql, (self.client_name, self.stream_name),
+            fetch=True)
+        return dict((shard, (owner, counter, expires))
+                    for shard, owner, counter, expires in rows)
+
+    def _take(self, shard_id, counter):
+        """Take (or renew) a lease, provided nobody changed it since counter"""
+        expires = int(time.time() + self.lease_duration_secs)
+        if counter is None:
+            created = self._execute(
+                self.create_lease_sql,
+                (self.client_name, self.stream_name, shard_id,
+                 self.owner, 0, expires))
+            if created is None:
+                # Someone else created it first
+                return False
+            self.owned_leases[shard_id] = 0
+            return True
+
+        updated = self._execute(
+            self.take_lease_sql,
+            (self.owner, counter + 1, expires,
+             self.client_name, self.stream_name, shard_id, counter))
+        if updated != 1:
+            self.owned_leases.pop(shard_id, None)
+            return False
+
+        self.owned_leases[shard_id] = counter + 1
+        return True
+
+    def renew(self):
+        """Renew every lease we hold, dropping any we've lost"""
+        for shard_id, counter in list(self.owned_leases.items()):
+            if not self._take(shard_id, counter):
+                log.warning('Lost lease on {}-{}'.format(
+                    self.stream_name, shard_id))
+
+    def finished_shard_ids(self):
+        """Shards that have been read to the end and handed on"""
+        return set(shard_id for shard_id, (owner, _, _)
+                   in self.leases().items() if owner == FINISHED_OWNER)
+
+    def claim(self, shard_id):
+        """Take the lease on shard_id, unless another consumer holds it
+
+        Returns whether we now hold it.
+        """
+        lease = self.leases().get(shard_id)
+        if lease is not None:
+            owner, counter, expires = lease
+            if owner == FINISHED_OWNER:
+                return False
+            if owner != self.owner and expires >= time.time():
+                return False
+        return self._take(shard_id, lease[1] if lease else None)
+
+    def finish(self, shard_id):
+        """Mark our lease on a shard we've read to the end as finished"""
+        counter = self.owned_leases.pop(shard_id, None)
+        if counter is not None:
+            self._execute(
+                self.take_lease_sql,
+                (FINISHED_OWNER, counter + 1, 0,
+                 self.client_name, self.stream_name, shard_id, counter))
+
+    def release(self, shard_id):
+        """Give up a lease so another consumer can claim it right away"""
+        counter = self.owned_leases.pop(shard_id, None)
+        if counter is not None:
+            self._execute(
+                self.take_lease_sql,
+                (self.owner, counter + 1, 0,
+                 self.client_name, self.stream_name, shard_id, counter))
+
+    def rebalance(self, shard_ids):
+        """Renew, claim and steal leases to hold our share of shard_ids
+
+        Returns the set of shard ids we now hold.
+        """
+        self.renew()
+
+        now = time.time()
+        leases = self.leases()
+        owned = set(self.owned_leases)
+
+        shard_ids = [
+            shard_id for shard_id in shard_ids
+            if leases.get(shard_id, (None,))[0] != FINISHED_OWNER]
+
+        owner_counts = {self.owner: len(owned)}
+        available = []
+        for shard_id in shard_ids:
+            lease = leases.get(shard_id)
+            if lease is None or lease[2] < now:
+                if shard_id not in owned:
+                    available.append(shard_id)
+            elif lease[0] != self.owner:
+                owner_counts[lease[0]] = owner_counts.get(lease[0], 0) + 1
+
+        target = -(-len(shard_ids) // len(owner_counts))
+
+        for shard_id in available:
+            if len(self.owned_leases) >= target:
+                break
+            lease = leases.get(shard_id)
+            if self._take(shard_id, lease[1] if lease else None):
+                log.info('Claimed lease on {}-{}'.format(
+                    self.stream_name, shard_id))
+
+        # Still short, take one lease from whoever holds the most. Only one
+        # per round so the fleet converges without thrashing.
+        if len(self.owned_leases) < target:
+            busiest_owner, busiest_count = max(
+                owner_counts.items(), key=lambda owner_count: owner_count[1])
+            if busiest_owner != self.owner and busiest_count > target:
+                for shard_id in shard_ids:
+                    lease = leases.get(shard_id)
+                    if lease and lease[0] == busiest_owner:
+                        if self._take(shard_id, lease[1]):
+                            log.info('Stole lease on {}-{} from {}'.format(
+                                self.stream_name, shard_id, busiest_owner))
+                        break
+
+        return set(self.owned_leases) & set(shard_ids)
@@ -5,6 +5,7 @@ import logging
 import os
 
 from . import errors
+from .encoding import check_compression
 
 ENV_VAR_TRITON_ZMQ_HOST = 'TRITON_ZMQ_HOST'
 ENV_VAR_TRITON_ZMQ_PORT = 'TRITON_ZMQ_PORT'
@@ -15,6 +16,9 @@ log = logging.getLogger(__name__)
 
 REQUIRED_CONFIG_KEYS = ['name', 'partition_key']
 
+# Top level key for tritond's own settings rather than a stream
+TRITOND_CONFIG_KEY = 'tritond'
+
 _zmq_config = None
 
 #NOTE: when loading config dictionary, yaml automatically converts unicode
@@ -28,11 +32,16 @@ def load_config(file_name):
         return None
 
     for stream_name, v in config_dict.items():
+        if stream_name == TRITOND_CONFIG_KEY:
+            continue
+
         for k in REQUIRED_CONFIG_KEYS:
             if k not in v:
                 raise errors.InvalidConfigurationError(
                     "Missing {} : {}".format(stream_name, k))
 
+        check_compression(v.get('compression'))
+
     return config_dict
 
 
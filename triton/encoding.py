@@ -1,27 +1,148 @@
 from __future__ import unicode_literals
 import decimal
 import datetime
+import threading
+import zlib
+
+import msgpack
 import six
+import snappy
 
+from . import errors
 
-def msgpack_encode_default(obj):
-    """Extra encodings for python types into msgpack
+# Compressed payloads start with this byte, which msgpack never uses, followed
+# by a byte saying which codec was used. Anything else is plain msgpack.
+COMPRESSED_HEADER = b'\xc1'
+CODEC_ZLIB = 1
+CODEC_SNAPPY = 2
 
-    These are attempted if our normal serialization fails.
-    """
-    if isinstance(obj, decimal.Decimal):
-        return str(obj)
-    if isinstance(obj, datetime.datetime):
-        return obj.isoformat(str(' '))
-    if isinstance(obj, datetime.date):
-        return obj.strftime("%Y-%m-%d")
+COMPRESSION_CODECS = {
+    'zlib': CODEC_ZLIB,
+    'snappy': CODEC_SNAPPY,
+}
+
+_compressors = {
+    CODEC_ZLIB: zlib.compress,
+    CODEC_SNAPPY: snappy.compress,
+}
+
+_decompressors = {
+    CODEC_ZLIB: zlib.decompress,
+    CODEC_SNAPPY: snappy.decompress,
+}
+
+
+def _encode_decimal(obj):
+    return str(obj)
+
+
+def _encode_datetime(obj):
+    return obj.isoformat(str(' '))
+
+
+def _encode_date(obj):
+    return obj.strftime("%Y-%m-%d")
+
+
+def _encode_other(obj):
     if hasattr(obj, 'coords'):
         # hack to deal with lat-long points
         return repr(obj.coords)
     try:
         return repr(obj)
     except Exception:
-        raise TypeError("Unknown type: %r" % (obj,))
+        raise TypeError("Unknown type: %r" % (type(obj),))
+
+
+# Checked in order, so subclasses (datetime of date) must come first
+_DEFAULT_ENCODERS = [
+    (decimal.Decimal, _encode_decimal),
+    (datetime.datetime, _encode_datetime),
+    (datetime.date, _encode_date),
+]
+
+# type -> encoder, filled in as we meet new types
+_default_encoder_cache = {}
+
+
+def _find_default_encoder(obj_type):
+    for encoded_type, encoder in _DEFAULT_ENCODERS:
+        if issubclass(obj_type, encoded_type):
+            return encoder
+    return _encode_other
+
+
+def msgpack_encode_default(obj):
+    """Extra encodings for python types into msgpack
+
+    These are used for any type msgpack doesn't handle itself. The encoder
+    for each type is looked up once and cached.
+    """
+    obj_type = type(obj)
+    try:
+        encoder = _default_encoder_cache[obj_type]
+    except KeyError:
+        encoder = _find_default_encoder(obj_type)
+        _default_encoder_cache[obj_type] = encoder
+    return encoder(obj)
+
+
+_packers = threading.local()
+
+
+def msgpack_pack(data):
+    """Serialize data to msgpack, using msgpack_encode_default for extra types
+
+    Each thread reuses its own Packer.
+    """
+    packer = getattr(_packers, 'packer', None)
+    if packer is None:
+        packer = msgpack.Packer(default=msgpack_encode_default)
+        _packers.packer = packer
+
+    try:
+        return packer.pack(data)
+    except Exception:
+        # The packer may be left holding part of data, so don't reuse it
+        _packers.packer = None
+        raise
+
+
+def check_compression(compression):
+    """Raise InvalidConfigurationError for an unknown compression setting"""
+    if compression is not None and compression not in COMPRESSION_CODECS:
+        raise errors.InvalidConfigurationError(
+            "Unknown compression {!r}, expected one of {}".format(
+                compression, ', '.join(sorted(COMPRESSION_CODECS))))
+
+
+def compress_payload(data, compression):
+    """Compress msgpack data with the named codec, adding our header
+
+    Data that doesn't get any smaller is returned as it was.
+    """
+    if compression is None:
+        return data
+
+    codec = COMPRESSION_CODECS[compression]
+    compressed = (COMPRESSED_HEADER + six.int2byte(codec) +
+                  _compressors[codec](data))
+    if len(compressed) >= len(data):
+        return data
+    return compressed
+
+
+def decompress_payload(data):
+    """Undo compress_payload(), passing through uncompressed data"""
+    if data[:1] != COMPRESSED_HEADER:
+        return data
+
+    codec = six.indexbytes(data, 1)
+    try:
+        decompress = _decompressors[codec]
+    except KeyError:
+        raise ValueError("Unknown compression codec {}".format(codec))
+    return decompress(data[2:])
 
 
 def unicode_to_ascii_str(text):
@@ -23,6 +23,11 @@ class StreamNotConfiguredError(Error):
     pass
 
 
+class InvalidConfigurationError(Error):
+    """Indicates a config file with missing or bad settings"""
+    pass
+
+
 class ShardNotFoundError(Error):
     """Indicates the requested shard isn't known"""
     pass
@@ -38,10 +43,22 @@ class KinesisError(Error):
 
 
 class KinesisPutManyError(Error):
-    """An ambiguous or unknown Kinesis Error"""
-    def __init__(self, reason, failed_data=None, *args):
+    """An ambiguous or unknown Kinesis Error
+
+    record_errors, if known, has an (ErrorCode, ErrorMessage) for each failed
+    record in results, and None for the rest.
+    """
+    def __init__(self, reason, failed_data=None, results=None,
+                 record_errors=None, *args):
         super(KinesisPutManyError, self).__init__(reason, *args)
         self.failed_data = failed_data
+        self.results = results
+        self.record_errors = record_errors
+
+
+class PutTimeoutError(Error):
+    """Timed out waiting for the result of a BatchingStream put"""
+    pass
 
 
 class TritonCheckpointError(Error):
@@ -17,11 +17,12 @@ import struct
 import atexit
 
 import zmq
-import msgpack
 
 from . import errors
 from . import config
-from .encoding import msgpack_encode_default, unicode_to_ascii_str, ascii_to_unicode_str
+from .config import TRITOND_CONFIG_KEY
+from .encoding import msgpack_pack, unicode_to_ascii_str, ascii_to_unicode_str
+from .encoding import check_compression, compress_payload
 
 log = logging.getLogger(__name__)
 
@@ -64,11 +65,13 @@ def _thread_connect():
 
 class NonblockingStream(object):
 
-    def __init__(self, name, partition_key):
+    def __init__(self, name, partition_key, compression=None):
         self.name = name
         if len(self.name) > 64:
             raise ValueError("Stream Name Too Long")
         self.partition_key = partition_key
+        check_compression(compression)
+        self.compression = compression
         if _zmq_context is None:
             init(*config.get_zmq_config())
 
@@ -87,14 +90,8 @@ class NonblockingStream(object):
         meta_data = struct.pack(META_STRUCT_FMT, META_STRUCT_VERSION,
                                 unicode_to_ascii_str(self.name),
                                 unicode_to_ascii_str(self._partition_key(data)))
-        try:
-            message_data = msgpack.packb(data)
-        except TypeError:
-            # If we fail to serialize our context, we can try again with an
-            # enhanced packer (it's slower though)
-            message_data = msgpack.packb(data, default=msgpack_encode_default)
-
-        return meta_data, message_data
+        message_data = msgpack_pack(data)
+        return meta_data, compress_payload(message_data, self.compression)
 
     def put(self, **kwargs):
         global _zmq_context
@@ -122,10 +119,12 @@ class NonblockingStream(object):
 
 def get_nonblocking_stream(stream_name, config):
     s_config = config.get(stream_name)
-    if not s_config:
+    # tritond's own settings share the namespace, but aren't a stream
+    if not s_config or stream_name == TRITOND_CONFIG_KEY:
         raise errors.StreamNotConfiguredError()
 
-    return NonblockingStream(stream_name, s_config['partition_key'])
+    return NonblockingStream(stream_name, s_config['partition_key'],
+                             compression=s_config.get('compression'))
 
 
 def close():
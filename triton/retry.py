@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+triton.retry
+~~~~~~~~
+
+Retry policy for Kinesis calls.
+
+Retries back off with "decorrelated jitter" (see
+https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/), so
+producers that were throttled together don't all come back at the same
+moment. Throttling backs off from a longer base delay than server errors,
+since retrying quickly only makes it worse.
+
+All retries made through a RetryPolicy draw on its RetryBudget. Every call
+adds a fraction of a retry to the budget, so retries can only ever be a small
+share of traffic; once the budget runs out, failures are given up on straight
+away rather than turning an outage into a retry storm.
+
+"""
+from __future__ import unicode_literals
+import logging
+import random
+import threading
+import time
+
+from boto.exception import BotoServerError
+from boto.kinesis.exceptions import ProvisionedThroughputExceededException
+
+log = logging.getLogger(__name__)
+
+# Kinesis error codes meaning we're going too fast, whether for a whole call or
+# for individual records in a put_records response.
+THROTTLING_ERROR_CODES = set([
+    'ProvisionedThroughputExceededException',
+    'LimitExceededException',
+    'ThrottlingException',
+])
+
+# Kinesis error codes that fail the same way however often they're retried,
+# e.g. a record over the size limit or a stream that's been deleted.
+PERMANENT_ERROR_CODES = set([
+    'ValidationException',
+    'ResourceNotFoundException',
+    'InvalidArgumentException',
+])
+
+THROTTLED = 'throttled'
+SERVER_ERROR = 'server_error'
+
+MAX_RETRIES = 2
+# Records that fail individually within a put_records call get one more go
+MAX_RECORD_RETRIES = 3
+BASE_DELAY_SECS = 0.1
+THROTTLE_BASE_DELAY_SECS = 0.5
+MAX_DELAY_SECS = 5.0
+
+# Each call earns this fraction of a retry
+BUDGET_RETRY_RATIO = 0.1
+# ... and this many retries per second are always allowed
+BUDGET_MIN_RETRIES_PER_SEC = 5.0
+BUDGET_MAX_RETRIES = 50.0
+
+
+def error_kind(e):
+    """THROTTLED, SERVER_ERROR or None if the exception isn't worth retrying"""
+    # boto's Kinesis exceptions (e.g. LimitExceededException from
+    # describe_stream) leave error_code unset, so go by their class too
+    if (isinstance(e, ProvisionedThroughputExceededException) or
+            type(e).__name__ in THROTTLING_ERROR_CODES or
+            getattr(e, 'error_code', None) in THROTTLING_ERROR_CODES):
+        return THROTTLED
+    if isinstance(e, BotoServerError) and e.status // 100 == 5:
+        return SERVER_ERROR
+    return None
+
+
+class RetryBudget(object):
+    """Limits retries to a share of calls made
+
+    Args:
+        ratio - Retries earned per call
+        min_retries_per_sec - Retries earned per second regardless of calls
+        max_retries - Most retries that can be saved up
+    """
+
+    def __init__(self, ratio=BUDGET_RETRY_RATIO,
+                 min_retries_per_sec=BUDGET_MIN_RETRIES_PER_SEC,
+                 max_retries=BUDGET_MAX_RETRIES):
+        self.ratio = ratio
+        self.min_retries_per_sec = min_retries_per_sec
+        self.max_retries = max_retries
+
+        self.balance = max_retries
+        self.last_update = time.time()
+        self._lock = threading.Lock()
+
+    def _add(self, amount):
+        self.balance = min(self.max_retries, self.balance + amount)
+
+    def deposit(self):
+        with self._lock:
+            self._add(self.ratio)
+
+    def withdraw(self):
+        """Take a retry from the budget, returning False if there isn't one"""
+        with self._lock:
+            now = time.time()
+            self._add((now - self.last_update) * self.min_retries_per_sec)
+            self.last_update = now
+
+            if self.balance < 1.0:
+                return False
+            self.balance -= 1.0
+            return True
+
+
+class RetryPolicy(object):
+    """Decides whether and when to retry failed Kinesis calls
+
+    Usage:
+
+        resp = policy.call(conn.put_record, stream_name, data, partition_key)
+
+    Counters for what the policy has done are in counters.
+
+    Args:
+        max_retries - Most times to retry one call
+        max_record_retries - Most times to resend records that failed on their
+            own in a put_records response
+        base_delay_secs - Shortest wait before retrying a server error
+        throttle_base_delay_secs - Shortest wait before retrying after being
+            throttled
+        max_delay_secs - Longest wait before any retry
+        budget - RetryBudget() shared with other policies, by default the
+            process wide one
+    """
+
+    def __init__(self, max_retries=MAX_RETRIES,
+                 max_record_retries=MAX_RECORD_RETRIES,
+                 base_delay_secs=BASE_DELAY_SECS,
+                 throttle_base_delay_secs=THROTTLE_BASE_DELAY_SECS,
+                 max_delay_secs=MAX_DELAY_SECS, budget=None):
+        self.max_retries = max_retries
+        self.max_record_retries = max_record_retries
+        self.base_delay_secs = base_delay_secs
+        self.throttle_base_delay_secs = throttle_base_delay_secs
+        self.max_delay_secs = max_delay_secs
+        self.budget = budget if budget is not None else default_budget
+
+        self.counters = {
+            'calls': 0,
+            'retries': 0,
+            THROTTLED: 0,
+            SERVER_ERROR: 0,
+            'give_ups': 0,
+            'budget_exhausted': 0,
+        }
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def record_call(self):
+        """Note a call was made, earning retry budget"""
+        self._count('calls')
+        self.budget.deposit()
+
+    def should_retry(self, retries, kind, max_retries=None):
+        """Whether to make retry number retries + 1 after a kind of failure
+
+        max_retries defaults to the policy's max_retries.
+        """
+        if kind is None:
+            return False
+        if max_retries is None:
+            max_retries = self.max_retries
+
+        self._count(kind)
+        if retries >= max_retries:
+            self._count('give_ups')
+            return False
+        if not self.budget.withdraw():
+            log.warning("Retry budget exhausted, not retrying %s", kind)
+            self._count('budget_exhausted')
+            self._count('give_ups')
+            return False
+
+        self._count('retries')
+        return True
+
+    def next_delay(self, last_delay, kind):
+        """Decorrelated jitter: random, but growing from the last delay"""
+        if kind == THROTTLED:
+            base = self.throttle_base_delay_secs
+        else:
+            base = self.base_delay_secs
+
+        upper = max(base, (last_delay or base) * 3)
+        return min(self.max_delay_secs, random.uniform(base, upper))
+
+    def call(self, func, *args, **kwargs):
+        """Call func, retrying throttling and server errors"""
+        retries = 0
+        delay = None
+        while True:
+            self.record_call()
+            try:
+                return func(*args, **kwargs)
+            except BotoServerError as e:
+                kind = error_kind(e)
+                if not self.should_retry(retries, kind):
+                    raise
+
+                delay = self.next_delay(delay, kind)
+                log.info("Retrying %s after %.2fs (%s)",
+                         getattr(func, '__name__', func), delay, kind)
+                time.sleep(delay)
+                retries += 1
+
+
+# Shared by all RetryPolicy() that aren't given their own budget
+default_budget = RetryBudget()
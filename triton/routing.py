@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+triton.routing
+~~~~~~~~
+
+Client side shard routing and rate limiting for producers.
+
+Kinesis picks a record's shard by the MD5 of its partition key, which falls
+in exactly one open shard's hash key range. Knowing that, a producer can keep
+each shard under its write limits (1MB and 1000 records per second) itself,
+rather than sending blind and backing off when Kinesis throttles it. Hot
+shards are smoothed out while writes to the others carry on at full speed.
+
+"""
+from __future__ import unicode_literals
+import bisect
+import hashlib
+import logging
+import threading
+import time
+
+import six
+
+log = logging.getLogger(__name__)
+
+# Kinesis write limits per shard
+SHARD_MAX_BYTES_PER_SEC = 1024 * 1024
+SHARD_MAX_RECORDS_PER_SEC = 1000
+
+# How often to pick up shard splits and merges
+SHARD_MAP_REFRESH_SECS = 60.0
+
+
+def hash_key(partition_key):
+    """The 128 bit hash key Kinesis assigns to a partition key"""
+    if isinstance(partition_key, six.text_type):
+        partition_key = partition_key.encode('utf-8')
+    return int(hashlib.md5(partition_key).hexdigest(), 16)
+
+
+class ShardMap(object):
+    """Maps partition keys to the open shard that will receive them
+
+    Args:
+        shards - Shard descriptions, as in Stream.shards
+    """
+
+    def __init__(self, shards):
+        ranges = []
+        for shard in shards:
+            if 'EndingSequenceNumber' in shard.get('SequenceNumberRange', {}):
+                # Closed by a split or merge, no longer takes writes
+                continue
+            hash_range = shard['HashKeyRange']
+            ranges.append((int(hash_range['StartingHashKey']),
+                           int(hash_range['EndingHashKey']),
+                           shard['ShardId']))
+
+        ranges.sort()
+        self._starts = [start for start, _, _ in ranges]
+        self._ranges = ranges
+
+    def shard_id(self, partition_key):
+        """Shard that a record with this partition key will be written to
+
+        Returns None if no open shard covers it, which can only happen while
+        the map is out of date.
+        """
+        key = hash_key(partition_key)
+        idx = bisect.bisect_right(self._starts, key) - 1
+        if idx < 0:
+            return None
+
+        _, end, shard_id = self._ranges[idx]
+        if key > end:
+            return None
+        return shard_id
+
+
+class RefreshingShardMap(object):
+    """ShardMap for a stream, reloaded every refresh_secs
+
+    Shards are loaded with the stream's retry policy. If a reload still fails,
+    the map we have is kept until the next refresh is due; only the first
+    load raises.
+
+    Args:
+        stream - Instance of Stream()
+        refresh_secs - How often to reload the stream's shards
+    """
+
+    def __init__(self, stream, refresh_secs=SHARD_MAP_REFRESH_SECS):
+        self.stream = stream
+        self.refresh_secs = refresh_secs
+
+        self._shard_map = None
+        self._shard_map_time = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._shard_map is None:
+                shards = self.stream.retry_policy.call(
+                    lambda: self.stream.shards)
+                self._shard_map = ShardMap(shards)
+                self._shard_map_time = time.time()
+            elif time.time() - self._shard_map_time > self.refresh_secs:
+                try:
+                    # Not through stream.refresh_shards(), the stream's
+                    # iterators rely on the shards it has cached
+                    shards = self.stream.retry_policy.call(
+                        self.stream._describe_shards)
+                    self._shard_map = ShardMap(shards)
+                except Exception:
+                    log.warning("Failed to reload shards for %s, keeping"
+                                " the current map", self.stream.name,
+                                exc_info=True)
+                self._shard_map_time = time.time()
+
+            return self._shard_map
+
+
+class TokenBucket(object):
+    """Allows rate units per second, with bursts of up to capacity
+
+    Tokens are reserved rather than waited for: take() always succeeds,
+    possibly leaving the bucket in debt, and returns how long the caller should
+    wait before acting so the rate is respected. This keeps concurrent callers
+    fair and lets requests bigger than capacity through.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.last_update = time.time()
+        self._lock = threading.Lock()
+
+    def take(self, amount):
+        """Reserve amount tokens, returning the seconds to wait before use"""
+        with self._lock:
+            now = time.time()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.last_update) * self.rate)
+            self.last_update = now
+
+            self.tokens -= amount
+            if self.tokens >= 0.0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class ShardRateLimiter(object):
+    """Holds writes to a stream to each shard's write limits
+
+    Usage:
+
+        limiter.wait([(partition_key, size), ...])
+        stream.conn.put_records(...)
+
+    Args:
+        stream - Instance of Stream()
+        max_bytes_per_sec, max_records_per_sec - Limits for each shard
+        refresh_secs - How often to reload the stream's shards
+        shard_map - RefreshingShardMap to share, rather than loading the
+            stream's shards separately. refresh_secs is ignored if given.
+    """
+
+    def __init__(self, stream, max_bytes_per_sec=SHARD_MAX_BYTES_PER_SEC,
+                 max_records_per_sec=SHARD_MAX_RECORDS_PER_SEC,
+                 refresh_secs=SHARD_MAP_REFRESH_SECS, shard_map=None):
+        self.stream = stream
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self.max_records_per_sec = max_records_per_sec
+        self.refresh_secs = refresh_secs
+
+        if shard_map is None:
+            shard_map = RefreshingShardMap(stream, refresh_secs)
+        self._shard_map = shard_map
+        # shard_id -> (bytes TokenBucket, records TokenBucket)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    @property
+    def shard_map(self):
+        return self._shard_map.get()
+
+    def _shard_buckets(self, shard_id):
+        with self._lock:
+            buckets = self._buckets.get(shard_id)
+            if buckets is None:
+                buckets = (TokenBucket(self.max_bytes_per_sec),
+                           TokenBucket(self.max_records_per_sec))
+                self._buckets[shard_id] = buckets
+            return buckets
+
+    def delay(self, records):
+        """Reserve capacity for records, returning how long to wait
+
+        Args:
+            records - list() of (partition_key, size in bytes)
+        """
+        shard_map = self.shard_map
+
+        shard_usage = {}
+        for partition_key, size in records:
+            shard_id = shard_map.shard_id(partition_key)
+            num_bytes, num_records = shard_usage.get(shard_id, (0, 0))
+            shard_usage[shard_id] = (num_bytes + size, num_records + 1)
+
+        wait_secs = 0.0
+        for shard_id, (num_bytes, num_records) in shard_usage.items():
+            if shard_id is None:
+                continue
+
+            byte_bucket, record_bucket = self._shard_buckets(shard_id)
+            wait_secs = max(wait_secs,
+                            byte_bucket.take(num_bytes),
+                            record_bucket.take(num_records))
+
+        return wait_secs
+
+    def wait(self, records):
+        """Block until records can be written without exceeding any limits"""
+        wait_secs = self.delay(records)
+        if wait_secs > 0.0:
+            log.debug("Holding %d records for %s for %.2fs",
+                      len(records), self.stream.name, wait_secs)
+            time.sleep(wait_secs)
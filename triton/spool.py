@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+triton.spool
+~~~~~~~~
+
+Disk backed write-ahead spool of records waiting to go to Kinesis.
+
+Records are appended to segment files, each a memory mapped file of
+length-prefixed, checksummed entries that's periodically synced to disk. A
+segment is deleted once it's full and every record in it has been written to
+Kinesis. Records that failed to be written are replayed from their segment,
+until they've failed max_attempts times. So are whole segments left behind by
+a crash or an unclean shutdown, so records are delivered at least once:
+records in those that had already been written are written again.
+
+Usage:
+
+    spool = Spool('/var/spool/tritond')
+    entry_id = spool.append(stream_name, partition_key, data)
+    ...
+    # Once the record has been written, or with ok=False if that failed
+    given_up = spool.done([entry_id], ok=True)
+
+    for entry_id, stream_name, partition_key, data in spool.replay():
+        ...
+
+"""
+from __future__ import unicode_literals
+import collections
+import heapq
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+import msgpack
+
+log = logging.getLogger(__name__)
+
+SEGMENT_SIZE = 16 * 1024 * 1024
+FSYNC_INTERVAL_SECS = 1.0
+
+# How long to wait before retrying a segment that failed to be written
+REPLAY_DELAY_SECS = 30.0
+
+# Longest a segment with failed records stays open for appends, so they're
+# replayed even if it doesn't fill up
+SEGMENT_ROLL_SECS = 10.0
+
+# Times a record may fail to be written before we give up on it
+MAX_ATTEMPTS = 50
+
+# Each entry is its length and the crc32 of its payload, then the payload. A
+# zero length marks the end of a segment's entries.
+ENTRY_HEADER_FMT = b'>II'
+ENTRY_HEADER_SIZE = struct.calcsize(ENTRY_HEADER_FMT)
+
+SEGMENT_FILE_RE = re.compile(r'^segment-(\d+)\.spool$')
+
+
+def segment_file_name(segment_id):
+    return 'segment-{:020d}.spool'.format(segment_id)
+
+
+def pack_entry(stream_name, partition_key, data):
+    payload = msgpack.packb(
+        [stream_name, partition_key, data], use_bin_type=True)
+    header = struct.pack(
+        ENTRY_HEADER_FMT, len(payload), zlib.crc32(payload) & 0xffffffff)
+    return header + payload
+
+
+def read_entries(buf):
+    """Yields (offset, stream_name, partition_key, data) for each entry in buf
+
+    Stops at the end of the entries, or at the first one that's incomplete or
+    corrupt, as the last can be if we crashed while writing it.
+    """
+    offset = 0
+    while offset + ENTRY_HEADER_SIZE <= len(buf):
+        length, crc = struct.unpack_from(ENTRY_HEADER_FMT, buf, offset)
+        if length == 0:
+            return
+
+        start = offset + ENTRY_HEADER_SIZE
+        payload = buf[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+            log.warning("Spool entry at offset %d is corrupt, skipping the "
+                        "rest of the segment", offset)
+            return
+
+        stream_name, partition_key, data = msgpack.unpackb(
+            payload, encoding='utf-8')
+        yield offset, stream_name, partition_key, data
+        offset = start + length
+
+
+class _Segment(object):
+    """State of one segment file"""
+
+    def __init__(self, segment_id):
+        self.segment_id = segment_id
+        # Records waiting to be written or being written
+        self.pending = 0
+        # Offsets of records that failed to be written, or None for all of
+        # them
+        self.failed = set()
+        # Times each record has failed to be written, by offset
+        self.attempts = collections.Counter()
+        # When a record in it first failed, while it's still active
+        self.failed_since = None
+        # No more records will be appended
+        self.sealed = False
+        # When it became ready to be replayed
+        self.replay_after = None
+
+
+class Spool(object):
+    """Append-only, disk backed spool of records
+
+    Safe to use from several threads.
+
+    Args:
+        path - Directory to keep segment files in, created if needed.
+            Segments already there are replayed.
+        segment_size - Size of each segment file
+        fsync_interval_secs - How often maybe_sync() writes to disk
+        replay_delay_secs - How long after a failure to replay a segment
+        segment_roll_secs - Longest the segment being appended to stays open
+            once a record in it has failed
+        max_attempts - Times a record may fail before done() gives up on it
+    """
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE,
+                 fsync_interval_secs=FSYNC_INTERVAL_SECS,
+                 replay_delay_secs=REPLAY_DELAY_SECS,
+                 segment_roll_secs=SEGMENT_ROLL_SECS,
+                 max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync_interval_secs = fsync_interval_secs
+        self.replay_delay_secs = replay_delay_secs
+        self.segment_roll_secs = segment_roll_secs
+        self.max_attempts = max_attempts
+
+        self._segments = {}
+        # Heap of (replay_after, segment id) of segments waiting to be
+        # replayed
+        self._replayable = []
+        self._lock = threading.Lock()
+
+        self._active = None
+        self._active_file = None
+        self._active_map = None
+        self._active_offset = 0
+        self._last_sync = time.time()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        next_id = 0
+        for segment_id in self._existing_segment_ids():
+            segment = _Segment(segment_id)
+            segment.sealed = True
+            segment.failed = None
+            segment.replay_after = 0.0
+            self._segments[segment_id] = segment
+            heapq.heappush(self._replayable, (0.0, segment_id))
+            next_id = segment_id + 1
+
+        if self._replayable:
+            log.info("Found %d spool segments to replay",
+                     len(self._replayable))
+
+        self._next_id = next_id
+
+    def _existing_segment_ids(self):
+        segment_ids = []
+        for file_name in os.listdir(self.path):
+            match = SEGMENT_FILE_RE.match(file_name)
+            if match:
+                segment_ids.append(int(match.group(1)))
+        return sorted(segment_ids)
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self.path, segment_file_name(segment_id))
+
+    def _open_segment(self, min_size):
+        segment_id = self._next_id
+        self._next_id += 1
+
+        size = max(self.segment_size, min_size + ENTRY_HEADER_SIZE)
+        f = open(self._segment_path(segment_id), 'w+b')
+        f.truncate(size)
+
+        self._active = _Segment(segment_id)
+        self._segments[segment_id] = self._active
+        self._active_file = f
+        self._active_map = mmap.mmap(f.fileno(), size)
+        self._active_offset = 0
+
+    def _close_active(self):
+        if self._active is None:
+            return
+
+        self._active_map.flush()
+        self._active_map.close()
+        self._active_file.close()
+
+        segment = self._active
+        self._active = None
+        self._active_file = None
+        self._active_map = None
+
+        segment.sealed = True
+        segment.failed_since = None
+        self._maybe_finish(segment)
+
+    def _maybe_roll_active(self):
+        """Close the active segment if its failed records have waited long
+        enough to be replayed
+        """
+        if (self._active is not None and
+                self._active.failed_since is not None and
+                time.time() - self._active.failed_since >=
+                self.segment_roll_secs):
+            self._close_active()
+
+    def _maybe_finish(self, segment):
+        """Delete or queue for replay a sealed segment with nothing pending"""
+        if not segment.sealed or segment.pending > 0:
+            return
+
+        if segment.failed is None or segment.failed:
+            segment.replay_after = time.time() + self.replay_delay_secs
+            heapq.heappush(self._replayable,
+                           (segment.replay_after, segment.segment_id))
+        else:
+            del self._segments[segment.segment_id]
+            try:
+                os.unlink(self._segment_path(segment.segment_id))
+            except OSError:
+                log.exception("Failed to remove spool segment %d",
+                              segment.segment_id)
+
+    def append(self, stream_name, partition_key, data):
+        """Write a record to the spool, returning its entry id
+
+        Entry ids are (segment id, offset).
+        """
+        entry = pack_entry(stream_name, partition_key, data)
+
+        with self._lock:
+            self._maybe_roll_active()
+            if (self._active is None or self._active_offset + len(entry) >
+                    len(self._active_map)):
+                self._close_active()
+                self._open_segment(len(entry))
+
+            entry_id = (self._active.segment_id, self._active_offset)
+            end = self._active_offset + len(entry)
+            self._active_map[self._active_offset:end] = entry
+            self._active_offset = end
+
+            self._active.pending += 1
+            return entry_id
+
+    def done(self, entry_ids, ok=True):
+        """Mark records as written, or as failed to be written
+
+        Args:
+            entry_ids - Entry ids from append() or replay()
+            ok - False if the records weren't written, so they're replayed
+
+        Returns:
+            list() of the entry ids that have now failed max_attempts times,
+            so won't be replayed
+        """
+        offsets = collections.defaultdict(list)
+        for segment_id, offset in entry_ids:
+            offsets[segment_id].append(offset)
+
+        given_up = []
+        with self._lock:
+            for segment_id, segment_offsets in offsets.items():
+                segment = self._segments.get(segment_id)
+                if segment is None:
+                    continue
+
+                segment.pending -= len(segment_offsets)
+                for offset in segment_offsets:
+                    if ok:
+                        segment.attempts.pop(offset, None)
+                        continue
+
+                    segment.attempts[offset] += 1
+                    if segment.attempts[offset] >= self.max_attempts:
+                        del segment.attempts[offset]
+                        given_up.append((segment_id, offset))
+                    else:
+                        segment.failed.add(offset)
+
+                if (segment is self._active and segment.failed and
+                        segment.failed_since is None):
+                    # Replayed once it fills up, or _maybe_roll_active()
+                    # closes it
+                    segment.failed_since = time.time()
+                self._maybe_finish(segment)
+
+        if given_up:
+            log.error("Giving up on %d spooled records after %d attempts",
+                      len(given_up), self.max_attempts)
+        return given_up
+
+    def replay(self):
+        """Records to replay from the next segment ready for it, if any
+
+        Only records that failed are replayed, or every record for a segment
+        left from before we started. They're pending again, so pass their
+        entry ids to done() once written.
+
+        Returns:
+            list() of (entry id, stream_name, partition_key, data)
+        """
+        with self._lock:
+            self._maybe_roll_active()
+            if (not self._replayable or
+                    self._replayable[0][0] > time.time()):
+                return []
+
+            _, segment_id = heapq.heappop(self._replayable)
+            segment = self._segments[segment_id]
+            with open(self._segment_path(segment.segment_id), 'rb') as f:
+                records = [
+                    ((segment_id, offset), stream_name, partition_key, data)
+                    for offset, stream_name, partition_key, data
+                    in read_entries(f.read())
+                    if segment.failed is None or offset in segment.failed]
+
+            log.info("Replaying %d records from spool segment %d",
+                     len(records), segment.segment_id)
+            segment.failed = set()
+            segment.pending += len(records)
+            self._maybe_finish(segment)
+            return records
+
+    def sync(self):
+        """Write everything appended so far to disk"""
+        with self._lock:
+            if self._active_map is not None:
+                self._active_map.flush()
+            self._last_sync = time.time()
+
+    def maybe_sync(self):
+        if time.time() - self._last_sync >= self.fsync_interval_secs:
+            self.sync()
+
+    def close(self):
+        """Sync and stop appending
+
+        Anything not yet written stays on disk, to be replayed by the next
+        Spool() on the same path.
+        """
+        with self._lock:
+            self._close_active()
@@ -11,7 +11,7 @@ import msgpack
 import snappy
 import boto.s3
 from boto.s3.connection import OrdinaryCallingFormat
-from .encoding import ascii_to_unicode_str, unicode_to_ascii_str
+from .encoding import ascii_to_unicode_str, unicode_to_ascii_str, msgpack_pack
 
 MAX_BUFFER_SIZE = 1024 * 1024
 
@@ -37,7 +37,7 @@ class StreamArchiveWriter(object):
         return os.path.join(self.base_path, date_str, file_name)
 
     def put(self, **kwargs):
-        data = msgpack.packb(kwargs)
+        data = msgpack_pack(kwargs)
 
         self.buffer.write(data)
 
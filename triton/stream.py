@@ -1,21 +1,59 @@
 from __future__ import unicode_literals
 import base64
+import collections
 import time
 import logging
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
 
+import six
+from six.moves import queue
 import msgpack
 import boto.kinesis.layer1
+from boto.exception import JSONResponseError
 from boto.kinesis.exceptions import ProvisionedThroughputExceededException
-from boto.exception import BotoServerError
 import boto.regioninfo
 
+from triton import aggregation
 from triton import errors
-from triton.checkpoint import TritonCheckpointer
-from triton.encoding import msgpack_encode_default, unicode_to_ascii_str, ascii_to_unicode_str
+from triton import retry
+from triton.routing import RefreshingShardMap, ShardRateLimiter
+from triton.checkpoint import TritonCheckpointer, TritonLeaseManager
+from triton.config import TRITOND_CONFIG_KEY
+from triton.encoding import (
+    msgpack_pack, unicode_to_ascii_str, ascii_to_unicode_str)
+from triton.encoding import (
+    check_compression, compress_payload, decompress_payload)
 
 MIN_POLL_INTERVAL_SECS = 1.0
+# Kinesis allows 5 GetRecords calls per second per shard, which is how fast we
+# poll a shard that is behind latest.
+BEHIND_POLL_INTERVAL_SECS = 0.2
+# Shards that keep coming back empty back off up to this interval
+MAX_POLL_INTERVAL_SECS = 4.0
 KINESIS_MAX_LENGTH = 500  # Can't write more than 500 records at a time
-KINESIS_MAX_RETRYS = 2  # Kinesis 'InternalFailure' retry attempts
+KINESIS_MAX_PUT_BYTES = 5 * 1024 * 1024  # ... or more than 5MB at a time
+KINESIS_MAX_RECORD_BYTES = 1024 * 1024  # Data plus partition key
+KINESIS_MAX_GET_RECORDS = 10000  # Most records one get_records can return
+
+# How many put_records calls a Stream makes at once when a batch needs several.
+# More than one loses the order of records with the same partition key across
+# the calls, so it's opt-in.
+PUT_CONCURRENCY = 1
+
+# A StreamIterator's prefetch thread exits after this long with nothing to
+# fetch, and is started again when next needed. Well over
+# MAX_POLL_INTERVAL_SECS, so busy iterators keep theirs.
+PREFETCH_THREAD_IDLE_SECS = 30.0
+
+# How many records each shard worker of a ParallelCombinedStreamIterator will
+# hold ready before it stops fetching and waits for the consumer.
+MAX_QUEUED_RECORDS_PER_SHARD = 10000
+
+# How often a LeasedCombinedStreamIterator renews and rebalances its leases.
+# Must be well under checkpoint.LEASE_DURATION_SECS.
+LEASE_RENEW_INTERVAL_SECS = 10.0
 
 ITER_TYPE_LATEST = 'LATEST'
 ITER_TYPE_ALL = 'TRIM_HORIZON'
@@ -25,27 +63,144 @@ ITER_TYPE_FROM_CHECKPOINT = 'FROM_CHECKPOINT'
 log = logging.getLogger(__name__)
 
 
+# Marks Record data that hasn't been unpacked yet (None is a valid payload)
+_UNDECODED = object()
+
+
 class Record(object):
-    __slots__ = ['shard_id', 'seq_num', 'data']
+    """A single record read from a shard
+
+    Records read from Kinesis keep the payload as it came off the wire; it is
+    only base64 decoded when raw_data is accessed, and only unpacked when data
+    is accessed. Consumers that route on shard_id/seq_num or pass raw_data
+    along never pay for decoding.
+
+    Records that were written as part of an aggregated Kinesis record (see
+    triton.aggregation) share their seq_num, and are told apart by
+    sub_seq_num. It's None for records written on their own.
+    """
+    __slots__ = ['shard_id', 'seq_num', 'sub_seq_num', 'num_sub_records',
+                 '_data', '_raw_data', '_encoded_data']
 
-    def __init__(self, shard_id, seq_num, data):
+    def __init__(self, shard_id, seq_num, data=_UNDECODED, raw_data=None,
+                 encoded_data=None, sub_seq_num=None, num_sub_records=None):
         self.shard_id = shard_id
         self.seq_num = seq_num
-        self.data = data
+        self.sub_seq_num = sub_seq_num
+        self.num_sub_records = num_sub_records
+        self._data = data
+        self._raw_data = raw_data
+        self._encoded_data = encoded_data
+
+    @property
+    def raw_data(self):
+        """The msgpack encoded payload, decompressed if it was compressed"""
+        if self._raw_data is None and self._encoded_data is not None:
+            self._raw_data = base64.b64decode(self._encoded_data)
+            self._encoded_data = None
+        if self._raw_data is not None:
+            self._raw_data = decompress_payload(self._raw_data)
+        return self._raw_data
+
+    @property
+    def ends_seq_num(self):
+        """Whether this is the last record sharing its seq_num
+
+        Only then is it safe to checkpoint at seq_num; a restart from there
+        would skip the rest of an aggregate.
+        """
+        return (self.sub_seq_num is None or
+                self.sub_seq_num == self.num_sub_records - 1)
+
+    @property
+    def size(self):
+        """Size of the payload in bytes, without decoding it"""
+        if self._raw_data is not None:
+            return len(self._raw_data)
+        if self._encoded_data is not None:
+            return len(self._encoded_data) * 3 // 4
+        return 0
+
+    @property
+    def data(self):
+        if self._data is _UNDECODED:
+            self._data = self._unpack_record_data(self.raw_data)
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    @classmethod
+    def _unpack_record_data(cls, raw_data):
+        return msgpack.unpackb(raw_data, encoding='utf-8')
 
     @classmethod
     def _decode_record_data(cls, record_data):
-        return msgpack.unpackb(base64.b64decode(record_data), encoding='utf-8')
+        return cls._unpack_record_data(
+            decompress_payload(base64.b64decode(record_data)))
 
     @classmethod
-    def from_raw_record(cls, shard_id, raw_record):
+    def from_raw_record(cls, shard_id, raw_record, b64_encoded=True):
+        """Build a Record from a get_records response entry
+
+        Args:
+            shard_id - Shard the record was read from
+            raw_record - dict with 'SequenceNumber' and 'Data'
+            b64_encoded - False if the transport already decoded 'Data' (for
+                example get_records(..., b64_decode=True))
+        """
+        if b64_encoded:
+            return cls(shard_id, raw_record['SequenceNumber'],
+                       encoded_data=raw_record['Data'])
         return cls(shard_id, raw_record['SequenceNumber'],
-                   cls._decode_record_data(raw_record['Data']))
+                   raw_data=raw_record['Data'])
+
+    @classmethod
+    def list_from_raw_record(cls, shard_id, raw_record, b64_encoded=True):
+        """Like from_raw_record(), but returns a list of Records
+
+        Aggregated records are expanded into the records they contain; any
+        other record comes back as a list of one.
+        """
+        data = raw_record['Data']
+        if b64_encoded:
+            # The magic number is in the first 6 base64 characters, so only
+            # decode the whole thing if it's there.
+            if not aggregation.is_aggregated(base64.b64decode(data[:8])):
+                return [cls.from_raw_record(shard_id, raw_record)]
+            data = base64.b64decode(data)
+
+        sub_records = aggregation.deaggregate(data)
+        if sub_records is None:
+            return [cls.from_raw_record(shard_id, raw_record, b64_encoded)]
+
+        seq_num = raw_record['SequenceNumber']
+        return [
+            cls(shard_id, seq_num, raw_data=sub_data, sub_seq_num=n,
+                num_sub_records=len(sub_records))
+            for n, (_, sub_data) in enumerate(sub_records)
+        ]
 
     def __repr__(self):
+        if self.sub_seq_num is not None:
+            return u'<Record {} {}:{}>'.format(
+                self.shard_id, self.seq_num, self.sub_seq_num)
         return u'<Record {} {}>'.format(self.shard_id, self.seq_num)
 
 
+def _checkpoint_seq_num(records, seq_num):
+    """The seq_num to checkpoint once records have been handed out
+
+    That's the last one they finish, or seq_num if they're all part of an
+    aggregate that isn't finished yet.
+    """
+    for rec in reversed(records):
+        if rec.ends_seq_num:
+            return rec.seq_num
+    return seq_num
+
+
 class StreamIterator(object):
     """Handles the workflow of reading from a shard
 
@@ -57,24 +212,45 @@ class StreamIterator(object):
         fallback_iterator_type - For 'AFTER_SEQUENCE_NUMBER', if there is no
             checkpoint availible, create an iterator with this iterator_type
             instead
+        limit - Most records to ask for per get_records call, None for the
+            Kinesis maximum
+        prefetch - Keep the next get_records call in flight from a background
+            thread while the current page is being processed
     """
 
     def __init__(
         self, stream, shard_id, iterator_type,
-        seq_num=None, fallback_iterator_type=ITER_TYPE_ALL
+        seq_num=None, fallback_iterator_type=ITER_TYPE_ALL, limit=None,
+        prefetch=False
     ):
         self.stream = stream
         self.shard_id = shard_id
         self.iterator_type = iterator_type
         self.seq_num = seq_num
         self.fallback_iterator_type = fallback_iterator_type
+        self.limit = limit
+        self.prefetch = prefetch
+        self.from_checkpoint = iterator_type == ITER_TYPE_FROM_CHECKPOINT
 
         self._iter_value = None
-        self.records = []
+        self.records = collections.deque()
+
+        # Set once Kinesis stops giving us a next iterator, meaning the shard
+        # was closed by a split or merge.
+        self.closed = False
 
         self._empty = True
         self.behind_latest_secs = None
 
+        # The in flight _PrefetchedPage, if prefetching, and the _Prefetcher
+        # making it
+        self._prefetched = None
+        self._prefetcher = None
+
+        # When this shard should next be polled, see _schedule_next_poll()
+        self.poll_interval_secs = MIN_POLL_INTERVAL_SECS
+        self.next_poll_time = 0.0
+
         self._checkpointer = None
         self.last_seq_num = None
 
@@ -109,9 +285,38 @@ class StreamIterator(object):
 
         return self._iter_value
 
-    def fill(self):
+    def _schedule_next_poll(self, poll_start, num_records, throttled=False):
+        """Decide when this shard is worth polling again
+
+        Shards that are behind latest are read again as soon as Kinesis allows,
+        shards returning records are read at the normal poll interval, and
+        empty or throttled shards back off exponentially. Throttling backs off
+        even for a shard that's behind, as that's when it's most likely.
+        """
+        if throttled:
+            self.poll_interval_secs = min(
+                max(self.poll_interval_secs * 2, MIN_POLL_INTERVAL_SECS),
+                MAX_POLL_INTERVAL_SECS)
+        elif self.behind_latest_secs:
+            self.poll_interval_secs = BEHIND_POLL_INTERVAL_SECS
+        elif num_records:
+            self.poll_interval_secs = MIN_POLL_INTERVAL_SECS
+        else:
+            self.poll_interval_secs = min(
+                max(self.poll_interval_secs * 2, MIN_POLL_INTERVAL_SECS),
+                MAX_POLL_INTERVAL_SECS)
+
+        self.next_poll_time = poll_start + self.poll_interval_secs
+
+    def _get_records(self, iter_value):
+        """Call get_records, returning (poll_start, response)
+
+        response is None if we were throttled.
+        """
+        poll_start = time.time()
         try:
-            record_resp = self.stream.conn.get_records(self.iter_value,
+            record_resp = self.stream.conn.get_records(iter_value,
+                                                       limit=self.limit,
                                                        b64_decode=False)
         except ProvisionedThroughputExceededException:
             # We set our poll interval to be conservative (and match
@@ -121,30 +326,82 @@ class StreamIterator(object):
             # complain loudly.
             log.error("Rate exceeded for %r:%r", self.stream.name,
                       self.shard_id)
+            return poll_start, None
+
+        return poll_start, record_resp
+
+    def _start_prefetch(self):
+        if self.prefetch and not self.closed:
+            if self._prefetcher is None:
+                self._prefetcher = _Prefetcher(self)
+            self._prefetched = self._prefetcher.fetch(
+                self._iter_value, self.next_poll_time)
+
+    def start_prefetch(self, budget, pending_records=0, pending_bytes=0):
+        """Prefetch the next page if it fits in budget (a PrefetchBudget)
+
+        For callers that fill with prefetch=False so they can account for the
+        page they got first. pending_records and pending_bytes are records
+        they hold that aren't added to budget.
+        """
+        if budget.has_room(pending_records, pending_bytes):
+            self.limit = budget.page_limit(pending_records, pending_bytes)
+            self._start_prefetch()
+
+    def fill(self, prefetch=True):
+        """Fetch the next page of records into the buffer
+
+        With prefetch=False, no prefetch is started for the page after this
+        one, leaving that to start_prefetch().
+        """
+        if self.closed:
+            raise errors.EndOfShardError()
+
+        if self._prefetched is not None:
+            prefetched, self._prefetched = self._prefetched, None
+            poll_start, record_resp = prefetched.result()
+        else:
+            poll_start, record_resp = self._get_records(self.iter_value)
+
+        if record_resp is None:
+            self._schedule_next_poll(poll_start, 0, throttled=True)
+            if prefetch:
+                self._start_prefetch()
             return
 
         behind_latest_secs = record_resp['MillisBehindLatest'] / 1000.0
         log.debug("Found %d records filling %r (behind %d secs)",
                   len(record_resp['Records']), self, int(behind_latest_secs))
 
-        if self.behind_latest_secs > 0.0 and behind_latest_secs == 0:
+        if self.behind_latest_secs and behind_latest_secs == 0:
             log.info("%r has caught up with latest", self)
 
         if self.behind_latest_secs is None:
             log.info("%r behind latest by %ds", self, behind_latest_secs)
 
         self.behind_latest_secs = behind_latest_secs
+        self._schedule_next_poll(poll_start, len(record_resp['Records']))
 
-        for rec in record_resp['Records']:
-            self.records.append(Record.from_raw_record(self.shard_id, rec))
+        if record_resp['Records']:
+            for rec in record_resp['Records']:
+                self.records.extend(
+                    Record.list_from_raw_record(self.shard_id, rec))
             self._empty = False
 
         if record_resp.get('NextShardIterator'):
             self._iter_value = record_resp['NextShardIterator']
         else:
             # If a next iterator isn't provided, it probably indicates the
-            # shard has be ended due to split or merge.
-            raise errors.EndOfShardError()
+            # shard has be ended due to split or merge. Any records we just
+            # got are still handed out; the next fill will raise, and since
+            # that doesn't call Kinesis there's no need to wait for it.
+            self.closed = True
+            self.next_poll_time = poll_start
+            if not record_resp['Records']:
+                raise errors.EndOfShardError()
+
+        if prefetch:
+            self._start_prefetch()
 
     def __iter__(self):
         return self
@@ -154,62 +411,320 @@ class StreamIterator(object):
             self.fill()
 
         try:
-            rec = self.records.pop(0)
-            self.last_seq_num = rec.seq_num
+            rec = self.records.popleft()
+            if rec.ends_seq_num:
+                self.last_seq_num = rec.seq_num
             return rec
 
         except IndexError:
             self._empty = True
             raise StopIteration
 
+    __next__ = next
+
+    def next_batch(self, prefetch=True):
+        """Return all buffered records as a list, filling first if needed
+
+        This is normally the whole page returned by one get_records call, and
+        may be empty if the shard had nothing new. prefetch is passed on to
+        fill().
+        """
+        if self._empty:
+            self.fill(prefetch=prefetch)
+
+        batch = list(self.records)
+        self.records.clear()
+        self._empty = True
+
+        self.last_seq_num = _checkpoint_seq_num(batch, self.last_seq_num)
+        return batch
+
     def __repr__(self):
         return u'<StreamIterator {} {} ({})>'.format(
             self.stream.name, self.shard_id, self.iterator_type)
 
 
+class _PrefetchedPage(object):
+    """A get_records call for a StreamIterator, made by its _Prefetcher
+
+    The call is made once start_time is reached, so prefetching doesn't poll a
+    shard any more often than it otherwise would.
+    """
+
+    def __init__(self, iter_value, start_time):
+        self.iter_value = iter_value
+        self.start_time = start_time
+
+        self._result = None
+        self._exc_info = None
+        self._done = threading.Event()
+
+    def run(self, stream_iterator):
+        throttle_secs = self.start_time - time.time()
+        if throttle_secs > 0.0:
+            time.sleep(throttle_secs)
+
+        try:
+            self._result = stream_iterator._get_records(self.iter_value)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        finally:
+            self._done.set()
+
+    def wait(self, timeout=None):
+        """Wait for the call to finish, returning whether it has"""
+        return self._done.wait(timeout)
+
+    def result(self):
+        """Wait for the call, returning what _get_records() did"""
+        self._done.wait()
+        if self._exc_info is not None:
+            six.reraise(*self._exc_info)
+        return self._result
+
+
+class _Prefetcher(object):
+    """Makes a StreamIterator's prefetch calls from one long lived thread
+
+    Rather than a thread per page, which for a big combined iterator means
+    starting several threads a second. The thread exits once it's been idle
+    for PREFETCH_THREAD_IDLE_SECS, so closed or abandoned iterators don't
+    keep one, and is started again by the next fetch().
+    """
+
+    def __init__(self, stream_iterator):
+        self.stream_iterator = stream_iterator
+
+        self._pages = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def fetch(self, iter_value, start_time):
+        """Queue a get_records call, returning its _PrefetchedPage"""
+        page = _PrefetchedPage(iter_value, start_time)
+        with self._lock:
+            self._pages.put(page)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='triton-prefetch-{}'.format(
+                        self.stream_iterator.shard_id))
+                self._thread.daemon = True
+                self._thread.start()
+        return page
+
+    def _run(self):
+        while True:
+            try:
+                page = self._pages.get(timeout=PREFETCH_THREAD_IDLE_SECS)
+            except queue.Empty:
+                with self._lock:
+                    # fetch() only starts a thread if there isn't one, so
+                    # check nothing was queued for us on the way out
+                    if self._pages.empty():
+                        self._thread = None
+                        return
+                continue
+
+            page.run(self.stream_iterator)
+
+
+class PrefetchBudget(object):
+    """Caps how much is fetched ahead of what the consumer has taken
+
+    Tracks records (and their bytes) that have been fetched but not yet handed
+    out. Fetchers wait() for room before polling and ask page_limit() how many
+    records the next get_records call may return.
+
+    Args:
+        max_records - Most records to hold, None for no limit
+        max_bytes - Most payload bytes to hold, None for no limit
+    """
+
+    def __init__(self, max_records=None, max_bytes=None):
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+
+        self.records = 0
+        self.bytes = 0
+        self._avg_record_bytes = None
+        self._cond = threading.Condition()
+
+    def _has_room(self, pending_records=0, pending_bytes=0):
+        records = self.records + pending_records
+        num_bytes = self.bytes + pending_bytes
+        return (
+            (self.max_records is None or records < self.max_records) and
+            (self.max_bytes is None or num_bytes < self.max_bytes))
+
+    def has_room(self, pending_records=0, pending_bytes=0):
+        """Whether another page fits on top of pending records not yet added"""
+        with self._cond:
+            return self._has_room(pending_records, pending_bytes)
+
+    def page_limit(self, pending_records=0, pending_bytes=0):
+        """How many records a get_records call should ask for, or None"""
+        limits = []
+        with self._cond:
+            if self.max_records is not None:
+                limits.append(
+                    self.max_records - self.records - pending_records)
+            if self.max_bytes is not None and self._avg_record_bytes:
+                # We can't know the size of records before fetching them, so
+                # go by what we've seen so far.
+                limits.append(int(
+                    (self.max_bytes - self.bytes - pending_bytes) /
+                    self._avg_record_bytes))
+
+        if not limits:
+            return None
+        return min(max(min(limits), 1), KINESIS_MAX_GET_RECORDS)
+
+    def wait(self, timeout):
+        """Wait up to timeout for room, returning whether there is any"""
+        with self._cond:
+            if not self._has_room():
+                self._cond.wait(timeout)
+            return self._has_room()
+
+    def observe(self, records):
+        """Update the average record size, returning the bytes in records"""
+        num_bytes = sum(rec.size for rec in records)
+        if records:
+            page_avg = float(num_bytes) / len(records)
+            if self._avg_record_bytes is None:
+                self._avg_record_bytes = page_avg
+            else:
+                self._avg_record_bytes = (
+                    0.8 * self._avg_record_bytes + 0.2 * page_avg)
+        return num_bytes
+
+    def add(self, records):
+        with self._cond:
+            self.records += len(records)
+            self.bytes += self.observe(records)
+
+    def release(self, records):
+        with self._cond:
+            self.records -= len(records)
+            self.bytes -= sum(rec.size for rec in records)
+            self._cond.notify_all()
+
+
 class CombinedStreamIterator(object):
     """Combines multiple StreamIterators for reading from multiple shards
 
-    Handles load balancing between streams.
+    Handles load balancing between streams: each fill goes to the shard that
+    has been waiting longest to be polled again (see
+    StreamIterator._schedule_next_poll), sleeping only if no shard is due yet.
+
+    Follows resharding: once a shard closed by a split or merge is drained,
+    its iterator is retired and iterators for its child shards take its place.
+
+    Args:
+        iterators - list of StreamIterator()
+        max_buffered_records - Most records to fetch ahead of the consumer
+        max_buffered_bytes - Most payload bytes to fetch ahead of the consumer
     """
 
-    def __init__(self, iterators):
-        self.iterators = iterators
-        self._fill_iterators = set()
+    def __init__(self, iterators, max_buffered_records=None,
+                 max_buffered_bytes=None):
+        self.budget = PrefetchBudget(max_buffered_records, max_buffered_bytes)
+        self.iterators = list(iterators)
+        # Retired iterators whose final position hasn't been checkpointed yet
+        self._retired_iterators = []
+        # Every shard we've read to the end, for deciding when a merged child
+        # can start. Unlike _retired_iterators, never reset by checkpoint().
+        self._retired_shard_ids = set()
         self._running = True
-        self._last_wait = None
 
         self.last_iterator = None
         self.last_seq_num = None
 
-        self._records = []
-
-    def _wait(self):
-        if self._last_wait is None:
-            # First fill, no waiting
-            self._last_wait = time.time()
-            return
+        self._records = collections.deque()
 
-        secs_since_fill = time.time() - self._last_wait
-
-        throttle_secs = MIN_POLL_INTERVAL_SECS - secs_since_fill
+    def _wait(self, iter_to_fill):
+        throttle_secs = iter_to_fill.next_poll_time - time.time()
         if throttle_secs > 0.0:
-            throttle_secs = MIN_POLL_INTERVAL_SECS - secs_since_fill
             log.debug("Throttling for %f secs", throttle_secs)
             time.sleep(throttle_secs)
 
-        self._last_wait = time.time()
-
     def _fill(self):
-        if not self._fill_iterators:
-            self._wait()
-            self._fill_iterators.update(set(self.iterators))
+        if not self.iterators:
+            log.info("Every shard has been read to the end")
+            self.stop()
+            return
+
+        # Shards with records already buffered come first, they don't need
+        # to be polled.
+        iter_to_fill = min(
+            self.iterators, key=lambda i: (i._empty, i.next_poll_time))
+        self._wait(iter_to_fill)
 
-        iter_to_fill = self._fill_iterators.pop()
         self.last_iterator = iter_to_fill
+        # Where the shard was before the records we're about to hand out
+        self.last_seq_num = iter_to_fill.last_seq_num
         log.debug("Checking stream (%s, %s) ", iter_to_fill.stream.name,
                   iter_to_fill.shard_id)
-        self._records += list(iter_to_fill)
+        # We only fill once the buffer is empty, so the budget just bounds the
+        # size of each page.
+        iter_to_fill.limit = self.budget.page_limit()
+        try:
+            batch = iter_to_fill.next_batch(prefetch=False)
+        except errors.EndOfShardError:
+            self._retire_iterator(iter_to_fill)
+        else:
+            num_bytes = self.budget.observe(batch)
+            self._records.extend(batch)
+            # A prefetched page is buffered alongside this one, so it only
+            # gets what room this one leaves.
+            iter_to_fill.start_prefetch(self.budget, len(batch), num_bytes)
+
+    def _retire_iterator(self, closed_iterator):
+        """Replace a drained, closed shard's iterator with its children
+
+        A child created by a merge has two parents. It's started by whoever
+        reads its ParentShardId, and only once the adjacent parent (if we're
+        reading it too) has also been drained.
+
+        Returns the list of new StreamIterator() started.
+        """
+        stream = closed_iterator.stream
+        log.info("%r has ended", closed_iterator)
+
+        self.iterators.remove(closed_iterator)
+        self._retired_iterators.append(closed_iterator)
+        self._retired_shard_ids.add(closed_iterator.shard_id)
+
+        active_shard_ids = set(i.shard_id for i in self.iterators)
+
+        stream.refresh_shards()
+        child_iterators = []
+        for child_shard_id in stream.child_shard_ids(closed_iterator.shard_id):
+            parent_id, adjacent_parent_id = stream.parent_shard_ids(
+                child_shard_id)
+            if child_shard_id in active_shard_ids:
+                continue
+            if parent_id not in self._retired_shard_ids:
+                continue
+            if adjacent_parent_id in active_shard_ids:
+                continue
+
+            # We read the parent to its end, so everything written to the
+            # child is new to us.
+            if closed_iterator.from_checkpoint:
+                iterator_type = ITER_TYPE_FROM_CHECKPOINT
+            else:
+                iterator_type = ITER_TYPE_ALL
+
+            log.info("Starting child shard %s of %s", child_shard_id,
+                     closed_iterator.shard_id)
+            child_iterator = StreamIterator(
+                stream, child_shard_id, iterator_type,
+                prefetch=closed_iterator.prefetch)
+            child_iterators.append(child_iterator)
+
+        self.iterators.extend(child_iterators)
+        return child_iterators
 
     def __iter__(self):
         return self
@@ -222,8 +737,9 @@ class CombinedStreamIterator(object):
         # 4. Don't load more records after stop() is called
         while True:
             try:
-                rec = self._records.pop(0)
-                self.last_seq_num = rec.seq_num
+                rec = self._records.popleft()
+                if rec.ends_seq_num:
+                    self.last_seq_num = rec.seq_num
                 return rec
             except IndexError:
                 if not self._running:
@@ -231,27 +747,603 @@ class CombinedStreamIterator(object):
 
                 self._fill()
 
+    __next__ = next
+
+    def next_batch(self):
+        """Like next(), but returns a list of records from a single shard
+
+        Each batch is the rest of a get_records page, so processors can work
+        on many records per call. Raises StopIteration once stop() has been
+        called and everything already fetched has been delivered.
+        """
+        while not self._records:
+            if not self._running:
+                raise StopIteration
+
+            self._fill()
+
+        batch = list(self._records)
+        self._records.clear()
+        self.last_seq_num = _checkpoint_seq_num(batch, self.last_seq_num)
+        return batch
+
+    def iter_batches(self):
+        """Generator of next_batch() results"""
+        while True:
+            try:
+                batch = self.next_batch()
+            except StopIteration:
+                return
+            yield batch
+
     def stop(self):
         self._running = False
 
+    def _should_checkpoint(self, this_iterator):
+        return True
+
     def checkpoint(self):
+        # Shards we've finished still need their final position recorded,
+        # otherwise a restart from checkpoint would read them again.
+        retired_iterators, self._retired_iterators = (
+            self._retired_iterators, [])
+        for this_iterator in retired_iterators:
+            if self._should_checkpoint(this_iterator):
+                this_iterator.checkpoint()
+
         for this_iterator in set(self.iterators):
-            if this_iterator != self.last_iterator:
+            if not self._should_checkpoint(this_iterator):
+                continue
+            elif this_iterator != self.last_iterator:
                 # we've already processed all data pulled from this iterator
                 this_iterator.checkpoint()
-            else:
+            elif self.last_seq_num is not None:
                 # we could be in the middle of processing this data
                 # checkpoint only as far as the data retrieved via next()
                 this_iterator.checkpointer.checkpoint(
                     this_iterator.shard_id, self.last_seq_num)
 
 
+class ParallelCombinedStreamIterator(CombinedStreamIterator):
+    """Combines multiple StreamIterators, filling each from its own thread
+
+    Every shard gets a worker thread that polls Kinesis and pushes records
+    into a bounded per-shard queue. next() hands out whatever is ready,
+    rotating between shards, so one slow get_records call doesn't hold up
+    reading from the rest of the stream.
+
+    Workers also stop fetching while the iterator's PrefetchBudget is used up,
+    so memory stays bounded however far behind the consumer is.
+
+    Args:
+        iterators - list of StreamIterator()
+        max_queued_records - How many records a shard may have waiting before
+            its worker stops fetching.
+        max_buffered_records, max_buffered_bytes - Limits across all shards,
+            see CombinedStreamIterator
+    """
+
+    def __init__(
+        self, iterators, max_queued_records=MAX_QUEUED_RECORDS_PER_SHARD,
+        **kwargs
+    ):
+        super(ParallelCombinedStreamIterator, self).__init__(
+            iterators, **kwargs)
+        self.max_queued_records = max_queued_records
+
+        self._queues = []
+        self._threads = []
+        # Iterators that have a worker, so each is only ever given one
+        self._started_iterators = set()
+        self._next_queue = 0
+        self._ready = threading.Condition()
+        self._stopped = threading.Event()
+        self._worker_exc_info = None
+
+        # The workers read ahead of the consumer, so the StreamIterator's own
+        # last_seq_num can't be used for checkpointing. Track what we've
+        # actually handed out instead.
+        self._delivered_seq_nums = {}
+
+    def _start_workers(self):
+        with self._ready:
+            if self._threads:
+                return
+
+            # Workers retire their iterators (and start their children) under
+            # _ready, so the list can't change while we go through it.
+            for this_iterator in list(self.iterators):
+                self._start_worker(this_iterator)
+
+    def _start_worker(self, stream_iterator):
+        """Start a worker for the iterator, unless it already has one
+
+        Must be called holding _ready.
+        """
+        if stream_iterator in self._started_iterators:
+            return
+        self._started_iterators.add(stream_iterator)
+
+        q = queue.Queue(self.max_queued_records)
+        t = threading.Thread(
+            target=self._run_worker, args=(stream_iterator, q),
+            name='triton-{}'.format(stream_iterator.shard_id))
+        t.daemon = True
+        self._queues.append((stream_iterator, q))
+        self._threads.append(t)
+        t.start()
+
+    def _run_worker(self, stream_iterator, q):
+        try:
+            while self._running:
+                throttle_secs = stream_iterator.next_poll_time - time.time()
+                if throttle_secs > 0.0 and self._stopped.wait(throttle_secs):
+                    return
+
+                while not self.budget.wait(MIN_POLL_INTERVAL_SECS):
+                    if not self._running:
+                        return
+
+                log.debug("Checking stream (%s, %s) ",
+                          stream_iterator.stream.name,
+                          stream_iterator.shard_id)
+                stream_iterator.limit = self.budget.page_limit()
+                batch = stream_iterator.next_batch(prefetch=False)
+                self.budget.add(batch)
+                stream_iterator.start_prefetch(self.budget)
+                for rec in batch:
+                    if not self._put(q, rec):
+                        return
+        except errors.EndOfShardError:
+            with self._ready:
+                for child_iterator in self._retire_iterator(stream_iterator):
+                    self._start_worker(child_iterator)
+        except Exception:
+            log.exception("Worker for %r failed", stream_iterator)
+            with self._ready:
+                self._worker_exc_info = sys.exc_info()
+                self._ready.notify()
+
+    def _put(self, q, rec):
+        while True:
+            try:
+                q.put(rec, timeout=MIN_POLL_INTERVAL_SECS)
+            except queue.Full:
+                if not self._running:
+                    return False
+            else:
+                with self._ready:
+                    self._ready.notify()
+                return True
+
+    def _pop_ready(self, max_records):
+        num_queues = len(self._queues)
+        for offset in range(num_queues):
+            idx = (self._next_queue + offset) % num_queues
+            this_iterator, q = self._queues[idx]
+
+            records = []
+            while len(records) < max_records:
+                try:
+                    records.append(q.get_nowait())
+                except queue.Empty:
+                    break
+
+            if not records:
+                continue
+
+            self.budget.release(records)
+            self._next_queue = (idx + 1) % num_queues
+            seq_num = _checkpoint_seq_num(
+                records, self._delivered_seq_nums.get(this_iterator))
+            if seq_num is not None:
+                self._delivered_seq_nums[this_iterator] = seq_num
+            self.last_iterator = this_iterator
+            self.last_seq_num = seq_num
+            return records
+
+        return None
+
+    def _next_ready(self, max_records):
+        self._start_workers()
+
+        with self._ready:
+            while True:
+                records = self._pop_ready(max_records)
+                if records:
+                    return records
+
+                if self._worker_exc_info is not None:
+                    exc_info = self._worker_exc_info
+                    self._worker_exc_info = None
+                    six.reraise(*exc_info)
+
+                if not self._running:
+                    raise StopIteration
+
+                if not self.iterators:
+                    # Every worker has put its last record and retired
+                    log.info("Every shard has been read to the end")
+                    self.stop()
+                    raise StopIteration
+
+                self._ready.wait(MIN_POLL_INTERVAL_SECS)
+
+    def next(self):
+        return self._next_ready(1)[0]
+
+    __next__ = next
+
+    def next_batch(self):
+        return self._next_ready(self.max_queued_records)
+
+    def stop(self):
+        super(ParallelCombinedStreamIterator, self).stop()
+        self._stopped.set()
+
+    def checkpoint(self):
+        with self._ready:
+            # Retired shards are covered by _delivered_seq_nums
+            self._retired_iterators = []
+            delivered_seq_nums = list(self._delivered_seq_nums.items())
+
+        for this_iterator, seq_num in delivered_seq_nums:
+            this_iterator.checkpointer.checkpoint(
+                this_iterator.shard_id, seq_num)
+
+
+class LeasedCombinedStreamIterator(CombinedStreamIterator):
+    """Reads whichever shards this consumer holds leases for
+
+    Shard assignment is coordinated through TritonLeaseManager, so any number
+    of consumers sharing a TRITON_CLIENT_NAME divide the stream between them
+    and rebalance as consumers come and go. Shards are read from checkpoint.
+
+    Leases are renewed from a background thread, so they're kept however long
+    processing records takes. Shards are only picked up or dropped when
+    filling though. A dropped shard's position is checkpointed as it's
+    dropped, and after that checkpoint() leaves it to the new owner.
+
+    Children of a shard we've read to the end are read under leases of their
+    own, once each of their parents has been. The parent's lease is marked
+    finished by the checkpoint() that records its final position.
+
+    Args:
+        stream - Instance of Stream()
+        lease_manager - TritonLeaseManager() for the stream
+        renew_interval_secs - How often to renew and rebalance leases
+        prefetch - Passed to each StreamIterator()
+    """
+
+    def __init__(self, stream, lease_manager,
+                 renew_interval_secs=LEASE_RENEW_INTERVAL_SECS, prefetch=False,
+                 **kwargs):
+        super(LeasedCombinedStreamIterator, self).__init__([], **kwargs)
+        self.stream = stream
+        self.lease_manager = lease_manager
+        self.renew_interval_secs = renew_interval_secs
+        self.prefetch = prefetch
+
+        self._last_rebalance = None
+        # Shards we've read to the end
+        self._finished_leases = set()
+
+        # Guards lease_manager, which the renewal thread uses too
+        self._lease_lock = threading.Lock()
+        self._renewer = None
+        self._stopped = threading.Event()
+
+    def _renew_leases(self):
+        while not self._stopped.wait(self.renew_interval_secs):
+            try:
+                with self._lease_lock:
+                    self.lease_manager.renew()
+            except Exception:
+                log.exception("Failed to renew leases")
+
+    def _start_renewer(self):
+        if self._renewer is None:
+            self._renewer = threading.Thread(
+                target=self._renew_leases, name='triton-lease-renewer')
+            self._renewer.daemon = True
+            self._renewer.start()
+
+    def stop(self):
+        super(LeasedCombinedStreamIterator, self).stop()
+        self._stopped.set()
+
+    def _should_checkpoint(self, this_iterator):
+        # Once another consumer has the lease, its checkpoints win
+        with self._lease_lock:
+            owned_leases = self.lease_manager.owned_leases
+            return this_iterator.shard_id in owned_leases
+
+    def _drop_iterator(self, this_iterator):
+        """Stop reading a shard we no longer lease, checkpointing it first"""
+        log.info("No longer leasing %r", this_iterator)
+        self.iterators.remove(this_iterator)
+
+        if this_iterator is self.last_iterator:
+            # Anything still buffered is left for the new owner
+            self._records.clear()
+            self.last_iterator = None
+            seq_num = self.last_seq_num
+        else:
+            seq_num = this_iterator.last_seq_num
+
+        if seq_num is not None:
+            this_iterator.checkpointer.checkpoint(
+                this_iterator.shard_id, seq_num)
+
+    def _leaseable_shard_ids(self, finished_shard_ids):
+        """Shards to divide between consumers
+
+        The stream's oldest shards, except that those read to the end are
+        replaced by their children, once all of a child's parents have been.
+        Shards we've read to the end ourselves are kept alongside their
+        children until checkpoint() finishes them.
+        """
+        listed = set(self.stream.shard_ids)
+        drained_shard_ids = finished_shard_ids | self._retired_shard_ids
+
+        leaseable = []
+        seen = set()
+        to_visit = collections.deque(self.stream._select_shard_ids(None))
+        while to_visit:
+            shard_id = to_visit.popleft()
+            if shard_id in seen:
+                continue
+            seen.add(shard_id)
+
+            if shard_id not in finished_shard_ids:
+                leaseable.append(shard_id)
+            if shard_id not in drained_shard_ids:
+                continue
+
+            for child_shard_id in self.stream.child_shard_ids(shard_id):
+                parent_ids = listed.intersection(
+                    self.stream.parent_shard_ids(child_shard_id))
+                if parent_ids <= drained_shard_ids:
+                    to_visit.append(child_shard_id)
+
+        return leaseable
+
+    def _rebalance(self):
+        self._last_rebalance = time.time()
+        with self._lease_lock:
+            owned = self.lease_manager.rebalance(self._leaseable_shard_ids(
+                self.lease_manager.finished_shard_ids()))
+
+        for this_iterator in list(self._retired_iterators):
+            if this_iterator.shard_id not in owned:
+                self._retired_iterators.remove(this_iterator)
+                this_iterator.checkpoint()
+                # If it's no longer listed, but still ours
+                with self._lease_lock:
+                    self.lease_manager.finish(this_iterator.shard_id)
+
+        for this_iterator in list(self.iterators):
+            if this_iterator.shard_id not in owned:
+                self._drop_iterator(this_iterator)
+
+        reading = set(i.shard_id for i in self.iterators)
+        for shard_id in owned - reading - self._finished_leases:
+            log.info("Now leasing %s", shard_id)
+            self.iterators.append(StreamIterator(
+                self.stream, shard_id, ITER_TYPE_FROM_CHECKPOINT,
+                prefetch=self.prefetch))
+
+    def _retire_iterator(self, closed_iterator):
+        child_iterators = super(
+            LeasedCombinedStreamIterator, self)._retire_iterator(
+                closed_iterator)
+        self._finished_leases.add(closed_iterator.shard_id)
+
+        finished_shard_ids = None
+        leased_child_iterators = []
+        for child_iterator in child_iterators:
+            parent_ids = set(
+                self.stream.parent_shard_ids(child_iterator.shard_id))
+            parent_ids.discard(None)
+            parent_ids -= self._retired_shard_ids
+
+            with self._lease_lock:
+                if parent_ids:
+                    # A merge, with the other parent leased by someone else
+                    if finished_shard_ids is None:
+                        finished_shard_ids = (
+                            self.lease_manager.finished_shard_ids())
+                    parent_ids = (parent_ids & set(self.stream.shard_ids) -
+                                  finished_shard_ids)
+                leased = (not parent_ids and
+                          self.lease_manager.claim(child_iterator.shard_id))
+
+            if leased:
+                log.info("Now leasing child shard %s",
+                         child_iterator.shard_id)
+                leased_child_iterators.append(child_iterator)
+            else:
+                # Left for rebalancing to hand out
+                self.iterators.remove(child_iterator)
+
+        return leased_child_iterators
+
+    def checkpoint(self):
+        retired_iterators = list(self._retired_iterators)
+        super(LeasedCombinedStreamIterator, self).checkpoint()
+
+        # Their final positions are recorded, so nobody needs to read them
+        # again
+        with self._lease_lock:
+            for this_iterator in retired_iterators:
+                self.lease_manager.finish(this_iterator.shard_id)
+
+    def _fill(self):
+        self._start_renewer()
+        if (self._last_rebalance is None or
+                time.time() - self._last_rebalance >=
+                self.renew_interval_secs):
+            self._rebalance()
+
+        if not self.iterators:
+            log.debug("No leases held, waiting")
+            time.sleep(self.renew_interval_secs)
+            return
+
+        super(LeasedCombinedStreamIterator, self)._fill()
+
+
+class _GroupCommitSlot(object):
+    __slots__ = ['record', 'done', 'result', 'exception']
+
+    def __init__(self, record):
+        self.record = record
+        self.done = False
+        self.result = None
+        self.exception = None
+
+
+class _GroupCommit(object):
+    """Merges concurrent Stream.put() calls into put_records requests
+
+    The first caller to arrive while no request is in flight becomes the
+    leader: it writes every record queued so far (after waiting window_secs
+    for more to arrive) and hands each caller its own result. Callers that
+    arrive while a request is in flight queue up for the next one. A caller on
+    its own is written straight away, so this costs nothing without
+    contention.
+    """
+
+    def __init__(self, stream, window_secs=0.0):
+        self.stream = stream
+        self.window_secs = window_secs
+
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._in_flight = False
+
+    def _take_batch(self):
+        with self._cond:
+            batch = []
+            while self._queue and len(batch) < KINESIS_MAX_LENGTH:
+                batch.append(self._queue.popleft())
+            return batch
+
+    def _write_batch(self, batch):
+        try:
+            results = self.stream._put_packed([slot.record for slot in batch])
+            error = None
+        except errors.KinesisPutManyError as e:
+            results = e.results
+            error = e
+        except Exception as e:
+            results = [None] * len(batch)
+            error = e
+
+        with self._cond:
+            for idx, (slot, result) in enumerate(zip(batch, results)):
+                slot.done = True
+                slot.result = result
+                if result is None:
+                    slot.exception = self._caller_error(error, idx)
+
+    def _caller_error(self, error, idx):
+        """The error to raise for the caller of batch[idx], if not written
+
+        The same kind of exception put() raises without group commit, so
+        callers' except clauses don't depend on the setting.
+        """
+        if not isinstance(error, errors.KinesisPutManyError):
+            return error
+
+        record_error = None
+        if error.record_errors is not None:
+            record_error = error.record_errors[idx]
+        if record_error is None or record_error[0] is None:
+            return errors.KinesisError(
+                'An unknown error occurred for stream {}'.format(
+                    self.stream.name))
+        return _put_record_error(*record_error)
+
+    def put(self, record):
+        slot = _GroupCommitSlot(record)
+
+        with self._cond:
+            self._queue.append(slot)
+
+        while True:
+            with self._cond:
+                while self._in_flight and not slot.done:
+                    self._cond.wait()
+                if slot.done:
+                    break
+                self._in_flight = True
+
+            try:
+                if self.window_secs:
+                    time.sleep(self.window_secs)
+                self._write_batch(self._take_batch())
+            finally:
+                with self._cond:
+                    self._in_flight = False
+                    self._cond.notify_all()
+
+        if slot.exception is not None:
+            raise slot.exception
+        return slot.result
+
+
 class Stream(object):
+    """A Kinesis stream
 
-    def __init__(self, conn, name, partition_key):
+    Args:
+        conn - Kinesis connection, see connect_to_region()
+        name - Name of the stream
+        partition_key - Which field of each record to partition by
+        aggregate - Pack records written with put_many() (and by tritond)
+            into aggregated Kinesis records, see triton.aggregation
+        put_concurrency - How many put_records calls to have in flight when
+            writing a batch too big for one. Records with the same partition
+            key only stay in order across the calls with 1, the default.
+        rate_limit - Hold writes to keep each shard under its Kinesis write
+            limits, rather than being throttled. See triton.routing
+        compression - Codec to compress written records with, 'zlib' or
+            'snappy'. Readers decompress records whatever this is set to.
+        retry_policy - RetryPolicy() for writes, see triton.retry
+        group_commit - Merge put() calls made at the same time from different
+            threads into one put_records request. Each still waits for, and
+            returns, its own result.
+        group_commit_window_secs - How long a group commit waits for more
+            callers to join before writing
+    """
+
+    def __init__(self, conn, name, partition_key, aggregate=False,
+                 put_concurrency=PUT_CONCURRENCY, rate_limit=False,
+                 compression=None, retry_policy=None, group_commit=False,
+                 group_commit_window_secs=0.0):
         self.conn = conn
         self.name = ascii_to_unicode_str(name)
         self.partition_key = ascii_to_unicode_str(partition_key)
+        self.aggregate = aggregate
+        self.put_concurrency = put_concurrency
+        self._put_pool = None
+        self._put_pool_lock = threading.Lock()
+        # Shared by aggregation and rate limiting, so describe_stream is only
+        # called once per refresh
+        self._shard_map = RefreshingShardMap(self)
+        if rate_limit:
+            self.rate_limiter = ShardRateLimiter(
+                self, shard_map=self._shard_map)
+        else:
+            self.rate_limiter = None
+        check_compression(compression)
+        self.compression = compression
+        self.retry_policy = retry_policy or retry.RetryPolicy()
+        if group_commit:
+            self._group_commit = _GroupCommit(self, group_commit_window_secs)
+        else:
+            self._group_commit = None
+        self._shards = None
         self._shard_ids = None
 
     #NOTE: explanation of the convoluted try blocks in _partition_key!
@@ -272,23 +1364,121 @@ class Stream(object):
                 pass
             raise original_error
 
+    @property
+    def shards(self):
+        """Shard descriptions from describe_stream, across all pages"""
+        if self._shards is None:
+            self._shards = self._describe_shards()
+
+        return self._shards
+
+    def _describe_shards(self):
+        """Load the shard descriptions, without touching the cached ones"""
+        shards = []
+        stream_describe_resp = self.conn.describe_stream(self.name)
+        while True:
+            description = stream_describe_resp['StreamDescription']
+            shards.extend(description['Shards'])
+            if not description['HasMoreShards']:
+                break
+
+            stream_describe_resp = self.conn.describe_stream(
+                self.name, exclusive_start_shard_id=shards[-1]['ShardId'])
+
+        return shards
+
     @property
     def shard_ids(self):
         if self._shard_ids is None:
-            self._shard_ids = []
-            stream_describe_resp = self.conn.describe_stream(self.name)
+            self._shard_ids = [shard['ShardId'] for shard in self.shards]
 
-            if stream_describe_resp['StreamDescription']['HasMoreShards']:
-                raise NotImplementedError
+        return self._shard_ids
 
-            for shard in stream_describe_resp['StreamDescription']['Shards']:
-                self._shard_ids.append(shard['ShardId'])
+    def refresh_shards(self):
+        """Forget the cached shard list, e.g. after a reshard"""
+        self._shards = None
+        self._shard_ids = None
 
-        return self._shard_ids
+    def parent_shard_ids(self, shard_id):
+        """(ParentShardId, AdjacentParentShardId) for the shard
+
+        Either may be None; AdjacentParentShardId is only set for shards
+        created by a merge.
+        """
+        for shard in self.shards:
+            if shard['ShardId'] == shard_id:
+                return (shard.get('ParentShardId'),
+                        shard.get('AdjacentParentShardId'))
+        raise errors.ShardNotFoundError(shard_id)
+
+    def child_shard_ids(self, shard_id):
+        """Shards created by splitting or merging the shard"""
+        return [
+            shard['ShardId'] for shard in self.shards
+            if shard_id in (shard.get('ParentShardId'),
+                            shard.get('AdjacentParentShardId'))
+        ]
+
+    def _open_shard_ids(self, shard_ids):
+        """The shards, with closed ones replaced by their open descendants"""
+        closed = set(
+            shard['ShardId'] for shard in self.shards
+            if 'EndingSequenceNumber' in shard.get('SequenceNumberRange', {}))
+
+        open_shard_ids = []
+        seen = set()
+        to_visit = collections.deque(shard_ids)
+        while to_visit:
+            shard_id = to_visit.popleft()
+            if shard_id in seen:
+                continue
+            seen.add(shard_id)
+
+            if shard_id in closed:
+                to_visit.extend(self.child_shard_ids(shard_id))
+            else:
+                open_shard_ids.append(shard_id)
+        return open_shard_ids
+
+    def _listed_shard_ids(self, shard_ids):
+        """The shards, with any no longer listed replaced by their children
+
+        Closed shards drop out of describe_stream once they're past the
+        stream's retention period, but their children still name them as
+        parents.
+        """
+        listed = set(self.shard_ids)
+
+        listed_shard_ids = []
+        seen = set()
+        to_visit = collections.deque(shard_ids)
+        while to_visit:
+            shard_id = to_visit.popleft()
+            if shard_id in seen:
+                continue
+            seen.add(shard_id)
+
+            if shard_id in listed:
+                listed_shard_ids.append(shard_id)
+            else:
+                to_visit.extend(self.child_shard_ids(shard_id))
+        return listed_shard_ids
+
+    def _select_shard_ids(self, shard_nums, open_only=False, shard_ids=None):
+        """Shards to start iterators for
+
+        With open_only, closed shards are skipped in favour of their open
+        descendants, as nothing new will ever be written to them. Otherwise
+        closed shards are selected and their children started once they've
+        been read to the end.
 
-    def _select_shard_ids(self, shard_nums):
-        shard_ids = []
-        if shard_nums:
+        Shards can be picked by position in the shard list (shard_nums) or by
+        id (shard_ids). Positions shift as closed shards age out, ids don't.
+        """
+        if shard_ids is not None:
+            shard_ids = self._listed_shard_ids(shard_ids)
+        elif shard_nums:
+            shard_ids = []
             for shard_num in shard_nums:
                 try:
                     shard_ids.append(self.shard_ids[shard_num])
@@ -297,19 +1487,31 @@ class Stream(object):
         else:
             shard_ids = self.shard_ids
 
-        return shard_ids
+        if open_only:
+            shard_ids = self._open_shard_ids(shard_ids)
+
+        # Shards whose parent is also selected will be started by the
+        # iterator once the parent has been read to the end.
+        selected = set(shard_ids)
+        return [
+            shard_id for shard_id in shard_ids
+            if not selected.intersection(self.parent_shard_ids(shard_id))
+        ]
 
     def put(self, **kwargs):
-        try:
-            data = msgpack.packb(kwargs)
-        except TypeError:
-            # If we fail to serialize our context, we can try again with an
-            # enhanced packer (it's slower though)
-            data = msgpack.packb(kwargs, default=msgpack_encode_default)
-        resp = _call_and_retry(
+        record = self._pack(kwargs)
+
+        if self._group_commit is not None:
+            return self._group_commit.put(record)
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait([
+                (record['PartitionKey'], _packed_record_size(record))])
+
+        resp = self.retry_policy.call(
             self.conn.put_record,
-            self.name, data,
-            self._partition_key(kwargs)
+            self.name, record['Data'],
+            record['PartitionKey']
         )
 
         try:
@@ -319,23 +1521,57 @@ class Stream(object):
                 'An unknown error occurred for stream {},'
                 ' response was {}').format(self.name, resp))
 
-    def put_many(self, records):
-        data_recs = []
-        for r in records:
-            try:
-                data = msgpack.packb(r)
-            except TypeError:
-                # If we fail to serialize our context, we can try again with an
-                # enhanced packer (it's slower though)
-                data = msgpack.packb(r, default=msgpack_encode_default)
-            data_recs.append({
-                'Data': data,
-                'PartitionKey': self._partition_key(r),
-            })
-
-        return self._put_many_packed(data_recs)
-
-    def _put_many_packed(self, records, retry_count=0, b64_encode=True):
+    def _pack(self, data):
+        """Pack a record into the form _put_many_packed() takes"""
+        return {
+            'Data': compress_payload(msgpack_pack(data), self.compression),
+            'PartitionKey': self._partition_key(data),
+        }
+
+    def put_many(self, records, aggregate=None):
+        """Write a list of records, returning a (shard_id, seq_num) for each
+
+        Records that were aggregated together share a (shard_id, seq_num).
+        aggregate defaults to the stream's setting.
+        """
+        data_recs = [self._pack(r) for r in records]
+        return self._put_packed(data_recs, aggregate=aggregate)
+
+    def _put_packed(self, records, aggregate=None):
+        """Like _put_many_packed(), but aggregates records if configured to"""
+        if aggregate is None:
+            aggregate = self.aggregate
+        if not aggregate:
+            return self._put_many_packed(records)
+
+        shard_map = self._shard_map.get()
+
+        def shard_of(partition_key):
+            # Until the map catches up with a reshard some keys aren't
+            # covered, those only share aggregates with the same key
+            return shard_map.shard_id(partition_key) or (None, partition_key)
+
+        aggregated = aggregation.aggregate(records, shard_of=shard_of)
+
+        def expand(results):
+            expanded = [None] * len(records)
+            for (_, idxs), result in zip(aggregated, results):
+                for idx in idxs:
+                    expanded[idx] = result
+            return expanded
+
+        try:
+            results = self._put_many_packed([r for r, _ in aggregated])
+        except errors.KinesisPutManyError as e:
+            e.results = expand(e.results)
+            if e.record_errors is not None:
+                e.record_errors = expand(e.record_errors)
+            raise
+
+        return expand(results)
+
+    def _put_many_packed(self, records, retry_count=0, b64_encode=True,
+                         retry_delay=None):
         """Re-usable method for already packed messages,
             used here and by tritond for non-blocking writes
 
@@ -346,76 +1582,282 @@ class Stream(object):
                     'PartitionKey': partition_key of the record
                 }
             retry_count - number of retries for individual failed records
+            retry_delay - how long we waited before this retry, if it is one
             b64_encode  - parameter to boto kinesis library included b/c boto
                           changes the data record itself. We need to pass false
                           to prevent re-encoding on failure.
+
+        returns:
+            list() of (shard_id, seq_num), in the same order as records
+
+        Records are sent in as few put_records calls as the Kinesis count and
+        size limits allow. If some records still fail after retrying, or are
+        too big to send at all, raises KinesisPutManyError with those records
+        as failed_data, and the results list (with None for the failed
+        records) as results.
         """
-        resp_value = []
-        num_records = len(records)
-        max_record = 0
-        retry_records = []
-
-        while max_record < num_records:
-            # iterate through all the records MAX_LENTH records at a time
-
-            # Note that the following _call_and_retry will only
-            # retry for 500 server errors;
-            # ProvisionedThroughputExceededException
-            # will not happen for put_records
-            resp = _call_and_retry(
+        resp_value = [None] * len(records)
+        # (ErrorCode, ErrorMessage) for each failed record
+        resp_errors = [None] * len(records)
+        retry_idxs = []
+        retry_kind = retry.SERVER_ERROR
+        oversized_idxs = []
+
+        chunks = self._chunk_packed(records, oversized_idxs, b64_encode)
+        for idx in oversized_idxs:
+            # As Kinesis would have rejected it
+            resp_errors[idx] = (
+                'ValidationException',
+                'Record is over the Kinesis limit of {} bytes'.format(
+                    KINESIS_MAX_RECORD_BYTES))
+        if self.rate_limiter is not None:
+            scheduled = self._schedule_chunks(records, chunks, b64_encode)
+        else:
+            scheduled = [(0.0, chunk) for chunk in chunks]
+        chunks = [chunk for _, chunk in scheduled]
+
+        def put_chunk(scheduled_chunk):
+            send_time, chunk = scheduled_chunk
+            wait_secs = send_time - time.time()
+            if wait_secs > 0.0:
+                log.debug("Holding %d records for %s for %.2fs",
+                          len(chunk), self.name, wait_secs)
+                time.sleep(wait_secs)
+
+            # Note that this only retries whole calls that fail, for 500
+            # server errors; throttling is reported per record.
+            return self.retry_policy.call(
                 self.conn.put_records,
-                records[max_record:max_record + KINESIS_MAX_LENGTH],
+                [records[idx] for idx in chunk],
                 self.name,
                 b64_encode=b64_encode)
 
-            for idx, r in enumerate(resp['Records']):
+        if len(chunks) > 1 and self.put_concurrency > 1:
+            responses = self._get_put_pool().map(put_chunk, scheduled)
+        else:
+            responses = [put_chunk(s) for s in scheduled]
+
+        for chunk, resp in zip(chunks, responses):
+            for idx, r in zip(chunk, resp['Records']):
                 # Per http://docs.aws.amazon.com/kinesis/
                 # ...latest/APIReference/API_PutRecordsResultEntry.html
                 # ProvisionedThroughputExceededException and InternalFailure
                 # happen on a message by message basis.
                 # Check for individual failed messages and queue for retry
                 try:
-                    resp_value.append((r['ShardId'], r['SequenceNumber']))
+                    resp_value[idx] = (r['ShardId'], r['SequenceNumber'])
                 except KeyError:
-                    retry_records.append(records[max_record + idx])
-            max_record += KINESIS_MAX_LENGTH
-        if retry_records:
-            # if any individual messages have failed, retry them now
-            if retry_count > KINESIS_MAX_RETRYS:
-                raise errors.KinesisPutManyError(
-                    'Failed to put_many records to Kinesis',
-                    failed_data=retry_records)
-            else:
-                time.sleep(2 ** retry_count * .1)
-                resp_value.extend(self._put_many_packed(
-                    retry_records,
+                    retry_idxs.append(idx)
+                    resp_errors[idx] = (r.get('ErrorCode'),
+                                        r.get('ErrorMessage'))
+                    if r.get('ErrorCode') in retry.THROTTLING_ERROR_CODES:
+                        retry_kind = retry.THROTTLED
+
+        failed_idxs = list(oversized_idxs)
+        if retry_idxs and not self.retry_policy.should_retry(
+                retry_count, retry_kind,
+                max_retries=self.retry_policy.max_record_retries):
+            failed_idxs.extend(retry_idxs)
+        elif retry_idxs:
+            # if any individual messages have failed, retry just those
+            retry_delay = self.retry_policy.next_delay(retry_delay, retry_kind)
+            log.info("Retrying %d of %d records for %s after %.2fs (%s)",
+                     len(retry_idxs), len(records), self.name, retry_delay,
+                     retry_kind)
+            time.sleep(retry_delay)
+            retry_errors = [None] * len(retry_idxs)
+            try:
+                retry_values = self._put_many_packed(
+                    [records[idx] for idx in retry_idxs],
                     retry_count=retry_count + 1,
-                    b64_encode=False)
-                )
+                    b64_encode=False,
+                    retry_delay=retry_delay)
+            except errors.KinesisPutManyError as e:
+                retry_values = e.results
+                if e.record_errors is not None:
+                    retry_errors = e.record_errors
+
+            for idx, value, record_error in zip(
+                    retry_idxs, retry_values, retry_errors):
+                resp_value[idx] = value
+                if value is None:
+                    failed_idxs.append(idx)
+                    # The latest attempt's error, if we know it
+                    resp_errors[idx] = record_error or resp_errors[idx]
+                else:
+                    resp_errors[idx] = None
+
+        if failed_idxs:
+            failed_idxs.sort()
+            raise errors.KinesisPutManyError(
+                'Failed to put_many records to Kinesis ({} failed, {} over'
+                ' the size limit)'.format(
+                    len(failed_idxs) - len(oversized_idxs),
+                    len(oversized_idxs)),
+                failed_data=[records[idx] for idx in failed_idxs],
+                results=resp_value,
+                record_errors=resp_errors)
+
         return resp_value
 
-    def build_iterator_for_all(self, shard_nums=None):
-        shard_ids = self._select_shard_ids(shard_nums)
-        return self._build_iterator(ITER_TYPE_ALL, shard_ids, None)
+    def _get_put_pool(self):
+        # put_many can be called from several threads at once, e.g. a
+        # BatchingStream's flusher and its caller
+        with self._put_pool_lock:
+            if self._put_pool is None:
+                self._put_pool = ThreadPool(self.put_concurrency)
+            return self._put_pool
 
-    def build_iterator_from_seqnum(self, shard_id, seq_num):
-        return self._build_iterator(ITER_TYPE_FROM_SEQNUM, [shard_id], seq_num)
+    def _schedule_chunks(self, records, chunks, b64_encode=True):
+        """Reserve each shard's write capacity, splitting off held records
 
-    def build_iterator_from_latest(self, shard_nums=None):
-        shard_ids = self._select_shard_ids(shard_nums)
-        return self._build_iterator(ITER_TYPE_LATEST, shard_ids, None)
+        Records for shards that can take them now stay together in one
+        put_records call. Each shard that has to wait gets its own call, so a
+        hot shard doesn't hold up the rest of a chunk.
 
-    def build_iterator_from_checkpoint(self, shard_nums=None):
+        Returns a list of (send_time, chunk), soonest first.
+        """
+        shard_map = self._shard_map.get()
+        now = time.time()
+
+        scheduled = []
+        for chunk in chunks:
+            shard_chunks = collections.OrderedDict()
+            for idx in chunk:
+                shard_id = shard_map.shard_id(records[idx]['PartitionKey'])
+                shard_chunks.setdefault(shard_id, []).append(idx)
+
+            held_idxs = set()
+            for shard_chunk in shard_chunks.values():
+                wait_secs = self.rate_limiter.delay([
+                    (records[idx]['PartitionKey'],
+                     _packed_record_size(records[idx], b64_encode))
+                    for idx in shard_chunk
+                ])
+                if wait_secs > 0.0:
+                    scheduled.append((now + wait_secs, shard_chunk))
+                    held_idxs.update(shard_chunk)
+
+            ready_chunk = [idx for idx in chunk if idx not in held_idxs]
+            if ready_chunk:
+                scheduled.append((now, ready_chunk))
+
+        scheduled.sort(key=lambda s: s[0])
+        return scheduled
+
+    def _chunk_packed(self, records, oversized_idxs, b64_encode=True):
+        """Split records into lists of indexes, one per put_records call
+
+        Each chunk is as big as Kinesis allows, by both record count and
+        size. Records too big to ever be accepted are logged and added to
+        oversized_idxs rather than sent.
+        """
+        chunks = []
+        chunk = []
+        chunk_bytes = 0
+
+        for idx, record in enumerate(records):
+            size = _packed_record_size(record, b64_encode)
+            if size > KINESIS_MAX_RECORD_BYTES:
+                log.error(
+                    "Record for %s with partition key %r is %d bytes, over"
+                    " the Kinesis limit of %d", self.name,
+                    record['PartitionKey'], size, KINESIS_MAX_RECORD_BYTES)
+                oversized_idxs.append(idx)
+                continue
+
+            if chunk and (len(chunk) >= KINESIS_MAX_LENGTH or
+                          chunk_bytes + size > KINESIS_MAX_PUT_BYTES):
+                chunks.append(chunk)
+                chunk = []
+                chunk_bytes = 0
+
+            chunk.append(idx)
+            chunk_bytes += size
+
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    # Extra keyword arguments to the build_iterator_* methods are passed on to
+    # the iterator, e.g. max_buffered_records or max_buffered_bytes. prefetch
+    # is passed to each StreamIterator.
+
+    def build_iterator_for_all(self, shard_nums=None, parallel=False,
+                               **iterator_kwargs):
         shard_ids = self._select_shard_ids(shard_nums)
-        return self._build_iterator(ITER_TYPE_FROM_CHECKPOINT, shard_ids, None)
+        return self._build_iterator(
+            ITER_TYPE_ALL, shard_ids, None, parallel=parallel,
+            **iterator_kwargs)
+
+    def build_iterator_from_seqnum(self, shard_id, seq_num,
+                                   **iterator_kwargs):
+        return self._build_iterator(
+            ITER_TYPE_FROM_SEQNUM, [shard_id], seq_num, **iterator_kwargs)
+
+    def build_iterator_from_latest(self, shard_nums=None, parallel=False,
+                                   **iterator_kwargs):
+        shard_ids = self._select_shard_ids(shard_nums, open_only=True)
+        return self._build_iterator(
+            ITER_TYPE_LATEST, shard_ids, None, parallel=parallel,
+            **iterator_kwargs)
+
+    def build_iterator_from_checkpoint(self, shard_nums=None, parallel=False,
+                                       shard_ids=None, **iterator_kwargs):
+        shard_ids = self._select_shard_ids(shard_nums, shard_ids=shard_ids)
+        return self._build_iterator(
+            ITER_TYPE_FROM_CHECKPOINT, shard_ids, None, parallel=parallel,
+            **iterator_kwargs)
+
+    def build_iterator_from_leases(self, owner=None, **iterator_kwargs):
+        """Build an iterator over the shards this consumer can lease
+
+        See LeasedCombinedStreamIterator.
+        """
+        lease_manager = TritonLeaseManager(self.name, owner=owner)
+        return LeasedCombinedStreamIterator(
+            self, lease_manager, **iterator_kwargs)
 
-    def _build_iterator(self, iterator_type, shard_ids, seq_num):
+    def _build_iterator(self, iterator_type, shard_ids, seq_num,
+                        parallel=False, prefetch=False, **iterator_kwargs):
         all_iters = []
         for shard_id in shard_ids:
-            i = StreamIterator(self, shard_id, iterator_type, seq_num)
+            i = StreamIterator(self, shard_id, iterator_type, seq_num,
+                               prefetch=prefetch)
             all_iters.append(i)
 
-        return CombinedStreamIterator(all_iters)
+        if parallel:
+            return ParallelCombinedStreamIterator(all_iters, **iterator_kwargs)
+        return CombinedStreamIterator(all_iters, **iterator_kwargs)
+
+    def build_async_iterator_for_all(self, shard_nums=None,
+                                     **iterator_kwargs):
+        shard_ids = self._select_shard_ids(shard_nums)
+        return self._build_async_iterator(
+            ITER_TYPE_ALL, shard_ids, **iterator_kwargs)
+
+    def build_async_iterator_from_latest(self, shard_nums=None,
+                                         **iterator_kwargs):
+        shard_ids = self._select_shard_ids(shard_nums, open_only=True)
+        return self._build_async_iterator(
+            ITER_TYPE_LATEST, shard_ids, **iterator_kwargs)
+
+    def build_async_iterator_from_checkpoint(self, shard_nums=None,
+                                             **iterator_kwargs):
+        shard_ids = self._select_shard_ids(shard_nums)
+        return self._build_async_iterator(
+            ITER_TYPE_FROM_CHECKPOINT, shard_ids, **iterator_kwargs)
+
+    def _build_async_iterator(self, iterator_type, shard_ids,
+                              prefetch=False, **iterator_kwargs):
+        # Imported here since asyncio syntax isn't available on python 2
+        from triton.async_stream import AsyncCombinedStreamIterator
+
+        all_iters = [
+            StreamIterator(self, shard_id, iterator_type, prefetch=prefetch)
+            for shard_id in shard_ids
+        ]
+        return AsyncCombinedStreamIterator(all_iters, **iterator_kwargs)
 
 
 def connect_to_region(region_name, **kw_params):
@@ -426,39 +1868,82 @@ def connect_to_region(region_name, **kw_params):
         endpoint='kinesis.{}.amazonaws.com'.format(region_name),
         connection_cls=boto.kinesis.layer1.KinesisConnection)
 
-    return region.connect(**kw_params)
+    conn = region.connect(**kw_params)
+    # So another process can connect the same way, see triton.worker
+    conn.triton_connect_params = dict(kw_params)
+    return conn
+
+
+# (region_name, connection params) -> KinesisConnection, see get_connection()
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(region_name, **kw_params):
+    """Like connect_to_region(), but shares connections across the process
+
+    Each boto connection keeps a thread safe pool of kept-alive HTTPS
+    connections, so sharing one between all the streams in a region (with
+    the same credentials) saves a TLS handshake per stream.
+    """
+    key = (region_name, tuple(sorted(kw_params.items())))
+    with _connections_lock:
+        conn = _connections.get(key)
+        if conn is None:
+            conn = connect_to_region(region_name, **kw_params)
+            _connections[key] = conn
+        return conn
+
+
+def clear_connections():
+    """Forget shared connections, e.g. in a child process after fork"""
+    with _connections_lock:
+        _connections.clear()
 
 
 def get_stream(stream_name, config):
     s_config = config.get(stream_name)
-    if not s_config:
+    # tritond's own settings share the namespace, but aren't a stream
+    if not s_config or stream_name == TRITOND_CONFIG_KEY:
         raise errors.StreamNotConfiguredError()
 
-    conn = connect_to_region(s_config.get('region', 'us-east-1'))
+    conn = get_connection(s_config.get('region', 'us-east-1'))
 
-    return Stream(conn, s_config['name'], s_config['partition_key'])
+    return Stream(conn, s_config['name'], s_config['partition_key'],
+                  aggregate=s_config.get('aggregate', False),
+                  put_concurrency=s_config.get(
+                      'put_concurrency', PUT_CONCURRENCY),
+                  rate_limit=s_config.get('rate_limit', False),
+                  compression=s_config.get('compression'),
+                  group_commit=s_config.get('group_commit', False),
+                  group_commit_window_secs=s_config.get(
+                      'group_commit_window_secs', 0.0))
 
 
-def _call_and_retry(kinesis_function, *args, **kwargs):
+def _put_record_error(error_code, error_message):
+    """The exception put_record raises for an error put_records reports for
+    a single record
     """
-    Retry Logic for generic kinesis calls.
+    body = {'__type': error_code, 'message': error_message}
+    if error_code == 'InternalFailure':
+        return JSONResponseError(500, 'Internal Server Error', body=body)
+
+    exception_class = boto.kinesis.layer1.KinesisConnection._faults.get(
+        error_code, JSONResponseError)
+    return exception_class(400, 'Bad Request', body=body)
 
-    This code follows the exponetial backoff pattern suggested by
-    http://docs.aws.amazon.com/general/latest/gr/api-retries.html
+
+def _packed_record_size(record, b64_encoded=True):
+    """Size of a packed record as Kinesis counts it
+
+    b64_encoded is False once boto has base64 encoded the data in place, as
+    it does for records we're retrying.
     """
-    retries = 0
-    while True:
-        try:
-            return kinesis_function(*args, **kwargs)
-        except BotoServerError as e:
-            if retries >= KINESIS_MAX_RETRYS:
-                raise e
-            if (
-                    e.status / 100 == 5  # 5xx error
-                    or
-                    type(e) == ProvisionedThroughputExceededException
-            ):
-                time.sleep(2 ** retries * .1)
-                retries += 1
-            else:
-                raise e
+    data_size = len(record['Data'])
+    if not b64_encoded:
+        data_size = data_size * 3 // 4
+
+    partition_key = record['PartitionKey']
+    if isinstance(partition_key, six.text_type):
+        partition_key = partition_key.encode('utf-8')
+    return data_size + len(partition_key)
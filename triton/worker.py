@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+triton.worker
+~~~~~~~~
+
+Common code for consumers that just need to handle records.
+
+A ShardWorkerPool splits a stream's shards across several worker processes,
+each reading its shards from checkpoint and handing records to a handler, and
+restarts any worker that dies, backing off if it keeps dying. Decoding and
+handling records is CPU bound, so this lets a consumer use more than one core.
+
+"""
+from __future__ import unicode_literals
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+from triton import checkpoint
+from triton.stream import Stream, clear_connections, get_connection
+
+log = logging.getLogger(__name__)
+
+# How often workers record their position
+CHECKPOINT_INTERVAL_SECS = 10.0
+
+# How often the supervisor checks on its workers
+SUPERVISE_INTERVAL_SECS = 1.0
+
+# Delay before restarting a worker that died, doubling each time it dies
+# again until it stays up for RESTART_MAX_DELAY_SECS
+RESTART_BASE_DELAY_SECS = 1.0
+RESTART_MAX_DELAY_SECS = 60.0
+
+
+def consume(stream_iterator, handler, batch=False,
+            checkpoint_interval_secs=CHECKPOINT_INTERVAL_SECS):
+    """Hand every record from the iterator to handler, checkpointing as we go
+
+    Args:
+        stream_iterator - CombinedStreamIterator() to read from
+        handler - callable taking a Record, or a list of them if batch is set
+        batch - Call handler with each batch from iter_batches() instead of
+            record by record
+        checkpoint_interval_secs - How often to checkpoint
+    """
+    if batch:
+        items = stream_iterator.iter_batches()
+    else:
+        items = stream_iterator
+
+    last_checkpoint = time.time()
+    for item in items:
+        handler(item)
+
+        if time.time() - last_checkpoint >= checkpoint_interval_secs:
+            stream_iterator.checkpoint()
+            last_checkpoint = time.time()
+
+    stream_iterator.checkpoint()
+
+
+def _worker_main(stream_name, partition_key, region_name, connect_params,
+                 shard_ids, handler, batch, checkpoint_interval_secs):
+    # Anything inherited from the supervisor by a fork can't be shared with
+    # it, so every worker makes its own connections and Stream. Building the
+    # Stream here also means only picklable arguments cross over, as the
+    # spawn and forkserver start methods need.
+    clear_connections()
+    checkpoint.postal_rds_pool = None
+    conn = get_connection(region_name, **connect_params)
+    stream = Stream(conn, stream_name, partition_key)
+
+    stream_iterator = stream.build_iterator_from_checkpoint(
+        shard_ids=shard_ids)
+
+    def handle_stop(signum, frame):
+        log.info("Worker %d stopping", os.getpid())
+        stream_iterator.stop()
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+
+    consume(stream_iterator, handler, batch=batch,
+            checkpoint_interval_secs=checkpoint_interval_secs)
+
+
+class ShardWorkerPool(object):
+    """Runs a stream consumer across multiple processes
+
+    Shards are divided between workers; each worker builds an iterator from
+    checkpoint for its shards and calls handler for every record. Workers that
+    exit with an error are restarted, after a delay that grows each time
+    they die again.
+
+    Workers connect to Kinesis the way the stream's connection was made (see
+    connect_to_region()). handler is passed to them, so it must be picklable,
+    e.g. a module level function.
+
+    Usage:
+
+        pool = ShardWorkerPool(stream, handle_record, num_workers=4)
+        pool.run()  # Until SIGTERM/SIGINT
+
+    Args:
+        stream - Instance of Stream()
+        handler - callable taking a Record (or a list of them, see batch)
+        num_workers - How many processes, defaults to one per CPU. Never more
+            than one per shard.
+        batch - Call handler with lists of records rather than one at a time
+        checkpoint_interval_secs - How often each worker checkpoints
+    """
+
+    def __init__(self, stream, handler, num_workers=None, batch=False,
+                 checkpoint_interval_secs=CHECKPOINT_INTERVAL_SECS):
+        self.stream = stream
+        self.handler = handler
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.batch = batch
+        self.checkpoint_interval_secs = checkpoint_interval_secs
+
+        self._running = True
+        # shard_ids tuple -> worker process
+        self._processes = {}
+        # shard_ids tuple -> when its worker was started
+        self._start_times = {}
+        # shard_ids tuple -> how many times in a row its worker has died
+        self._failures = {}
+        # shard_ids tuple -> when to restart its worker, once it's died
+        self._restart_times = {}
+
+    def shard_groups(self):
+        """Divide the stream's shards into a list of shard ids per worker
+
+        Only shards that aren't children of other selected shards are
+        assigned; the worker reading the parent picks up its children.
+        Workers are given ids rather than positions in the shard list, which
+        shift as closed shards age out.
+        """
+        shard_ids = self.stream._select_shard_ids(None)
+
+        num_groups = min(self.num_workers, len(shard_ids))
+        return [shard_ids[n::num_groups] for n in range(num_groups)]
+
+    def _worker_args(self, shard_ids):
+        conn = self.stream.conn
+        return (self.stream.name, self.stream.partition_key,
+                conn.region.name, getattr(conn, 'triton_connect_params', {}),
+                shard_ids, self.handler, self.batch,
+                self.checkpoint_interval_secs)
+
+    def _start_process(self, shard_ids):
+        process = multiprocessing.Process(
+            target=_worker_main, args=self._worker_args(shard_ids))
+        process.daemon = True
+        process.start()
+        log.info("Started worker %d for shards %r", process.pid, shard_ids)
+        return process
+
+    def _start_worker(self, group):
+        self._processes[group] = self._start_process(list(group))
+        self._start_times[group] = time.time()
+
+    def _supervise(self):
+        now = time.time()
+        for group, restart_time in list(self._restart_times.items()):
+            if now >= restart_time:
+                del self._restart_times[group]
+                self._start_worker(group)
+
+        for group, process in list(self._processes.items()):
+            if process.is_alive():
+                continue
+
+            del self._processes[group]
+            if process.exitcode == 0:
+                log.info("Worker %d for shards %r finished",
+                         process.pid, list(group))
+                continue
+
+            if now - self._start_times[group] >= RESTART_MAX_DELAY_SECS:
+                # It had been running fine, so this is a new problem
+                self._failures[group] = 0
+            failures = self._failures.get(group, 0) + 1
+            self._failures[group] = failures
+
+            delay_secs = min(RESTART_MAX_DELAY_SECS,
+                             RESTART_BASE_DELAY_SECS * 2 ** (failures - 1))
+            log.error("Worker %d for shards %r died (%r), restarting in "
+                      "%.0fs", process.pid, list(group), process.exitcode,
+                      delay_secs)
+            self._restart_times[group] = now + delay_secs
+
+    def stop(self):
+        self._running = False
+
+    def run(self):
+        def handle_stop(signum, frame):
+            log.info("Stopping workers")
+            self.stop()
+
+        signal.signal(signal.SIGTERM, handle_stop)
+        signal.signal(signal.SIGINT, handle_stop)
+
+        for group in self.shard_groups():
+            self._start_worker(tuple(group))
+
+        while self._running and (self._processes or self._restart_times):
+            time.sleep(SUPERVISE_INTERVAL_SECS)
+            if self._running:
+                self._supervise()
+
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+
+        for process in self._processes.values():
+            process.join()